@@ -31,6 +31,8 @@ def setExptParams():
     #print 'test: ','\n  '.join(testData.pprint())
     prog = program.ProPPRProgram.loadRules("%s-train-isg.ppr" % stem,db=db)
     prog.setRuleWeights()
+    # let the rule weights gain non-zeros during learning
+    prog.db.markAsGrowable('weighted',1)
     prog.maxDepth=4
     return (prog, trainData, testData)
 
@@ -110,6 +110,8 @@ def accExpt(prog,trainFile,testFile,n,maxD,epochs):
     trainData = dataset.Dataset.loadExamples(prog.db,trainFile)
     testData = dataset.Dataset.loadExamples(prog.db,testFile)
     prog.db.markAsParameter('edge',2)
+    # the learned paths use cells that are not edges of the grid
+    prog.db.markAsGrowable('edge',2)
     prog.maxDepth = maxD
     # 20 epochs and rate=0.01 is ok for grid size 16 depth 10
     # then it gets sort of chancy
@@ -0,0 +1,29 @@
+import sys
+
+from tensorlog import countmin
+from tensorlog import dataset
+from tensorlog import matrixdb
+from tensorlog import program
+
+import expt
+
+# accuracy/memory trade-off of count-min compression of the grid
+#
+# usage: python cmexpt.py [grid-size] [maxDepth] [depth]
+
+def runMain():
+    n = int(sys.argv[1]) if len(sys.argv)>1 else 16
+    maxD = int(sys.argv[2]) if len(sys.argv)>2 else 4
+    depth = int(sys.argv[3]) if len(sys.argv)>3 else 3
+    (factFile,trainFile,testFile) = expt.genInputs(n)
+    db = matrixdb.MatrixDB.loadFile(factFile)
+    prog = program.Program.loadRules("grid.ppr",db)
+    prog.maxDepth = maxD
+    testData = dataset.Dataset.loadExamples(db,testFile)
+    print('grid-cm-expt: %d x %d grid, %d entities, maxPath %d, depth %d' % (n,n,db.dim(),maxD,depth))
+    widths = [w for w in [n*n//8,n*n//4,n*n//2,n*n] if w>0]
+    for r in countmin.tradeoff(db,prog.rules,testData,widths,depth,maxDepth=maxD):
+        print('width %(width)d: %(bytes)d bytes (%(compression).1fx smaller) precision %(precision).3f recall %(recall).3f' % r)
+
+if __name__=="__main__":
+    runMain()
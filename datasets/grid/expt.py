@@ -173,6 +173,8 @@ def timingExpt(prog):
 def accExpt(prog,trainData,testData,n,maxD,epochs):
     print('grid-acc-expt: %d x %d grid, %d epochs, maxPath %d' % (n,n,epochs,maxD))
     prog.db.markAsParameter('edge',2)
+    # the learned paths use cells that are not edges of the grid
+    prog.db.markAsGrowable('edge',2)
     prog.maxDepth = maxD
     # 20 epochs and rate=0.01 is ok for grid size 16 depth 10
     # then it gets sort of chancy
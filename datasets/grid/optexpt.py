@@ -0,0 +1,61 @@
+import sys
+import time
+
+from tensorlog import dataset
+from tensorlog import learn
+from tensorlog import matrixdb
+from tensorlog import program
+
+import expt
+
+# compare optimizers on the grid: for each optimizer and rate, the
+# number of epochs and seconds of full-batch gradient descent needed
+# to reach a test accuracy, and the final test accuracy
+#
+# usage: python optexpt.py [grid-size] [maxDepth] [epochs] [targetAcc]
+
+OPTIMIZERS = [
+    ('fixed', learn.FixedRateOptimizer, [0.01, 0.05]),
+    ('adagrad', learn.AdaGradOptimizer, [0.01, 0.1]),
+    ('rmsprop', learn.RMSPropOptimizer, [0.001, 0.01]),
+    ('adam', learn.AdamOptimizer, [0.001, 0.01]),
+]
+
+def trainUntil(factFile,trainFile,testFile,maxD,epochs,optimizer,rate,target):
+    db = matrixdb.MatrixDB.loadFile(factFile)
+    prog = program.Program.loadRules("grid.ppr",db)
+    prog.maxDepth = maxD
+    prog.db.markAsParameter('edge',2)
+    # the learned paths use cells that are not edges of the grid
+    prog.db.markAsGrowable('edge',2)
+    trainData = dataset.Dataset.loadExamples(prog.db,trainFile)
+    testData = dataset.Dataset.loadExamples(prog.db,testFile)
+    learner = learn.FixedRateGDLearner(prog,epochs=1,rate=rate,optimizer=optimizer,
+                                       tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent)
+    elapsed = 0.0
+    reached = None
+    acc = 0.0
+    for epoch in range(1,epochs+1):
+        start = time.time()
+        learner.train(trainData)
+        elapsed += time.time() - start
+        acc = learner.datasetAccuracy(testData,learner.datasetPredict(testData))
+        if reached is None and acc >= target:
+            reached = (epoch,elapsed)
+    return reached,acc,elapsed
+
+def runMain():
+    n = int(sys.argv[1]) if len(sys.argv)>1 else 16
+    maxD = int(sys.argv[2]) if len(sys.argv)>2 else 8
+    epochs = int(sys.argv[3]) if len(sys.argv)>3 else 20
+    target = float(sys.argv[4]) if len(sys.argv)>4 else 0.85
+    (factFile,trainFile,testFile) = expt.genInputs(n)
+    print('grid-opt-expt: %d x %d grid, maxPath %d, %d epochs, target acc %.2f' % (n,n,maxD,epochs,target))
+    for name,optimizerClass,rates in OPTIMIZERS:
+        for rate in rates:
+            reached,acc,elapsed = trainUntil(factFile,trainFile,testFile,maxD,epochs,optimizerClass(),rate,target)
+            toTarget = 'epoch %d, %.1f sec' % reached if reached else 'not reached'
+            print('%-8s rate %-6g target: %-20s final acc %.3f in %.1f sec' % (name,rate,toTarget,acc,elapsed))
+
+if __name__=="__main__":
+    runMain()
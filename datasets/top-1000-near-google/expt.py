@@ -33,6 +33,8 @@ def setExptParams():
   testData = comline.parseDatasetSpec('tmp-cache/{stem}-test.dset|raw/{stem}.test.examples'.format(stem=stem), db)
   prog = comline.parseProgSpec("{stem}-recursive.ppr".format(stem=stem),db,proppr=True)
   prog.setRuleWeights()
+  # let the rule weights gain non-zeros during learning
+  prog.db.markAsGrowable('weighted',1)
   prog.maxDepth=4
   learner = learn.FixedRateGDLearner(prog,epochs=5)
   return {'prog':prog,
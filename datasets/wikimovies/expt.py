@@ -27,6 +27,9 @@ def setExptParams(num):
     testData = comline.parseDatasetSpec('tmp-cache/test-%d.dset|inputs/test-%d.exam'  % (num,num), db)
     prog = comline.parseProgSpec("theory.ppr",db,proppr=True)
     prog.setFeatureWeights()
+    # let the feature weights gain non-zeros during learning
+    for (functor,arity) in prog.getParamList():
+        prog.db.markAsGrowable(functor,arity)
     learner = plearn.ParallelFixedRateGDLearner(prog,regularizer=learn.L2Regularizer(),parallel=5,epochs=10)
     return {'prog':prog,
             'trainData':trainData,
@@ -22,5 +22,5 @@ setup(name='tensorlog',
         #'debug':['ttk', 'Tkinter', 'tkfont'],
         'debug':['pyttk'],
         },
-      packages=['tensorlog'],
+      packages=['tensorlog','tensorlog.bench'],
       zip_safe=False)
@@ -0,0 +1,16 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# a reproducible benchmark suite.  Each workload generates its own
+# inputs deterministically from a size name and a seed, and is
+# measured for database load time, compilation speed, query latency
+# and throughput, learning time, peak memory, and the scaling of the
+# parallel learner.  Results are saved as JSON, and two result files
+# can be compared to find regressions.  Usage:
+#
+#  python -m tensorlog.bench run --out results.json [--workloads grid,chain] [--size small] [--repeats 3] [--parallel 1,2,4]
+#  python -m tensorlog.bench compare base.json new.json [--threshold 0.1]
+#  python -m tensorlog.bench sampling [--sizes 8,16,32] [--negatives 10] [--repeats 3]
+#
+# The sampling command shows where the time of a gradient step goes
+# with and without negative sampling, as the grid grows.
+#
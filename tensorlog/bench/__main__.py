@@ -0,0 +1,77 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# command-line interface for the benchmark suite - see __init__.py
+
+import getopt
+import sys
+import tempfile
+
+from tensorlog.bench import measure
+from tensorlog.bench import results
+from tensorlog.bench import workloads
+
+def usage():
+  print('usage: python -m tensorlog.bench run --out results.json [--workloads grid,chain] [--size tiny|small|medium|large]')
+  print('                                     [--repeats n] [--parallel 1,2,4] [--queries n] [--dir inputDir] [--seed n]')
+  print('       python -m tensorlog.bench compare base.json new.json [--threshold 0.1]')
+  print('       python -m tensorlog.bench sampling [--sizes 8,16,32] [--negatives 10] [--repeats 3] [--dir inputDir]')
+  print('  compare exits with status 1 if any metric regressed')
+
+def runMain(argv):
+  if not argv or argv[0] not in ['run','compare','sampling']:
+    usage()
+    sys.exit(-1)
+  command = argv[0]
+  argspec = ["out=","workloads=","size=","repeats=","parallel=","queries=","dir=","seed=","threshold=","sizes=","negatives="]
+  try:
+    optlist,args = getopt.gnu_getopt(argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if command=='run':
+    if '--out' not in optdict:
+      usage()
+      sys.exit(-1)
+    size = optdict.get('--size','small')
+    seed = int(optdict.get('--seed',0))
+    repeats = int(optdict.get('--repeats',3))
+    parallel = [int(k) for k in optdict.get('--parallel','1,2').split(',')]
+    numQueries = int(optdict.get('--queries',200))
+    direc = optdict.get('--dir') or tempfile.mkdtemp(prefix='tlbench-')
+    output = {'environment':results.environment(),'size':size,'workloads':{}}
+    for name in optdict.get('--workloads','grid,chain').split(','):
+      workload = workloads.makeWorkload(name,size,seed)
+      print('measuring workload %s %r' % (name,workload.params))
+      output['workloads'][name] = measure.measureIsolated(workload,direc,repeats,parallel,numQueries)
+      for metric,value in sorted(output['workloads'][name]['metrics'].items()):
+        print('  %-16s %g' % (metric,value))
+    results.save(output,optdict['--out'])
+    print('results saved in %s' % optdict['--out'])
+  elif command=='sampling':
+    sizes = [int(n) for n in optdict.get('--sizes','8,16,32').split(',')]
+    repeats = int(optdict.get('--repeats',3))
+    numNegatives = int(optdict.get('--negatives',10))
+    direc = optdict.get('--dir') or tempfile.mkdtemp(prefix='tlbench-')
+    scaling = measure.samplingScaling(sizes,direc,repeats,numNegatives)
+    steps = ['eval_sec','loss_sec','backprop_sec','softmax_cells']
+    print('%-6s %-8s %-8s %s' % ('size','entities','softmax',' '.join('%-13s' % k for k in steps)))
+    for n in sizes:
+      for softmax in ['full','sampled']:
+        times = scaling[str(n)][softmax]
+        print('%-6d %-8d %-8s %s' % (n,scaling[str(n)]['entities'],softmax,' '.join('%-13g' % times[k] for k in steps)))
+  else:
+    if len(args)!=2:
+      usage()
+      sys.exit(-1)
+    threshold = float(optdict['--threshold']) if '--threshold' in optdict else None
+    comparison = results.compare(results.load(args[0]),results.load(args[1]),threshold)
+    for line in results.report(comparison):
+      print(line)
+    regressions = [c for c in comparison if c[-1]]
+    print('%d of %d metrics regressed' % (len(regressions),len(comparison)))
+    if regressions:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  runMain(sys.argv[1:])
@@ -0,0 +1,212 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# measurements taken for each workload of the benchmark suite.  Times
+# are the median over several repeats, to reduce noise.
+
+import multiprocessing
+import resource
+import time
+import traceback
+
+import numpy as NP
+
+from tensorlog import dataset
+from tensorlog import learn
+from tensorlog import matrixdb
+from tensorlog import mutil
+from tensorlog import opfunutil
+from tensorlog import plearn
+from tensorlog import program
+from tensorlog.bench import workloads
+
+def _median(xs):
+  return float(NP.median(xs))
+
+def _timed(fun,repeats):
+  """Run fun repeats times, and return the median elapsed time in
+  seconds and the result of the last call."""
+  elapsed = []
+  for r in range(repeats):
+    start = time.time()
+    result = fun()
+    elapsed.append(time.time() - start)
+  return _median(elapsed),result
+
+def peakRSSMegabytes():
+  """Peak resident set size of this process so far."""
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def loadTime(workload,files,repeats):
+  """Seconds to load the workload's database from its .cfacts file."""
+  return _timed(lambda:matrixdb.MatrixDB.loadFile(files.facts),repeats)
+
+def _newProgram(db,rules,workload):
+  prog = program.Program(db=db,rules=rules)
+  prog.maxDepth = workload.maxDepth
+  return prog
+
+def compileRate(db,rules,modes,workload,repeats):
+  """Modes compiled per second, with a fresh program each time."""
+  def compileAll():
+    prog = _newProgram(db,rules,workload)
+    for mode in modes:
+      prog.compile(mode)
+  elapsed,_ = _timed(compileAll,repeats)
+  return len(modes)/elapsed if elapsed else 0.0
+
+def queryLatencies(prog,dset,numQueries):
+  """Milliseconds to answer each of up to numQueries single queries,
+  taken in order from the modes of a dataset."""
+  result = []
+  for mode in dset.modesToLearn():
+    X = dset.getX(mode)
+    for i in range(min(mutil.numRows(X),numQueries-len(result))):
+      x = mutil.selectRows(X,i,i+1)
+      start = time.time()
+      prog.eval(mode,[x])
+      result.append(1000.0*(time.time() - start))
+  return result
+
+def batchRate(prog,dset,repeats):
+  """Queries answered per second when each mode of a dataset is
+  answered as one minibatch."""
+  def evalAll():
+    for mode in dset.modesToLearn():
+      prog.eval(mode,[dset.getX(mode)])
+  elapsed,_ = _timed(evalAll,repeats)
+  numQueries = sum(mutil.numRows(dset.getX(mode)) for mode in dset.modesToLearn())
+  return numQueries/elapsed if elapsed else 0.0
+
+def epochTime(prog,dset,repeats):
+  """Seconds for an epoch of batch gradient descent."""
+  learner = learn.FixedRateGDLearner(prog,epochs=1,tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent)
+  elapsed,_ = _timed(lambda:learner.train(dset),repeats)
+  return elapsed
+
+def samplingTimes(prog,dset,sampler,repeats):
+  """A dictionary with the seconds spent in each step of computing
+  the gradient for every mode of a dataset in one batch: evaluating
+  the inner function of the predict function ('eval_sec'), the
+  softmax and loss ('loss_sec'), and backprop ('backprop_sec'), and
+  the number of answers the softmax is over ('softmax_cells').  If
+  sampler is a learn.NegativeSampler the softmax is sampled, and
+  the inner function only scores the answers drawn where it can."""
+  steps = ['eval_sec','loss_sec','backprop_sec']
+  elapsed = dict((k,[]) for k in steps)
+  cells = 0
+  for r in range(repeats):
+    total = dict((k,0.0) for k in steps)
+    cells = 0
+    for mode in dset.modesToLearn():
+      X,Y = dset.getX(mode),dset.getY(mode)
+      predictFun = prog.getPredictFunction(mode)
+      pad = opfunutil.Scratchpad()
+      relations = predictFun.fun.relationsUsed()
+      start = time.time()
+      if sampler is not None:
+        candidates = sampler.candidates(Y,predictFun.outputType,relations)
+        pad[predictFun.fun.id].candidates = candidates
+      unnorm = predictFun.fun.eval(prog.db,[X],pad)
+      total['eval_sec'] += time.time() - start
+      start = time.time()
+      if sampler is not None:
+        unnorm = sampler.restrict(unnorm,candidates,Y,predictFun.outputType,relations)
+      _,_,delta = mutil.softmaxCrossEntropy(prog.db,unnorm,Y)
+      total['loss_sec'] += time.time() - start
+      cells += unnorm.nnz
+      start = time.time()
+      predictFun.fun.backprop(delta,learn.GradAccumulator(db=prog.db),pad)
+      total['backprop_sec'] += time.time() - start
+    for k in steps:
+      elapsed[k].append(total[k])
+  result = dict((k,_median(elapsed[k])) for k in steps)
+  result['softmax_cells'] = cells
+  return result
+
+def samplingScaling(sizes,direc,repeats=3,numNegatives=10,proposal='frequency'):
+  """Measure samplingTimes with and without a NegativeSampler on grid
+  workloads of each size.  Returns a dictionary mapping each size
+  to the number of entities and a pair of samplingTimes results,
+  'full' and 'sampled'."""
+  result = {}
+  for n in sizes:
+    workload = workloads.GridWorkload(n=n)
+    files = workload.generate(direc)
+    db = matrixdb.MatrixDB.loadFile(files.facts)
+    prog = _newProgram(db,program.Program.loadRules(files.rules,db).rules,workload)
+    for (functor,arity) in workload.parameters:
+      db.markAsParameter(functor,arity)
+    trainData = dataset.Dataset.loadExamples(db,files.train)
+    sampler = learn.NegativeSampler(db,numNegatives=numNegatives,proposal=proposal)
+    result[str(n)] = {'entities':db.dim(),
+                      'full':samplingTimes(prog,trainData,None,repeats),
+                      'sampled':samplingTimes(prog,trainData,sampler,repeats)}
+  return result
+
+def parallelEpochTimes(prog,dset,parallel,repeats,miniBatchSize=25):
+  """A dictionary mapping each number of worker processes to the
+  seconds for an epoch of the parallel learner, not counting the
+  time to start the workers."""
+  result = {}
+  for k in parallel:
+    learner = plearn.ParallelFixedRateGDLearner(prog,epochs=1,parallel=k,miniBatchSize=miniBatchSize,
+                                                tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent)
+    try:
+      result[k],_ = _timed(lambda:learner.train(dset),repeats)
+    finally:
+      learner.pool.terminate()
+      learner.pool.join()
+  return result
+
+def measureWorkload(workload,direc,repeats=3,parallel=(1,2),numQueries=200):
+  """Generate the inputs for a workload and measure it.  Returns a
+  dictionary with the workload's parameters, a dictionary of
+  metrics, and the parallel learner's scaling curve."""
+  files = workload.generate(direc)
+  metrics = {}
+  metrics['load_sec'],db = loadTime(workload,files,repeats)
+  rules = program.Program.loadRules(files.rules,db).rules
+  trainData = dataset.Dataset.loadExamples(db,files.train)
+  testData = dataset.Dataset.loadExamples(db,files.test)
+  modes = sorted(set(trainData.modesToLearn()) | set(testData.modesToLearn()),key=str)
+  metrics['compile_fps'] = compileRate(db,rules,modes,workload,repeats)
+  prog = _newProgram(db,rules,workload)
+  latencies = queryLatencies(prog,testData,numQueries)
+  metrics['query_p50_ms'] = float(NP.percentile(latencies,50))
+  metrics['query_p99_ms'] = float(NP.percentile(latencies,99))
+  metrics['batch_qps'] = batchRate(prog,testData,repeats)
+  # learning changes the parameters, so it is measured last
+  for (functor,arity) in workload.parameters:
+    db.markAsParameter(functor,arity)
+  metrics['epoch_sec'] = epochTime(prog,trainData,repeats)
+  epochTimes = parallelEpochTimes(prog,trainData,parallel,repeats)
+  metrics['peak_rss_mb'] = peakRSSMegabytes()
+  base = epochTimes.get(min(epochTimes)) if epochTimes else None
+  scaling = {}
+  for k in sorted(epochTimes):
+    scaling[str(k)] = {'epoch_sec':epochTimes[k],
+                       'speedup':(base/epochTimes[k] if epochTimes[k] else 0.0)}
+  return {'params':workload.params,'metrics':metrics,'scaling':scaling}
+
+##############################################################################
+# Each workload is measured in a separate process, so the peak memory
+# of one workload doesn't hide that of the next.
+##############################################################################
+
+def _measureInProcess(queue,workload,direc,repeats,parallel,numQueries):
+  try:
+    queue.put((True,measureWorkload(workload,direc,repeats,parallel,numQueries)))
+  except Exception:
+    queue.put((False,traceback.format_exc()))
+
+def measureIsolated(workload,direc,repeats=3,parallel=(1,2),numQueries=200):
+  """Like measureWorkload, but run in a new process."""
+  queue = multiprocessing.Queue()
+  # not a daemon, so it can start the parallel learner's workers
+  proc = multiprocessing.Process(target=_measureInProcess,args=(queue,workload,direc,repeats,parallel,numQueries))
+  proc.start()
+  ok,result = queue.get()
+  proc.join()
+  assert ok, 'measuring workload %s failed:\n%s' % (workload.name,result)
+  return result
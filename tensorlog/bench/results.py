@@ -0,0 +1,90 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# saving benchmark results as JSON, and comparing two sets of results
+
+import json
+import multiprocessing
+import platform
+import time
+
+import numpy as NP
+import scipy
+
+from tensorlog import config
+from tensorlog import version
+
+conf = config.Config()
+conf.threshold = 0.1;        conf.help.threshold = 'A metric regresses if it is worse by more than this fraction'
+conf.min_seconds = 0.001;    conf.help.min_seconds = 'Ignore changes in times when both are below this many seconds'
+
+# metrics where a larger value is better - for all others, smaller is better
+HIGHER_IS_BETTER = set(['compile_fps','batch_qps','speedup'])
+
+def environment():
+  """A description of the machine and software that results came from."""
+  return {'tensorlog':version.VERSION,
+          'python':platform.python_version(),
+          'numpy':NP.__version__,
+          'scipy':scipy.__version__,
+          'platform':platform.platform(),
+          'cpus':multiprocessing.cpu_count(),
+          'time':time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def save(results,fileName):
+  with open(fileName,'w') as fp:
+    json.dump(results,fp,indent=2,sort_keys=True)
+
+def load(fileName):
+  with open(fileName) as fp:
+    return json.load(fp)
+
+def flatten(results):
+  """Map (workload,metric) pairs to values, where the scaling curve
+  gives metrics like 'epoch_sec@4' and 'speedup@4' for 4 workers."""
+  result = {}
+  for name,w in list(results['workloads'].items()):
+    for metric,value in list(w['metrics'].items()):
+      result[(name,metric)] = value
+    for k,point in list(w.get('scaling',{}).items()):
+      for metric,value in list(point.items()):
+        result[(name,'%s@%s' % (metric,k))] = value
+  return result
+
+def _baseMetric(metric):
+  return metric.split('@')[0]
+
+def _isTime(metric):
+  return _baseMetric(metric).endswith('_sec') or _baseMetric(metric).endswith('_ms')
+
+def compare(base,new,threshold=None):
+  """Compare two sets of results, and return a list of tuples
+  (workload,metric,baseValue,newValue,change,regressed) for the
+  metrics in both, where change is the fractional change in the
+  direction of improvement, eg -0.2 if a time went up by 20%.  Results
+  for workloads with different parameters are not compared."""
+  if threshold is None: threshold = conf.threshold
+  result = []
+  baseFlat = flatten(base)
+  newFlat = flatten(new)
+  for key in sorted(set(baseFlat) & set(newFlat)):
+    (name,metric) = key
+    if base['workloads'][name]['params']!=new['workloads'][name]['params']:
+      continue
+    b,n = baseFlat[key],newFlat[key]
+    if _baseMetric(metric) in HIGHER_IS_BETTER:
+      change = (n-b)/b if b else 0.0
+    else:
+      change = (b-n)/b if b else 0.0
+    regressed = change < -threshold
+    if _isTime(metric):
+      toSec = 0.001 if _baseMetric(metric).endswith('_ms') else 1.0
+      if max(b,n)*toSec < conf.min_seconds: regressed = False
+    result.append((name,metric,b,n,change,regressed))
+  return result
+
+def report(comparison):
+  """Lines describing a comparison, with regressions flagged."""
+  lines = []
+  for (name,metric,b,n,change,regressed) in comparison:
+    lines.append('%-12s %-20s %12.4g %12.4g %+7.1f%%%s' % (name,metric,b,n,100.0*change,'  REGRESSION' if regressed else ''))
+  return lines
@@ -0,0 +1,159 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# synthetic workloads for the benchmark suite.  A workload writes a
+# .cfacts file, a rule file, and training and test .exam files into a
+# directory.  The inputs depend only on the workload's parameters, so
+# results from different runs and machines are comparable.
+
+import os
+import os.path
+
+import numpy as NP
+import numpy.random as NR
+import scipy.sparse as SS
+
+class WorkloadFiles(object):
+  """The files generated for a workload."""
+
+  def __init__(self,facts,rules,train,test):
+    self.facts = facts
+    self.rules = rules
+    self.train = train
+    self.test = test
+
+class Workload(object):
+  """Abstract workload.  Subclasses set self.name, self.params (a
+  dictionary of JSON-able parameter values), self.maxDepth and
+  self.parameters (the relations that are learned), and implement
+  _writeFacts, _writeRules and _examples."""
+
+  def generate(self,direc):
+    """Write the inputs for this workload into a subdirectory of direc,
+    reusing them if they already exist, and return a WorkloadFiles."""
+    stem = os.path.join(direc,'%s-%s' % (self.name,'-'.join('%s%s' % kv for kv in sorted(self.params.items()))))
+    files = WorkloadFiles(stem+'.cfacts',stem+'.ppr',stem+'-train.exam',stem+'-test.exam')
+    if all(os.path.exists(f) for f in [files.facts,files.rules,files.train,files.test]):
+      return files
+    if not os.path.exists(direc):
+      os.makedirs(direc)
+    with open(files.facts,'w') as fp:
+      self._writeFacts(fp)
+    with open(files.rules,'w') as fp:
+      self._writeRules(fp)
+    examples = self._examples()
+    # a fixed fraction of the examples, chosen by the seed, is held out
+    isTrain = NR.RandomState(self.params['seed']).rand(len(examples)) < 0.67
+    with open(files.train,'w') as fpTrain, open(files.test,'w') as fpTest:
+      for (pred,x,ys),train in zip(examples,isTrain):
+        (fpTrain if train else fpTest).write('\t'.join([pred,x] + ys) + '\n')
+    return files
+
+class GridWorkload(Workload):
+  """Path-finding in an n-by-n grid, where each cell is linked to its
+  neighbors, with a recursive path predicate - see datasets/grid."""
+
+  EDGE_WEIGHT = 0.2
+
+  def __init__(self,n=16,maxDepth=8,seed=0):
+    self.name = 'grid'
+    self.params = {'n':n,'maxDepth':maxDepth,'seed':seed}
+    self.maxDepth = maxDepth
+    self.parameters = [('edge',2)]
+
+  @staticmethod
+  def nodeName(i,j):
+    return '%d,%d' % (i,j)
+
+  def _writeFacts(self,fp):
+    n = self.params['n']
+    for i in range(1,n+1):
+      for j in range(1,n+1):
+        for di in [-1,0,+1]:
+          for dj in [-1,0,+1]:
+            if (1 <= i+di <= n) and (1 <= j+dj <= n):
+              fp.write('edge\t%s\t%s\t%f\n' % (self.nodeName(i,j),self.nodeName(i+di,j+dj),self.EDGE_WEIGHT))
+
+  def _writeRules(self,fp):
+    fp.write('path(X,Y) :- edge(X,Y).\n')
+    fp.write('path(X,Y) :- edge(X,Z), path(Z,Y).\n')
+
+  def _examples(self):
+    # the target is the nearest corner
+    n = self.params['n']
+    result = []
+    for i in range(1,n+1):
+      for j in range(1,n+1):
+        ti = 1 if i<=n//2 else n
+        tj = 1 if j<=n//2 else n
+        result.append(('path',self.nodeName(i,j),[self.nodeName(ti,tj)]))
+    return result
+
+class ChainWorkload(Workload):
+  """A random multi-relational graph, with target predicates defined
+  by rules that follow one or two relations, so there are many
+  modes to compile and learn."""
+
+  def __init__(self,numEntities=2000,numRelations=8,degree=3,numTargets=4,numQueries=200,seed=0):
+    self.name = 'chain'
+    self.params = {'entities':numEntities,'relations':numRelations,'degree':degree,
+                   'targets':numTargets,'queries':numQueries,'seed':seed}
+    self.maxDepth = 1
+    self.parameters = [('r%d' % k,2) for k in range(numRelations)]
+    rs = NR.RandomState(seed)
+    # for each relation, its (src,dst) pairs
+    self.edges = []
+    for k in range(numRelations):
+      numEdges = numEntities*degree
+      self.edges.append((rs.randint(numEntities,size=numEdges),rs.randint(numEntities,size=numEdges)))
+    # for each target, the relations in its rules
+    self.bodies = [tuple(rs.choice(numRelations,size=3,replace=False)) for t in range(numTargets)]
+    self.queries = [rs.choice(numEntities,size=numQueries,replace=False) for t in range(numTargets)]
+
+  @staticmethod
+  def entityName(i):
+    return 'e%d' % i
+
+  def _writeFacts(self,fp):
+    for k,(src,dst) in enumerate(self.edges):
+      for i,j in sorted(set(zip(src.tolist(),dst.tolist()))):
+        fp.write('r%d\t%s\t%s\n' % (k,self.entityName(i),self.entityName(j)))
+
+  def _writeRules(self,fp):
+    for t,(a,b,c) in enumerate(self.bodies):
+      fp.write('t%d(X,Y) :- r%d(X,Y).\n' % (t,a))
+      fp.write('t%d(X,Y) :- r%d(X,Z), r%d(Z,Y).\n' % (t,a,b))
+      fp.write('t%d(X,Y) :- r%d(X,Z), r%d(Z,Y).\n' % (t,b,c))
+
+  def _examples(self):
+    # the answers to a query are the entities reachable by the first
+    # two rules of the target
+    n = self.params['entities']
+    mats = [SS.csr_matrix((NP.ones(len(src)),(src,dst)),shape=(n,n)) for (src,dst) in self.edges]
+    result = []
+    for t,(a,b,c) in enumerate(self.bodies):
+      reach = (mats[a] + mats[a]*mats[b]).tocsr()
+      for x in self.queries[t]:
+        ys = reach.indices[reach.indptr[x]:reach.indptr[x+1]]
+        if len(ys):
+          result.append(('t%d' % t,self.entityName(x),[self.entityName(y) for y in sorted(ys)]))
+    return result
+
+# parameters of each workload at each size
+SIZES = {
+  'grid': {'tiny':{'n':6,'maxDepth':4},
+           'small':{'n':16,'maxDepth':8},
+           'medium':{'n':32,'maxDepth':16},
+           'large':{'n':64,'maxDepth':24}},
+  'chain': {'tiny':{'numEntities':200,'numRelations':4,'degree':2,'numTargets':2,'numQueries':40},
+            'small':{'numEntities':2000,'numRelations':8,'degree':3,'numTargets':4,'numQueries':200},
+            'medium':{'numEntities':20000,'numRelations':16,'degree':4,'numTargets':8,'numQueries':1000},
+            'large':{'numEntities':200000,'numRelations':32,'degree':5,'numTargets':16,'numQueries':5000}},
+}
+
+WORKLOAD_CLASSES = {'grid':GridWorkload, 'chain':ChainWorkload}
+
+def makeWorkload(name,size='small',seed=0):
+  """Return the workload with the given name and size name."""
+  assert name in WORKLOAD_CLASSES, 'unknown workload %r' % name
+  assert size in SIZES[name], 'unknown size %r for workload %s' % (size,name)
+  return WORKLOAD_CLASSES[name](seed=seed,**SIZES[name][size])
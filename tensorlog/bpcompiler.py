@@ -18,6 +18,7 @@ conf = config.Config()
 conf.strict = True;     conf.help.strict =    "Check that a clause fits all assumptions"
 conf.trace = False;     conf.help.trace =     "Print debug info during BP"
 conf.produce_ops = True;  conf.help.produce_ops =   "Turn off to debug analysis"
+conf.fold_constants = True;  conf.help.fold_constants = "Compute the outputs of ops that don't depend on the inputs once, and reuse them"
 
 # functor for the special 'assign(Var,const) predicate
 ASSIGN = 'assign'
@@ -98,7 +99,10 @@ class BPCompiler(object):
     """
     if not self.compiled:
       self.compile()
-    return funs.OpSeqFunction(self.inputs, self.output, self.ops, self.rule, self.inputTypes, self.outputType)
+    fun = funs.OpSeqFunction(self.inputs, self.output, self.ops, self.rule, self.inputTypes, self.outputType)
+    # mark the ops that a learner can cache the outputs of
+    fun.markParameterFree(self.tensorlogProg.db)
+    return fun
 
   #
   # debugging tools
@@ -166,8 +170,22 @@ class BPCompiler(object):
     for op in self.ops:
       op.dstType = self.msgType.get(op.dst)
 
+    if conf.fold_constants:
+      self.foldConstants()
+
     self.compiled = True
 
+  def foldConstants(self):
+    """Mark the ops whose outputs don't depend on the inputs of the
+    function, like the preimage of a fixed relation, so that they are
+    computed once and cached.  The cached output is recomputed if the
+    relation it comes from changes, and isn't used for parameters -
+    see ops.Op.constantKey.
+    """
+    for op in self.ops:
+      if op.isConstant():
+        op.folded = True
+
   #
   # simpler subroutines of compile
   #
@@ -52,6 +52,7 @@ def parseCommandLine(argv,extraArgConsumer=None,extraArgSpec=[],extraArgUsage=[]
         print( ' --prog file.ppr           - file is parsable as tensorlog rules')
         print( ' --trainData file.exam     - optional: file is parsable with Dataset.loadExamples')
         print( ' --trainData file.dset     - optional: file is a serialized Dataset')
+        print( ' --trainData file.mdset    - optional: file is a memory-mapped dataset.MemmapDataset')
         print( ' --testData file.exam      - optional:')
         print( ' --proppr                  - if present, assume the file has proppr features with')
         print( '                             every rule: {ruleid}, or {all(F): p(X,...),q(...,F)}')
@@ -82,7 +83,7 @@ def parseCommandLine(argv,extraArgConsumer=None,extraArgSpec=[],extraArgUsage=[]
         assert False,'--db and --prog are required options'
 
     startTime = time.time()
-    def status(msg): logging.info('%s time %.3f sec mem %.3f Gb' % (msg,time.time()-startTime,util.memusage()))
+    def status(msg): logging.info('%s time %.3f sec rss %.3f Gb peak %.3f Gb' % (msg,time.time()-startTime,util.memusage(),util.peakMemusage()))
 
     status('loading db')
     db = parseDBSpec(optdict['--db'])
@@ -111,9 +112,13 @@ def parseDatasetSpec(spec,db):
     if isUncachefromSrc(spec):
         cache,src = getCacheSrcPair(spec)
         assert src.endswith(".examples") or src.endswith(".exam"), 'illegal --train or --test file'
+        if cache.endswith(".mdset"):
+            return dataset.MemmapDataset.uncacheExamples(cache,db,src,proppr=src.endswith(".examples"))
         return dataset.Dataset.uncacheExamples(cache,db,src,proppr=src.endswith(".examples"))
     elif spec.endswith(".dset"):
         return dataset.Dataset.deserialize(spec)
+    elif spec.endswith(".mdset"):
+        return dataset.MemmapDataset(spec)
     else:
         assert spec.endswith(".examples") or spec.endswith(".exam"), 'illegal --train or --test file'
         return dataset.Dataset.loadExamples(db,spec,proppr=spec.endswith(".examples"))
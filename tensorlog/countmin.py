@@ -0,0 +1,264 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# count-min embeddings of large types.  The entities of a compressed
+# type are hashed into a small number of buckets, relations are
+# rewritten to map buckets to buckets, and inference runs in the
+# embedded space.  Scores for the original entities are recovered, as
+# in a count-min sketch, by taking the minimum over the buckets an
+# entity hashes to.  Usage:
+#
+#  python -m tensorlog.countmin --db foo.cfacts --prog foo.ppr --queries foo.examples [--widths 100,1000] [--depth 3]
+#
+# prints the memory used and the precision and recall of the
+# (unnormalized) answers to the queries for each width.
+#
+# Summary of the construction: let H be an N-by-W matrix where row i
+# has a one in each of the D buckets entity i hashes to, and let H1 be
+# H with rows normalized to sum to one.  A k-hot vector v is embedded
+# as vH, and a matrix M as H1^T M H, so that, absent collisions,
+# (vH)(H1^T M H) = (vM)H.  The special entities (the null entity and
+# the out-of-vocabulary entity) are not hashed, but keep their own
+# ids, so normalization works as usual in the embedded space.
+#
+
+import getopt
+import sys
+
+import numpy as NP
+import numpy.random as NR
+import scipy.sparse as SS
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import dbschema
+from tensorlog import matrixdb
+from tensorlog import mutil
+from tensorlog import program
+
+conf = config.Config()
+conf.width = 1000;  conf.help.width = 'Number of buckets that each compressed type is hashed into'
+conf.depth = 3;     conf.help.depth = 'Number of hash functions used for each compressed type'
+conf.seed = 0;      conf.help.seed = 'Seed for choosing the hash functions'
+
+# ids that are never hashed: 0 is unused and 1, 2 are the null and
+# out-of-vocabulary entities
+NUM_RESERVED_IDS = 3
+BUCKET_NAME = '__bucket_%d'
+# a Mersenne prime larger than any entity id
+HASH_PRIME = 2**31 - 1
+
+def bucketIds(n,width,depth,seed=0):
+  """Return an n-by-depth array giving the embedded id of each bucket
+  that each of the ids 0...n-1 hashes to.  Hashing is with the
+  universal family ((a*i + b) mod p) mod width, and embedded ids of
+  buckets start after the reserved ids."""
+  rand = NR.RandomState(seed)
+  a = rand.randint(1,HASH_PRIME,size=depth).astype(NP.int64)
+  b = rand.randint(0,HASH_PRIME,size=depth).astype(NP.int64)
+  ids = NP.arange(n,dtype=NP.int64)
+  buckets = NUM_RESERVED_IDS + ((ids[:,None]*a[None,:] + b[None,:]) % HASH_PRIME) % width
+  reserved = min(n,NUM_RESERVED_IDS)
+  buckets[:reserved,:] = ids[:reserved,None]
+  return buckets
+
+def embedderMatrix(buckets,embeddedDim):
+  """The 0/1 matrix H with H[i,j]=1 iff id i hashes to embedded id j."""
+  n,depth = buckets.shape
+  rows = NP.repeat(NP.arange(n),depth)
+  cols = buckets.reshape(-1)
+  H = mutil.csrFromCOO(NP.ones(n*depth),rows,cols,(n,embeddedDim),'embedderMatrix')
+  # two hashes of the same id can collide
+  return mutil.mapData(NP.sign,H)
+
+class TypeEmbedding(object):
+  """The count-min embedding of one type of a database."""
+
+  def __init__(self,n,width,depth,seed=0):
+    self.n = n
+    self.width = width
+    self.depth = depth
+    self.dim = width + NUM_RESERVED_IDS
+    self.buckets = bucketIds(n,width,depth,seed)
+    self.H = embedderMatrix(self.buckets,self.dim)
+    rowCounts = NP.diff(self.H.indptr)
+    self._H1T = mutil.asCSR((SS.diags(1.0/NP.maximum(rowCounts,1))*self.H).transpose(),'TypeEmbedding')
+    self._HT = mutil.asCSR(self.H.transpose(),'TypeEmbedding')
+    self._rowCounts = rowCounts
+
+  def embed(self,X):
+    """Embed the rows of X, a matrix over the original ids."""
+    return mutil.asCSR(X*self.H,'embed')
+
+  def embedRows(self,M):
+    """H1^T M: the left-hand side of an embedded relation."""
+    return self._H1T*M
+
+  def decode(self,W,minScore=0.0):
+    """Return a sparse matrix over the original ids whose row r holds
+    the estimated score of each entity for row r of W, a matrix over
+    the embedded ids.  The estimate for an entity is the minimum of
+    W over the buckets it hashes to, and only entities for which all
+    those buckets score above minScore are included."""
+    W = mutil.asCSR(W,'decode')
+    # count how many of each entity's buckets are non-zero in W, and
+    # keep entities where all of them are
+    hits = mutil.asCSR(mutil.mapData(lambda d:(d>minScore).astype(mutil.DATA_DTYPE),W)*self._HT,'decode')
+    rows = mutil.rowIndices(hits)
+    cols = hits.indices
+    full = hits.data==self._rowCounts[cols]
+    rows,cols = rows[full],cols[full]
+    dense = W.toarray()
+    scores = dense[rows[:,None],self.buckets[cols]].min(axis=1)
+    return mutil.csrFromCOO(scores,rows,cols,(mutil.numRows(W),self.n),'decode')
+
+class CountMinDB(object):
+  """A count-min compressed version of a MatrixDB.  The given types
+  (by default, all types) are embedded with width buckets and depth
+  hash functions, and the given relations (by default, all
+  relations) are rewritten to use the embedded ids.  The compressed
+  relations are held in an ordinary MatrixDB, self.edb, so
+  compiled programs run on it without change.
+  """
+
+  def __init__(self,db,types=None,relations=None,width=None,depth=None,seed=None):
+    width = conf.width if width is None else width
+    depth = conf.depth if depth is None else depth
+    seed = conf.seed if seed is None else seed
+    self.db = db
+    self.types = db.schema.getTypes() if types is None else types
+    self.relations = db.relationKeys() if relations is None else relations
+    self.embedding = {}
+    for k,typeName in enumerate(self.types):
+      self.embedding[typeName] = TypeEmbedding(db.dim(typeName),width,depth,seed+k)
+    self.edb = matrixdb.MatrixDB(initSchema=(dbschema.UntypedSchema() if db.isTypeless() else dbschema.TypedSchema()))
+    self._buildSchema()
+    for (functor,arity) in self.relations:
+      self.edb.matEncoding[(functor,arity)] = self.embedRelation(functor,arity)
+      if (functor,arity) in db.paramSet:
+        self.edb.markAsParameter(functor,arity)
+
+  def _buildSchema(self):
+    if not self.db.isTypeless():
+      for (functor,arity) in self.relations:
+        self.edb.schema.declarePredicateTypes(functor,[self.db.schema.getArgType(functor,arity,i) for i in range(arity)])
+    for typeName in self.db.schema.getTypes():
+      if typeName not in self.edb.schema.getTypes():
+        self.edb.schema.insertType(typeName)
+      if typeName in self.embedding:
+        symbols = [BUCKET_NAME % j for j in range(self.embedding[typeName].width)]
+      else:
+        symbols = [self.db.schema.getSymbol(typeName,i) for i in range(NUM_RESERVED_IDS,self.db.dim(typeName))]
+      for i,s in enumerate(symbols):
+        k = self.edb.schema.getId(typeName,s)
+        assert k==i+NUM_RESERVED_IDS, 'cannot build embedded schema for type %s' % typeName
+
+  def embedRelation(self,functor,arity):
+    """The embedded matrix for a relation, H1^T M H for a binary
+    relation and vH for a unary one, where types that are not
+    compressed are left alone."""
+    m = self.db.relationMatrix(functor,arity)
+    types = [self.db.schema.getArgType(functor,arity,i) for i in range(arity)]
+    if types[-1] in self.embedding:
+      m = self.embedding[types[-1]].embed(m)
+    if arity==2 and types[0] in self.embedding:
+      m = self.embedding[types[0]].embedRows(m)
+    return mutil.asCSR(m,'embedRelation')
+
+  def embed(self,X,typeName=None):
+    """Embed the rows of X, a matrix over the ids of a type in the
+    original database."""
+    typeName = self.db._fillDefault(typeName)
+    if typeName not in self.embedding: return X
+    return self.embedding[typeName].embed(X)
+
+  def decode(self,W,typeName=None,minScore=0.0):
+    """Map the rows of W, a matrix over the ids of a type in the
+    embedded database, back to estimated scores for entities of the
+    original database."""
+    typeName = self.db._fillDefault(typeName)
+    if typeName not in self.embedding: return W
+    return self.embedding[typeName].decode(W,minScore)
+
+  def program(self,rules,normalize='none'):
+    """A Program that runs the rules on the embedded database.  By
+    default its outputs are not normalized, since the result of
+    decoding is an estimate of the unnormalized scores."""
+    prog = program.Program(db=self.edb,rules=rules)
+    prog.normalize = normalize
+    return prog
+
+  def eval(self,prog,mode,inputs):
+    """Evaluate a program made by self.program on inputs that use the
+    original ids, and decode the output."""
+    fun = prog.getFunction(mode)
+    inputTypes = fun.inputTypes or [None]*len(inputs)
+    result = prog.eval(mode,[self.embed(X,t) for X,t in zip(inputs,inputTypes)])
+    return self.decode(result,fun.outputType)
+
+  def evalSymbols(self,prog,mode,symbols,typeName=None):
+    return self.eval(prog,mode,[self.db.onehot(s,typeName) for s in symbols])
+
+  def bytes(self):
+    """Memory used by the embedded relations."""
+    return sum(mutil.matrixBytes(m) for m in list(self.edb.matEncoding.values()))
+
+#
+# measuring the accuracy/memory trade-off
+#
+
+def compareAnswers(exact,approx):
+  """Return (#true positives, #answers in approx, #answers in exact)
+  where an answer is a non-zero cell."""
+  exactKeys = mutil.cellKeys(mutil.asCSR(exact,'compareAnswers'))
+  approxKeys = mutil.cellKeys(mutil.asCSR(approx,'compareAnswers'))
+  return len(NP.intersect1d(exactKeys,approxKeys)),len(approxKeys),len(exactKeys)
+
+def tradeoff(db,rules,dset,widths,depth=None,seed=None,maxDepth=None):
+  """For each width, compress all types of the database, answer the
+  queries in a Dataset on the compressed database and compare to the
+  exact, unnormalized, answers.  Returns a list of dictionaries with
+  the width, the bytes used by the relations, and the precision and
+  recall of the decoded answers.  maxDepth, if given, bounds the
+  depth of recursion in the programs."""
+  exactProg = program.Program(db=db,rules=rules)
+  exactProg.normalize = 'none'
+  if maxDepth is not None: exactProg.maxDepth = maxDepth
+  exact = dict((mode,exactProg.eval(mode,[dset.getX(mode)])) for mode in dset.modesToLearn())
+  uncompressedBytes = sum(mutil.matrixBytes(db.relationMatrix(f,a)) for (f,a) in db.relationKeys())
+  results = []
+  for width in widths:
+    cdb = CountMinDB(db,width=width,depth=depth,seed=seed)
+    prog = cdb.program(rules)
+    if maxDepth is not None: prog.maxDepth = maxDepth
+    tp = numApprox = numExact = 0
+    for mode in dset.modesToLearn():
+      counts = compareAnswers(exact[mode],cdb.eval(prog,mode,[dset.getX(mode)]))
+      tp,numApprox,numExact = tp+counts[0],numApprox+counts[1],numExact+counts[2]
+    results.append({'width':width,
+                    'bytes':cdb.bytes(),
+                    'compression':float(uncompressedBytes)/max(cdb.bytes(),1),
+                    'precision':float(tp)/numApprox if numApprox else 1.0,
+                    'recall':float(tp)/numExact if numExact else 1.0})
+  return results
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.countmin --db dbspec --prog progspec --queries datasetspec [--proppr] [--widths w1,w2,...] [--depth d]')
+    print('  report memory and the precision/recall of answers to the queries on a count-min compressed database')
+  argspec = ["db=","prog=","queries=","proppr","widths=","depth="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if '--db' not in optdict or '--prog' not in optdict or '--queries' not in optdict:
+    usage()
+    sys.exit(-1)
+  db = comline.parseDBSpec(optdict['--db'])
+  prog = comline.parseProgSpec(optdict['--prog'],db,proppr=('--proppr' in optdict))
+  dset = comline.parseDatasetSpec(optdict['--queries'],db)
+  widths = [int(w) for w in optdict.get('--widths','100,1000,10000').split(',')]
+  depth = int(optdict['--depth']) if '--depth' in optdict else None
+  for r in tradeoff(db,prog.rules,dset,widths,depth):
+    print('width %(width)d: %(bytes)d bytes (%(compression).1fx smaller) precision %(precision).3f recall %(recall).3f' % r)
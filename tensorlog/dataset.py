@@ -1,8 +1,12 @@
 # (C) William W. Cohen and Carnegie Mellon University, 2016
 
 import sys
+import io
 import re
 import math
+import itertools
+import multiprocessing
+import multiprocessing.pool
 import os.path
 import collections
 import scipy.sparse as SS
@@ -10,6 +14,9 @@ import scipy.io as SIO
 import numpy as NP
 import numpy.random as NR
 import logging
+import queue
+import threading
+import time
 
 from tensorlog import config
 from tensorlog import mutil
@@ -19,6 +26,10 @@ from tensorlog import util
 
 conf = config.Config()
 conf.normalize_outputs = True;  conf.help.normalize_outputs =  "In .exam files, l1-normalize the weights of valid outputs"
+conf.parse_chunk_lines = 100000;  conf.help.parse_chunk_lines = "Number of lines of an example file parsed together"
+conf.parse_chunk_bytes = 32*1024*1024;  conf.help.parse_chunk_bytes = "Example files bigger than this are split into chunks of about this size, which are parsed in parallel"
+conf.parse_processes = 0;  conf.help.parse_processes = "Number of processes used to parse a big example file, or 0 for one per CPU"
+conf.prefetch_minibatches = 0;  conf.help.prefetch_minibatches = "If positive, build up to this many minibatches ahead on a background thread"
 
 #
 # dealing with labeled training data
@@ -67,14 +78,37 @@ class Dataset(object):
             self.xDict[mode] = mutil.shuffleRows(self.xDict[mode],shuffledRowNums)
             self.yDict[mode] = mutil.shuffleRows(self.yDict[mode],shuffledRowNums)
 
-    def minibatchIterator(self,batchSize=100,shuffleFirst=True):
+    def minibatchIterator(self,batchSize=100,shuffleFirst=True,prefetch=None,transform=None):
         """Iterate over triples (mode,X',Y') where X' and Y' are sets of
         batchSize rows from the full data for mode, randomly selected
-        (without replacement) from the dataset."""
-        # randomize the order of the examples
-        if shuffleFirst: self.shuffle()
-        # then sample an ordering of the modes
+        (without replacement) from the dataset.  If transform is
+        given, the iterator yields transform(mode,X',Y') instead.
+
+        If prefetch>0, minibatches are built (and transformed) on a
+        background thread, which stays up to prefetch minibatches
+        ahead of the consumer.  The default for prefetch is
+        conf.prefetch_minibatches.  The MinibatchPrefetcher used is
+        saved as self.prefetcher, so its stall statistics can be
+        inspected.
+        """
+        batches = self._minibatches(batchSize,shuffleFirst)
+        if prefetch is None: prefetch = conf.prefetch_minibatches
+        if prefetch>0:
+            self.prefetcher = MinibatchPrefetcher(batches,depth=prefetch,transform=transform)
+            return iter(self.prefetcher)
+        elif transform is not None:
+            return (transform(mode,bX,bY) for (mode,bX,bY) in batches)
+        else:
+            return batches
+
+    def _minibatches(self,batchSize,shuffleFirst):
+        # randomize the order of the examples, with a permutation of
+        # the row numbers rather than a shuffled copy of the data
         modeList =  self.modesToLearn()
+        rowOrder = {}
+        for mode in modeList:
+            rowOrder[mode] = NR.permutation(mutil.numRows(self.getX(mode))) if shuffleFirst else None
+        # then sample an ordering of the modes
         modeSampleDict = {}
         for modeIndex,mode in enumerate(modeList):
             numBatches = int(math.ceil( mutil.numRows(self.getX(mode)) / float(batchSize) ))
@@ -86,8 +120,13 @@ class Dataset(object):
         for modeIndex in modeSamples:
             mode = modeList[modeIndex]
             lo = currentOffset[modeIndex]
-            bX = mutil.selectRows(self.getX(mode),lo,lo+batchSize)
-            bY = mutil.selectRows(self.getY(mode),lo,lo+batchSize)
+            if rowOrder[mode] is None:
+                bX = mutil.selectRows(self.getX(mode),lo,lo+batchSize)
+                bY = mutil.selectRows(self.getY(mode),lo,lo+batchSize)
+            else:
+                rows = rowOrder[mode][lo:lo+batchSize]
+                bX = mutil.gatherRows(self.getX(mode),rows)
+                bY = mutil.gatherRows(self.getY(mode),rows)
             currentOffset[modeIndex] += batchSize
             yield mode,bX,bY
 
@@ -121,7 +160,7 @@ class Dataset(object):
             for stringKey,mat in list(d.items()):
                 del d[stringKey]
                 if not stringKey.startswith('__'):
-                   d[declare.asMode(stringKey)] = SS.csr_matrix(mat)
+                   d[declare.asMode(stringKey)] = mutil.asCSR(SS.csr_matrix(mat),'Dataset.deserialize')
         dset = Dataset(xDict,yDict)
         logging.info('deserialized dataset has %d modes and %d non-zeros' % (len(dset.modesToLearn()), dset.size()))
         return dset
@@ -170,11 +209,11 @@ class Dataset(object):
         functorToLearn = declare.asMode(functorToLearn)
         xrows = []
         yrows = []
-        m = db.matEncoding[(functorInDB,2)].tocoo()
+        m = db.matrix(declare.asMode("%s(i,o)" % functorInDB)).tocoo()
         n = db.dim()
         for i in range(len(m.data)):
             x = m.row[i]
-            xrows.append(SS.csr_matrix( ([1.0],([0],[x])), shape=(1,n) ))
+            xrows.append(mutil.csr([1.0],[x],[0,1],(1,n),'loadMatrix'))
             rx = m.getrow(x)
             yrows.append(rx * (1.0/rx.sum()))
         return Dataset({functorToLearn:mutil.stack(xrows)},{functorToLearn:mutil.stack(yrows)})
@@ -182,30 +221,10 @@ class Dataset(object):
     @staticmethod
     def _parseLine(line,proppr=True):
         #returns mode, x, positive y's where x and ys are symbols
-        if not line.strip() or line[0]=='#':
+        functor,x,ys = _parseExampleLine(line,proppr)
+        if functor is None:
             return None,None,None
-        parts = line.strip().split("\t")
-        if not proppr:
-            assert len(parts)>=2, 'bad line: %r parts %r' % (line,parts)
-            return declare.asMode(parts[0]+"/io"),parts[1],parts[2:]
-        else:
-            regex = re.compile('(\w+)\((\w+),(\w+)\)')
-            mx = regex.search(parts[0])
-            if not mx:
-                return None,None,None
-            else:
-                mode = declare.asMode(mx.group(1)+"/io")
-                x = mx.group(2)
-                pos = []
-                for ans in parts[1:]:
-                    label = ans[0]
-                    my = regex.search(ans[1:])
-                    assert my,'problem at line '+line
-                    assert my.group(1)==mode.functor,'mismatched modes %s %s at line %s' % (my.group(1),mode,line)
-                    assert my.group(2)==x,'mismatched x\'s at line '+line
-                    if label=='+':
-                        pos.append(my.group(3))
-                return mode,x,pos
+        return _exampleMode(functor),x,ys
 
     @staticmethod
     def loadProPPRExamples(db,fileName):
@@ -214,7 +233,7 @@ class Dataset(object):
         return Dataset.loadExamples(db,fileName,proppr=True)
 
     @staticmethod
-    def loadExamples(db,fileName,proppr=False):
+    def loadExamples(db,fileName,proppr=False,processes=None):
         """Convert foo.exam file, where each line is of the form
 
           functor <TAB> x <TAB> y1 ... yk
@@ -222,43 +241,36 @@ class Dataset(object):
         to two dictionaries of modename->matrix pairs, one for the Xs,
         one for the Ys.
 
+        Lines are parsed in chunks, and the symbols in each chunk are
+        converted to ids together.  A file bigger than
+        conf.parse_chunk_bytes is split into chunks that are parsed by
+        a pool of processes.
         """
         logging.info('loading examples from '+ str(fileName))
-
-        # map from relation to lists that buffer data,row
-        # index,colindex information for each of the X,Y matrices
-        xDatabuf = collections.defaultdict(list)
-        xRowbuf = collections.defaultdict(list)
-        xColbuf = collections.defaultdict(list)
-        yDatabuf = collections.defaultdict(list)
-        yRowbuf = collections.defaultdict(list)
-        yColbuf = collections.defaultdict(list)
+        chunks = _parseExampleChunks(fileName,proppr,processes)
+        # merge the chunks, keeping the modes in the order they first
+        # appear in the file
+        parsed = collections.OrderedDict()
+        for chunk in chunks:
+          for functor,part in list(chunk.items()):
+            parsed.setdefault(functor,[]).append(part)
         xsResult = {}
         ysResult = {}
-        def getId(typeName,symbol):
-          s = symbol if db.schema.hasId(typeName,symbol) else matrixdb.OOV_ENTITY_NAME
-          return db.schema.getId(typeName,s)
-        for line in util.linesIn(fileName):
-          pred,x,ys = Dataset._parseLine(line,proppr=proppr)
-          if pred:
-            xType = db.schema.getDomain(pred.getFunctor(),2)
-            yType = db.schema.getRange(pred.getFunctor(),2)
-            row_index = len(xDatabuf[pred])
-            xDatabuf[pred].append(1.0)
-            xRowbuf[pred].append(row_index)
-            xColbuf[pred].append(getId(xType,x))
-            for y in ys:
-              yDatabuf[pred].append( 1.0/len(ys) if conf.normalize_outputs else 1.0)
-              yRowbuf[pred].append(row_index)
-              yColbuf[pred].append(getId(yType,y))
-        for pred in list(xDatabuf.keys()):
+        for functor,parts in list(parsed.items()):
+          pred = _exampleMode(functor)
           xType = db.schema.getDomain(pred.getFunctor(),2)
           yType = db.schema.getRange(pred.getFunctor(),2)
-          nrows = len(xDatabuf[pred])
-          coo_x = SS.coo_matrix((xDatabuf[pred],(xRowbuf[pred],xColbuf[pred])), shape=(nrows,db.dim(xType)))
-          xsResult[pred] = SS.csr_matrix(coo_x,dtype='float32')
-          coo_y = SS.coo_matrix((yDatabuf[pred],(yRowbuf[pred],yColbuf[pred])), shape=(nrows,db.dim(yType)))
-          ysResult[pred] = SS.csr_matrix(coo_y,dtype='float32')
+          xCols = NP.concatenate([db.schema.lookupIds(xType,p.xSymbols,matrixdb.OOV_ENTITY_NAME)[p.xIndex] for p in parts])
+          yCols = NP.concatenate([db.schema.lookupIds(yType,p.ySymbols,matrixdb.OOV_ENTITY_NAME)[p.yIndex] for p in parts])
+          offsets = NP.cumsum([0] + [p.numRows for p in parts])
+          yRows = NP.concatenate([p.yRows + offset for p,offset in zip(parts,offsets)])
+          nrows = int(offsets[-1])
+          if conf.normalize_outputs:
+            yData = 1.0/NP.bincount(yRows,minlength=nrows)[yRows]
+          else:
+            yData = NP.ones(len(yRows))
+          xsResult[pred] = mutil.csrFromCOO(NP.ones(nrows),NP.arange(nrows),xCols,(nrows,db.dim(xType)),'loadExamples')
+          ysResult[pred] = mutil.csrFromCOO(yData,yRows,yCols,(nrows,db.dim(yType)),'loadExamples')
         dset = Dataset(xsResult,ysResult)
         logging.info('loaded dataset has %d modes and %d non-zeros' % (len(dset.modesToLearn()), dset.size()))
         logging.info('in loaded dataset, example normalization (so sum_{y} score[pred(x,y)] == 1) is %r' % conf.normalize_outputs)
@@ -286,6 +298,374 @@ class Dataset(object):
                     fp.write('\t+%s(%s,%s)' % (theoryPred,x,y))
                 fp.write('\n')
 
+#
+# parsing example files
+#
+
+_EXAMPLE_REGEX = re.compile(r'(\w+)\((\w+),(\w+)\)')
+_EXAMPLE_MODES = {}
+
+def _exampleMode(functor):
+    # declare.asMode runs a parser, so modes are only built once
+    if functor not in _EXAMPLE_MODES:
+        _EXAMPLE_MODES[functor] = declare.asMode(functor+"/io")
+    return _EXAMPLE_MODES[functor]
+
+def _parseExampleLine(line,proppr):
+    #returns functor, x, positive y's where x and ys are symbols
+    if not line.strip() or line[0]=='#':
+        return None,None,None
+    parts = line.strip().split("\t")
+    if not proppr:
+        assert len(parts)>=2, 'bad line: %r parts %r' % (line,parts)
+        return parts[0],parts[1],parts[2:]
+    mx = _EXAMPLE_REGEX.search(parts[0])
+    if not mx:
+        return None,None,None
+    functor,x = mx.group(1),mx.group(2)
+    pos = []
+    for ans in parts[1:]:
+        label = ans[0]
+        my = _EXAMPLE_REGEX.search(ans[1:])
+        assert my,'problem at line '+line
+        assert my.group(1)==functor,'mismatched modes %s %s at line %s' % (my.group(1),_exampleMode(functor),line)
+        assert my.group(2)==x,'mismatched x\'s at line '+line
+        if label=='+':
+            pos.append(my.group(3))
+    return functor,x,pos
+
+class _ParsedExamples(object):
+    """The examples for one functor in a chunk of lines.  Symbols are
+    stored once each, in xSymbols and ySymbols, and xIndex and yIndex
+    give the position of each example's symbols in those lists - so
+    the symbols of a chunk can be converted to ids together.  yRows
+    are the rows, within the chunk, of the y's."""
+
+    def __init__(self):
+        self.numRows = 0
+        self.xSymbols = {}
+        self.ySymbols = {}
+        self.xIndex = []
+        self.yIndex = []
+        self.yRows = []
+
+    def add(self,x,ys):
+        self.xIndex.append(self.xSymbols.setdefault(x,len(self.xSymbols)))
+        for y in ys:
+            self.yIndex.append(self.ySymbols.setdefault(y,len(self.ySymbols)))
+            self.yRows.append(self.numRows)
+        self.numRows += 1
+
+    def finish(self):
+        # convert to lists and arrays, which are much faster to send
+        # between processes
+        self.xSymbols = list(self.xSymbols)
+        self.ySymbols = list(self.ySymbols)
+        self.xIndex = NP.array(self.xIndex,dtype=NP.int64)
+        self.yIndex = NP.array(self.yIndex,dtype=NP.int64)
+        self.yRows = NP.array(self.yRows,dtype=NP.int64)
+        return self
+
+def _parseExampleLines(lines,proppr):
+    """Parse some lines of an examples file, and return an ordered
+    dictionary mapping each functor to a _ParsedExamples."""
+    result = collections.OrderedDict()
+    for line in lines:
+        functor,x,ys = _parseExampleLine(line,proppr)
+        if functor is not None:
+            if functor not in result: result[functor] = _ParsedExamples()
+            result[functor].add(x,ys)
+    for parsed in list(result.values()):
+        parsed.finish()
+    return result
+
+def _parseExampleRange(args):
+    # parse the lines of a file between two byte offsets - run in a
+    # worker process
+    (fileName,lo,hi,proppr) = args
+    with open(fileName,'rb') as fp:
+        fp.seek(lo)
+        text = fp.read(hi-lo).decode('utf-8')
+    return _parseExampleLines(io.StringIO(text,newline=None),proppr)
+
+def _lineBoundaries(fileName,numChunks):
+    """Byte offsets that split a file into about numChunks pieces,
+    each ending with a complete line."""
+    size = os.path.getsize(fileName)
+    result = [0]
+    with open(fileName,'rb') as fp:
+        for k in range(1,numChunks):
+            fp.seek(max(result[-1],size*k//numChunks))
+            fp.readline()
+            if fp.tell()>=size: break
+            result.append(fp.tell())
+    result.append(size)
+    return result
+
+def _parseExampleChunks(fileLike,proppr,processes=None):
+    """Parse an examples file, or an iterable of lines, in chunks, and
+    yield the result of _parseExampleLines for each chunk, in order."""
+    if isinstance(fileLike,str) and os.path.getsize(fileLike)>conf.parse_chunk_bytes:
+        bounds = _lineBoundaries(fileLike,int(math.ceil(os.path.getsize(fileLike)/float(conf.parse_chunk_bytes))))
+        ranges = [(fileLike,lo,hi,proppr) for lo,hi in zip(bounds[:-1],bounds[1:])]
+        processes = processes or conf.parse_processes or multiprocessing.cpu_count()
+        if processes>1 and len(ranges)>1:
+            logging.info('parsing %d chunks of %s with %d processes' % (len(ranges),fileLike,processes))
+            pool = multiprocessing.pool.Pool(min(processes,len(ranges)))
+            try:
+                for chunk in pool.imap(_parseExampleRange,ranges):
+                    yield chunk
+            finally:
+                pool.terminate()
+            return
+    lines = util.linesIn(fileLike)
+    while True:
+        chunk = list(itertools.islice(lines,conf.parse_chunk_lines))
+        if not chunk: break
+        yield _parseExampleLines(chunk,proppr)
+
+#
+# building minibatches in the background
+#
+
+class MinibatchPrefetcher(object):
+    """Iterates over the items produced by a minibatch iterator, which
+    is run on a background thread that stays up to depth items ahead
+    of the consumer.  If transform is given, transform(mode,X,Y) is
+    also computed on the background thread, and yielded instead of
+    the (mode,X,Y) triple.
+
+    The stats dictionary records the number of minibatches, the time
+    the producer spent building them, the time the producer was
+    blocked because the queue was full (producerStall), and the time
+    the consumer was blocked because it was empty (consumerStall).
+    A large consumerStall means depth or the producer should be
+    increased; a large producerStall means the consumer is the
+    bottleneck.
+    """
+
+    _DONE = object()
+
+    def __init__(self,batches,depth=2,transform=None):
+        assert depth>0, 'prefetch depth must be positive'
+        self.batches = batches
+        self.transform = transform
+        self.stats = collections.Counter()
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._produce,name='MinibatchPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = self._queue.get()
+                self.stats['consumerStall'] += time.time() - start
+                if item is MinibatchPrefetcher._DONE:
+                    break
+                elif isinstance(item,_ProducerError):
+                    raise item.exception
+                yield item
+        finally:
+            self.close()
+        logging.info('prefetched %d minibatches: build time %.3f producer stall %.3f consumer stall %.3f' % (
+            self.stats['minibatches'],self.stats['buildTime'],self.stats['producerStall'],self.stats['consumerStall']))
+
+    def close(self):
+        """Stop the background thread, e.g., if the consumer stops early."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _produce(self):
+        try:
+            start = time.time()
+            for (mode,bX,bY) in self.batches:
+                item = (mode,bX,bY) if self.transform is None else self.transform(mode,bX,bY)
+                self.stats['buildTime'] += time.time() - start
+                self.stats['minibatches'] += 1
+                if not self._put(item): return
+                start = time.time()
+            self._put(MinibatchPrefetcher._DONE)
+        except Exception as ex:
+            self._put(_ProducerError(ex))
+
+    def _put(self,item):
+        """Put an item on the queue, returning False if the consumer has
+        gone away."""
+        start = time.time()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item,timeout=0.1)
+                self.stats['producerStall'] += time.time() - start
+                return True
+            except queue.Full:
+                pass
+        return False
+
+class _ProducerError(object):
+    """Wraps an exception raised on the producer thread."""
+    def __init__(self,exception):
+        self.exception = exception
+
+#
+# datasets that live on disk
+#
+
+class MemmapDataset(Dataset):
+    """A Dataset whose X and Y matrices are stored on disk, in a
+    directory written by a MemmapDatasetWriter, and accessed through
+    memory maps.  Minibatches are sliced directly from the maps, so
+    only the rows in the current minibatch need to be in memory.
+    The stored data is never modified.
+    """
+
+    def __init__(self,dir):
+        self.dir = dir
+        xDict = {}
+        yDict = {}
+        for line in util.linesIn(os.path.join(dir,MemmapDatasetWriter.INDEX_FILE)):
+            parts = line.strip().split("\t")
+            mode = declare.asMode(parts[0])
+            k = int(parts[1])
+            (numRows,xCols,xNnz,yCols,yNnz) = [int(p) for p in parts[2:7]]
+            indexType = NP.dtype(parts[7])
+            xDict[mode] = self._openMatrix('x%d' % k,numRows,xCols,xNnz,indexType)
+            yDict[mode] = self._openMatrix('y%d' % k,numRows,yCols,yNnz,indexType)
+        super(MemmapDataset,self).__init__(xDict,yDict)
+        logging.info('opened memory-mapped dataset %s with %d modes and %d non-zeros' % (dir,len(xDict),self.size()))
+
+    def _openMatrix(self,stem,numRows,numCols,nnz,indexType):
+        def mapped(suffix,dtype,n):
+            if n==0: return NP.zeros(0,dtype=dtype)
+            return NP.memmap(os.path.join(self.dir,stem+suffix),dtype=dtype,mode='r',shape=(n,))
+        return SS.csr_matrix(
+            (mapped('.data',mutil.DATA_DTYPE,nnz), mapped('.indices',indexType,nnz), mapped('.indptr',indexType,numRows+1)),
+            shape=(numRows,numCols), copy=False)
+
+    def shuffle(self):
+        assert False, 'a MemmapDataset cannot be shuffled in place: minibatchIterator shuffles with a permutation'
+
+    @staticmethod
+    def fromDataset(dset,dir):
+        """Store an in-memory dataset on disk, and return it as a MemmapDataset."""
+        writer = MemmapDatasetWriter(dir)
+        for mode in dset.modesToLearn():
+            writer.addRows(mode,dset.getX(mode),dset.getY(mode))
+        writer.close()
+        return MemmapDataset(dir)
+
+    @staticmethod
+    def fromExamples(db,fileName,dir,proppr=False,linesPerChunk=100000):
+        """Parse an examples file, as in Dataset.loadExamples, and store
+        it on disk, reading only linesPerChunk lines at a time.  Returns
+        a MemmapDataset. """
+        writer = MemmapDatasetWriter(dir)
+        chunk = []
+        def flush():
+            dset = Dataset.loadExamples(db,chunk,proppr=proppr)
+            for mode in dset.modesToLearn():
+                writer.addRows(mode,dset.getX(mode),dset.getY(mode))
+        for line in util.linesIn(fileName):
+            chunk.append(line)
+            if len(chunk)>=linesPerChunk:
+                flush()
+                chunk = []
+        if chunk: flush()
+        writer.close()
+        return MemmapDataset(dir)
+
+    @staticmethod
+    def uncacheExamples(dsetDir,db,exampleFile,proppr=True):
+        """Like Dataset.uncacheExamples, but for memory-mapped datasets."""
+        if not os.path.exists(dsetDir) or os.path.getmtime(exampleFile)>os.path.getmtime(dsetDir):
+            logging.info('storing examples in %s to %s' % (exampleFile,dsetDir))
+            MemmapDataset.fromExamples(db,exampleFile,dsetDir,proppr=proppr)
+            os.utime(dsetDir,None)
+        return MemmapDataset(dsetDir)
+
+class MemmapDatasetWriter(object):
+    """Writes the X,Y matrices of a dataset to a directory that can be
+    opened as a MemmapDataset.  Rows are appended to the files for a
+    mode with addRows, so the full dataset never needs to be in
+    memory.  The files are raw binary arrays: for the k-th mode,
+    xk.data, xk.indices, and xk.indptr hold the CSR arrays of X,
+    and likewise for Y.
+    """
+
+    INDEX_FILE = 'index.txt'
+
+    def __init__(self,dir):
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self.dir = dir
+        self.modeList = []
+        # per-mode dicts of shapes and open files
+        self.numRows = {}
+        self.numCols = {}
+        self.nnz = {}
+        self.files = {}
+
+    def addRows(self,mode,X,Y):
+        """Append the rows of X and Y, which must have the same number of
+        rows, to the stored examples for mode."""
+        assert mutil.numRows(X)==mutil.numRows(Y), 'X and Y have different numbers of rows for %s' % str(mode)
+        if mode not in self.numRows:
+            k = len(self.modeList)
+            self.modeList.append(mode)
+            self.numRows[mode] = 0
+            self.numCols[mode] = {'x':mutil.numCols(X),'y':mutil.numCols(Y)}
+            self.nnz[mode] = {'x':0,'y':0}
+            self.files[mode] = {}
+            for xy in 'xy':
+                for suffix in ['.data','.indices','.indptr']:
+                    self.files[mode][xy+suffix] = open(os.path.join(self.dir,'%s%d%s' % (xy,k,suffix)),'wb')
+                NP.zeros(1,dtype=mutil.LONG_INDEX_DTYPE).tofile(self.files[mode][xy+'.indptr'])
+        for xy,m in (('x',X),('y',Y)):
+            assert mutil.numCols(m)==self.numCols[mode][xy], 'inconsistent number of columns for %s' % str(mode)
+            m = mutil.asCSR(m,'MemmapDatasetWriter')
+            fps = self.files[mode]
+            NP.asarray(m.data,dtype=mutil.DATA_DTYPE).tofile(fps[xy+'.data'])
+            NP.asarray(m.indices,dtype=mutil.LONG_INDEX_DTYPE).tofile(fps[xy+'.indices'])
+            (NP.asarray(m.indptr[1:],dtype=mutil.LONG_INDEX_DTYPE) + self.nnz[mode][xy]).tofile(fps[xy+'.indptr'])
+            self.nnz[mode][xy] += m.nnz
+        self.numRows[mode] += mutil.numRows(X)
+
+    def close(self):
+        """Finish writing.  Index arrays are stored as int32 if every
+        matrix allows it, which lets scipy use the memory maps
+        without converting them."""
+        maxValue = 0
+        for mode in self.modeList:
+            for fp in self.files[mode].values(): fp.close()
+            maxValue = max([maxValue,self.numRows[mode]] + list(self.numCols[mode].values()) + list(self.nnz[mode].values()))
+        indexType = mutil.indexDtype(maxValue)
+        with open(os.path.join(self.dir,MemmapDatasetWriter.INDEX_FILE),'w') as fp:
+            for k,mode in enumerate(self.modeList):
+                if indexType!=mutil.LONG_INDEX_DTYPE:
+                    for xy in 'xy':
+                        for suffix in ['.indices','.indptr']:
+                            self._narrow(os.path.join(self.dir,'%s%d%s' % (xy,k,suffix)),indexType)
+                fp.write('\t'.join([str(mode),str(k),str(self.numRows[mode]),
+                                    str(self.numCols[mode]['x']),str(self.nnz[mode]['x']),
+                                    str(self.numCols[mode]['y']),str(self.nnz[mode]['y']),
+                                    indexType.name]) + '\n')
+
+    @staticmethod
+    def _narrow(fileName,indexType,blockSize=1<<22):
+        """Convert a file of int64's to indexType, a block at a time."""
+        tmpName = fileName + '.tmp'
+        with open(fileName,'rb') as src, open(tmpName,'wb') as dst:
+            while True:
+                block = NP.fromfile(src,dtype=mutil.LONG_INDEX_DTYPE,count=blockSize)
+                if not len(block): break
+                block.astype(indexType).tofile(dst)
+        os.replace(tmpName,fileName)
+
 if __name__ == "__main__":
     usage = 'usage: python -m dataset.py --serialize foo.cfacts|foo.db bar.exam|bar.examples glob.dset'
     if sys.argv[1]=='--serialize':
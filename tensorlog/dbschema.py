@@ -5,6 +5,8 @@
 import os.path
 import logging
 
+import numpy as NP
+
 from tensorlog import util
 
 THING = '__THING__' # name of default type
@@ -94,6 +96,35 @@ class AbstractSchema(object):
     assert False, 'abstract method called'
 
 
+  def insertSymbols(self,typeName,symbols):
+    """Add a list of new symbols to a type, with consecutive ids, and
+    return the id of the first one.
+    """
+    return self._stab[self._stabKey(typeName)].insertAll(symbols)
+
+  def lookupIds(self,typeName,symbols,default):
+    """Return an array with the ids of a list of symbols, where symbols
+    not in the type get the id of the symbol default.  Only default is
+    added to the type if necessary.
+    """
+    return self._stab[self._stabKey(typeName)].lookupAll(symbols,default)
+
+  def getIds(self,typeName,symbols,insert=True):
+    """Return an array with the ids of a list of symbols.  If insert is
+    True symbols not in the type are added to it, and otherwise they
+    get the id 0, which no symbol has.
+    """
+    return self._stab[self._stabKey(typeName)].getIds(symbols,insert)
+
+  def permuteIds(self,typeName,newToOld):
+    """Renumber the symbols of a type, so that the symbol with id
+    newToOld[i] gets id i.
+    """
+    self._stab[self._stabKey(typeName)].permute(newToOld)
+
+  def _stabKey(self,typeName):
+    return typeName
+
   def _safeSymbTab(self):
     """ Symbol table with reserved words 'i', 'o', and 'any'
     """
@@ -203,6 +234,9 @@ class UntypedSchema(AbstractSchema):
     """
     return self._stab[THING].getSymbol(symbolId)
 
+  def _stabKey(self,typeName):
+    return THING
+
 
 class TypedSchema(AbstractSchema):
 
@@ -368,6 +402,18 @@ class SymbolTable(object):
       self._symbolList += [symbol]
       self._empty = False
 
+  def insertAll(self,symbols):
+    """Insert a list of symbols that are not already in the table,
+    giving them consecutive ids, and return the first id.  This is
+    much faster than inserting them one by one."""
+    first = self._nextId + 1
+    self._symbolList.extend(symbols)
+    self._idDict.update(zip(symbols,range(first,first+len(symbols))))
+    self._nextId += len(symbols)
+    assert len(self._idDict)==self._nextId, 'some symbols were already in the table'
+    if len(symbols): self._empty = False
+    return first
+
   def getSymbolList(self):
     """Get an array of all defined symbols."""
     return self._symbolList[1:]
@@ -384,5 +430,30 @@ class SymbolTable(object):
     self.insert(symbol)
     return self._idDict[symbol]
 
+  def lookupAll(self,symbols,default):
+    """Get an array of the ids of a list of symbols, where symbols not
+    in the table get the id of default."""
+    k = self.getId(default)
+    get = self._idDict.get
+    return NP.fromiter((get(s,k) for s in symbols),dtype=NP.int64,count=len(symbols))
+
+  def getIds(self,symbols,insert=True):
+    """Get an array of the ids of a list of symbols.  If insert is True,
+    the symbols not in the table are added, in the order they first
+    appear, and otherwise they get the id 0."""
+    if insert:
+      missing = [s for s in dict.fromkeys(symbols) if s not in self._idDict]
+      if missing: self.insertAll(missing)
+    get = self._idDict.get
+    return NP.fromiter((get(s,0) for s in symbols),dtype=NP.int64,count=len(symbols))
+
   def getMaxId(self):
     return self._nextId
+
+  def permute(self,newToOld):
+    """Renumber the symbols, so the symbol with id newToOld[i] gets id
+    i.  newToOld must be a permutation of 0...N that leaves 0 fixed."""
+    assert len(newToOld)==self._nextId+1 and newToOld[0]==0, 'not a permutation of the symbol ids'
+    self._symbolList = [None] + [self._symbolList[i] for i in newToOld[1:]]
+    self._idDict = dict((s,i) for i,s in enumerate(self._symbolList) if i>0)
+    assert len(self._idDict)==self._nextId, 'not a permutation of the symbol ids'
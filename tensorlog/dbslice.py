@@ -0,0 +1,129 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# find the part of a database that a program actually reads for a set
+# of query modes, and export just that part, with the ids of each type
+# renumbered compactly, so that a server answering those queries can
+# load a much smaller database.  Usage:
+#
+#  python -m tensorlog.dbslice --db foo.cfacts|foo.db --prog foo.ppr [--proppr] --modes 'p/io,q/io' --out slice.db
+#
+# The sliced database is serialized with one set of files per
+# relation, so it can also be loaded lazily with
+# MatrixDB.deserialize(direc,lazy=True).
+
+import getopt
+import sys
+
+import numpy as NP
+
+from tensorlog import comline
+from tensorlog import dbschema
+from tensorlog import declare
+from tensorlog import matrixdb
+from tensorlog import mutil
+from tensorlog import typeinfer
+
+# ids of the symbols that are in every type, which keep their ids
+NUM_RESERVED_IDS = 3
+
+def relationsNeeded(prog,modes):
+  """Return the sorted list of (functor,arity) pairs for the database
+  relations read when the program answers queries in any of the
+  given modes."""
+  result = set()
+  for mode in modes:
+    result.update(prog.relationsUsed(declare.asMode(mode)))
+  return sorted(result)
+
+def constantsNeeded(prog,modes):
+  """Return the sorted list of (constant,typeName) pairs for the
+  constants that the rules used by the given modes look up in the
+  database, where typeName is None for the default type."""
+  result = set()
+  for mode in modes:
+    result.update(prog.getFunction(declare.asMode(mode)).constantsUsed())
+  return sorted(result,key=str)
+
+def sliceDB(db,relations,constants=()):
+  """Return a new database containing only the given relations, where
+  the ids of each type are renumbered to cover only the entities
+  that appear in those relations, plus the given (constant,typeName)
+  pairs.  Entities keep their relative order, and the reserved
+  symbols keep their ids, in every type.  Parameters and growable
+  relations stay that way in the slice."""
+  relations = sorted(relations)
+  for key in relations:
+    assert db.inDB(*key), 'relation %s/%d is not in the database' % key
+  if db.isTypeless():
+    sliced = matrixdb.MatrixDB()
+  else:
+    sliced = matrixdb.MatrixDB(initSchema=dbschema.TypedSchema())
+  argTypes = dict((key,[db.schema.getArgType(key[0],key[1],i) for i in range(key[1])]) for key in relations)
+  if not db.isTypeless():
+    for (functor,arity) in relations:
+      sliced.schema.declarePredicateTypes(functor,argTypes[(functor,arity)])
+  # collect the old ids used in each type
+  used = {}
+  for key in relations:
+    for typeName,ids in zip(argTypes[key],typeinfer.argumentIds(db.relationMatrix(*key),key[1])):
+      used.setdefault(typeName,[]).append(ids)
+  for (const,typeName) in constants:
+    typeName = db._fillDefault(typeName)
+    if db.schema.hasId(typeName,const):
+      used.setdefault(typeName,[]).append(NP.array([db.schema.getId(typeName,const)]))
+  # map them to new ids, in the same order
+  oldToNew = {}
+  for typeName in sorted(used.keys()):
+    if typeName not in sliced.schema.getTypes():
+      sliced.schema.insertType(typeName)
+    oldIds = NP.unique(NP.concatenate(used[typeName]))
+    oldIds = oldIds[oldIds>=NUM_RESERVED_IDS]
+    mapping = NP.zeros(db.dim(typeName),dtype=mutil.LONG_INDEX_DTYPE)
+    mapping[:NUM_RESERVED_IDS] = NP.arange(NUM_RESERVED_IDS)
+    for i in oldIds:
+      mapping[i] = sliced.schema.getId(typeName,db.schema.getSymbol(typeName,i))
+    oldToNew[typeName] = mapping
+  # re-index the matrices
+  for key in relations:
+    m = db.relationMatrix(*key)
+    types = argTypes[key]
+    if key[1]==1:
+      sliced.matEncoding[key] = mutil.relabel(m,colMap=oldToNew[types[0]],shape=(1,sliced.dim(types[0])))
+    else:
+      sliced.matEncoding[key] = mutil.relabel(m,rowMap=oldToNew[types[0]],colMap=oldToNew[types[1]],
+                                              shape=(sliced.dim(types[0]),sliced.dim(types[1])))
+  for (functor,arity) in db.paramList:
+    if (functor,arity) in sliced.matEncoding:
+      sliced.markAsParameter(functor,arity)
+      if db.isGrowable(functor,arity):
+        sliced.markAsGrowable(functor,arity)
+  return sliced
+
+def sliceForProgram(prog,modes):
+  """Return the slice of the program's database needed to answer
+  queries in the given modes."""
+  return sliceDB(prog.db,relationsNeeded(prog,modes),constantsNeeded(prog,modes))
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.dbslice --db dbspec --prog progspec [--proppr] --modes "p/io,q/io" --out slice.db')
+    print('  write the relations and entities of a database that are needed to answer queries in the given modes')
+  argspec = ["db=","prog=","proppr","modes=","out="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if not all(opt in optdict for opt in ['--db','--prog','--modes','--out']):
+    usage()
+    sys.exit(-1)
+  db = comline.parseDBSpec(optdict['--db'])
+  prog = comline.parseProgSpec(optdict['--prog'],db,proppr=('--proppr' in optdict))
+  modes = optdict['--modes'].split(',')
+  relations = relationsNeeded(prog,modes)
+  sliced = sliceDB(db,relations,constantsNeeded(prog,modes))
+  print('kept %d of %d relations' % (len(relations),db.numMatrices()))
+  for typeName in sorted(sliced.schema.getTypes()):
+    print('type %s: dimension %d (was %d)' % (typeName,sliced.dim(typeName),db.dim(typeName)))
+  sliced.serialize(optdict['--out'],perRelation=True)
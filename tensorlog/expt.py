@@ -159,11 +159,12 @@ if __name__=="__main__":
         '    --learner f         # where f is the name of a learner class',
         '    --learnerOpts g     # g is a string that "evals" to a python dict',
         '    --weightEpsilon eps # parameter weights multiplied by eps',
-        '    --params p1/k1,..   # comma-sep list of functor/arity pairs'
+        '    --params p1/k1,..   # comma-sep list of functor/arity pairs',
+        '    --growable p1/k1,.. # parameters whose sparsity pattern can grow'
     ]
     argSpec = ["learner=", "savedModel=", "learnerOpts=", "targetMode=",
                "savedTestPredictions=", "savedTestExamples=", "savedTrainExamples=",
-               "params=","weightEpsilon="]
+               "params=","growable=","weightEpsilon="]
     optdict,args = comline.parseCommandLine(
         sys.argv[1:],
         extraArgConsumer="expt", extraArgSpec=argSpec, extraArgUsage=usageLines
@@ -178,6 +179,10 @@ if __name__=="__main__":
             optdict['db'].markAsParameter(functor,int(arity))
     optdict['prog'].setFeatureWeights(epsilon=weightEpsilon)
     optdict['prog'].setRuleWeights(epsilon=weightEpsilon)
+    if '--growable' in optdict:
+        for spec in optdict['--growable'].split(","):
+            functor,arity = spec.split("/")
+            optdict['db'].markAsGrowable(functor,int(arity))
     learner = None
     if 'learner' in optdict:
         try:
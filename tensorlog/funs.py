@@ -97,6 +97,22 @@ class Function(object):
         """Return list of child functions, for visualization"""
         assert False, 'abstract method called'
 
+    def relationsUsed(self):
+        """Set of (functor,arity) pairs for the database relations read
+        when this function is evaluated."""
+        result = set()
+        for c in self.children():
+            result.update(c.relationsUsed())
+        return result
+
+    def constantsUsed(self):
+        """Set of (constant,typeName) pairs for the constants looked up
+        in the database when this function is evaluated."""
+        result = set()
+        for c in self.children():
+            result.update(c.constantsUsed())
+        return result
+
 class OpSeqFunction(Function):
     """A function defined by executing a sequence of operators."""
 
@@ -111,6 +127,8 @@ class OpSeqFunction(Function):
           self.inputTypes = inputTypes
         else:
           self.inputTypes = [None]*len(self.opInputs)
+        # set by markParameterFree
+        self.memoPlan = None
     def __repr__(self):
         shortOps = '[%r,...,%r]' % (self.ops[0],self.ops[-1])
         return 'OpSeqFunction(%r,%r,%r)' % (self.opInputs,self.opOutput,shortOps)
@@ -120,20 +138,87 @@ class OpSeqFunction(Function):
         return '%s = OpSeqFunction(%s)' % (rhs,','.join(args))
     def pprintComment(self):
         return str(self.rule) if self.rule else ''
+    def markParameterFree(self,db):
+        """Mark the ops whose outputs depend only on the inputs of the
+        function and on relations that aren't parameters, and save in
+        self.memoPlan the information needed to cache their outputs
+        for each example - see subtreecache.py.  The marks are redone
+        if the parameters of db change."""
+        fixedVars = set(self.opInputs)
+        # fixed variables that depend on the inputs, not just on constants
+        rowVars = set(self.opInputs)
+        fixedOps = set()
+        skippedOps = set()
+        relations = set()
+        for op in self.ops:
+            op.parameterFree = op.isParameterFree(db)
+            srcs = op.inputVars()
+            if op.parameterFree and all(v in fixedVars for v in srcs):
+                fixedVars.add(op.dst)
+                fixedOps.add(op)
+                if any(v in rowVars for v in srcs):
+                    rowVars.add(op.dst)
+                    skippedOps.add(op)
+                    relations.update(op.relationsUsed())
+        # cache the fixed per-example values that are needed by the
+        # rest of the function
+        needed = set([self.opOutput])
+        for op in self.ops:
+            if op not in fixedOps: needed.update(op.inputVars())
+        cachedVars = sorted(v for v in rowVars if v in needed and v not in self.opInputs)
+        self.memoPlan = MemoPlan(frozenset(db.paramSet),fixedOps,skippedOps if cachedVars else set(),
+                                 cachedVars,sorted(relations))
+        return self.memoPlan
+    def _memoPlan(self,db):
+        if self.memoPlan is None or self.memoPlan.params!=frozenset(db.paramSet):
+            self.markParameterFree(db)
+        return self.memoPlan
     def _doEval(self,db,values,pad):
         #eval expression
         pad[self.id].opEnv = opfunutil.Envir(db)
         pad[self.id].opEnv.bindList(self.opInputs,values)
+        # reuse the cached outputs of parameter-free ops if the inputs
+        # are the examples the scratchpad's cache is for
+        memo = pad.memo if (pad.memo is not None and len(values)==1 and values[0] is pad.memo.X) else None
+        skip = set()
+        if memo is not None:
+            plan = self._memoPlan(db)
+            if plan.cachedVars:
+                pad[self.id].memoPlan = plan
+                versions = (db.symbolEpoch,) + tuple(db.getVersion(f,a) for (f,a) in plan.relations)
+                cached = memo.lookup(self,versions,plan.cachedVars)
+                if cached is not None:
+                    for v,m in list(cached.items()):
+                        pad[self.id].opEnv[v] = m
+                    skip = plan.skippedOps
+        # if a pattern of candidate outputs is given, only those cells
+        # of the output are needed - see SoftmaxFunction.evalWithLoss.
+        # An output that will be cached must be computed in full
+        candidates = getattr(pad[self.id],'candidates',None)
+        last = self.ops[-1] if self.ops else None
+        if last is None or last.dst!=self.opOutput or (memo is not None and last in self._memoPlan(db).skippedOps):
+            candidates = None
         for op in self.ops:
-            op.eval(pad[self.id].opEnv,pad)
+            if op not in skip:
+                op.eval(pad[self.id].opEnv,pad,candidates if op is last else None)
+        if memo is not None and plan.cachedVars and not skip:
+            memo.store(self,versions,plan.cachedVars,pad[self.id].opEnv.register)
         return pad[self.id].opEnv[self.opOutput]
     def _doBackprop(self,delta,gradAccum,pad):
         pad[self.id].opEnv.delta[self.opOutput] = delta
+        # when the inputs are examples, the parameter-free ops can't
+        # contribute to a gradient, so backprop through them is skipped
+        plan = getattr(pad[self.id],'memoPlan',None)
+        skip = plan.fixedOps if plan is not None else set()
         n = len(self.ops)
         for i in range(n):
             op = self.ops[n-i-1]
-            op.backprop(pad[self.id].opEnv,gradAccum,pad)
+            if op not in skip:
+                op.backprop(pad[self.id].opEnv,gradAccum,pad)
         assert len(self.opInputs)==1, 'bp for multiple input functions not implemented'
+        if plan is not None:
+            X = pad[self.id].opEnv[self.opInputs[0]]
+            return pad[self.id].opEnv.db.zeros(mutil.numRows(X),self.inputTypes[0])
         return pad[self.id].opEnv.delta[self.opInputs[0]]
     def children(self):
         return self.ops
@@ -141,6 +226,21 @@ class OpSeqFunction(Function):
         ret = OpSeqFunction(self.opInputs, self.opOutput, [o.copy() for o in self.ops], self.rule, self.inputTypes, self.outputType)
         return ret
 
+class MemoPlan(object):
+    """How the parameter-free ops of an OpSeqFunction are cached, given
+    the parameters when they were marked.  fixedOps and skippedOps are
+    sets of ops: the ops that read no parameters (directly or
+    through other fixed ops), and those of them whose outputs vary
+    with the input rows, which are not evaluated when cachedVars are
+    found in a cache.  relations are the relations the skipped ops
+    read."""
+    def __init__(self,params,fixedOps,skippedOps,cachedVars,relations):
+        self.params = params
+        self.fixedOps = fixedOps
+        self.skippedOps = skippedOps
+        self.cachedVars = cachedVars
+        self.relations = relations
+
 class NullFunction(Function):
     """Returns an all-zeros vector."""
 
@@ -207,6 +307,9 @@ class SumFunction(Function):
         rhs = 'SumFunction' if self.outputType is None else 'SumFunction(%s)' % (self.outputType)
         return rhs
     def _doEval(self,db,values,pad):
+        candidates = getattr(pad[self.id],'candidates',None)
+        for f in self.funs:
+            pad[f.id].candidates = candidates
         addends = [f.eval(db,values,pad) for f in self.funs]
         accum = addends[0]
         for i in range(1,len(addends)):
@@ -245,6 +348,26 @@ class SoftmaxFunction(Function):
     def _doEval(self,db,values,pad):
         unnorm = self.fun.eval(db,values,pad)
         return mutil.softmax(db,unnorm)
+    def evalWithLoss(self,db,values,Y,pad,sampler=None):
+        """Like eval, but also compute the cross-entropy loss of each row
+        relative to labels Y, and the initial delta for backprop - see
+        mutil.softmaxCrossEntropy.  Returns a triple (P,rowLoss,delta).
+        If a learn.NegativeSampler is given, the softmax is only over
+        the answers it picks, so P, the loss and delta are for a
+        sampled softmax, and the inner function only computes the
+        scores of those answers where it can."""
+        if sampler is None:
+            unnorm = self.fun.eval(db,values,pad)
+        else:
+            relations = self.fun.relationsUsed()
+            candidates = sampler.candidates(Y,self.outputType,relations)
+            pad[self.fun.id].candidates = candidates
+            unnorm = self.fun.eval(db,values,pad)
+            pad[self.fun.id].candidates = None
+            unnorm = sampler.restrict(unnorm,candidates,Y,self.outputType,relations)
+        P,rowLoss,delta = mutil.softmaxCrossEntropy(db,unnorm,Y)
+        pad[self.id].output = P
+        return P,rowLoss,delta
     def _doBackprop(self,delta,pad):
         # see comments for learner.crossEntropyGrad
         assert False, 'should not call this directly'
@@ -3,6 +3,9 @@ import gpextras
 import sys
 import math
 
+#
+# NOTE: tensorlog/minerules.py mines the same rules directly from a
+# MatrixDB, with sparse matrix operations, and doesn't need GuineaPig.
 #
 # given a 'triples' file, which has tab-separated triples of the form
 # (head,relation,tail) generate a file of all plausible rules and
@@ -6,6 +6,8 @@
 import sys
 import time
 import math
+import queue
+import threading
 import numpy as NP
 import scipy.sparse as SS
 import collections
@@ -14,14 +16,19 @@ from tensorlog import config
 from tensorlog import dataset
 from tensorlog import declare
 from tensorlog import funs
+from tensorlog import memory
 from tensorlog import mutil
 from tensorlog import opfunutil
+from tensorlog import subtreecache
 
 # clip to avoid exploding gradients
 
 conf = config.Config()
 conf.minGradient = -100;   conf.help.minGradient = "Clip gradients smaller than this to minGradient"
 conf.maxGradient = +100;   conf.help.minGradient = "Clip gradients larger than this to maxGradient"
+conf.denseGradientLimit = 1000000;  conf.help.denseGradientLimit = "Use a dense gradient buffer for parameters with at most this many cells"
+conf.numNegatives = 20;    conf.help.numNegatives = "Number of negative answers sampled per example by a NegativeSampler"
+conf.proposal = 'frequency'; conf.help.proposal = "How a NegativeSampler draws negatives: 'uniform' or 'frequency'"
 
 ##############################################################################
 # helper classes
@@ -34,22 +41,51 @@ class GradAccumulator(object):
     mostly updated by the Tracer functions.  The only required counter
     is the counter 'n', which is the size of the minibatch the
     gradient was computed on.
+
+    If a GradientBuffers object and a db are given, gradients for
+    matrix parameters are scatter-added into preallocated buffers, and
+    only converted to sparse matrices when they are read.  (Gradients
+    for row-vector parameters have one row per example, so they are
+    summed as sparse matrices.)
     """
-    def __init__(self):
+    def __init__(self,buffers=None,db=None):
         self.runningSum = {}
         self.counter = collections.defaultdict(float)
         self.reshaped = False
+        # examples merged in so far by appendChunk
+        self.chunkRows = 0
+        self.buffers = buffers
+        self.db = db
+        # _touched[paramName] is a list of arrays of buffer positions
+        # holding gradients not yet moved to runningSum
+        self._touched = {}
     def keys(self):
+        self._flushBuffers()
         return list(self.runningSum.keys())
     def items(self):
+        self._flushBuffers()
         return list(self.runningSum.items())
     def __getitem__(self,paramName):
+        self._flushBuffers()
         return self.runningSum[paramName]
     def __setitem__(self,paramName,gradient):
+        self._flushBuffers()
         self.runningSum[paramName] = gradient
     def accum(self,paramName,deltaGradient):
         """Increment the parameter with the given name by the appropriate
-        amount."""
+        amount.  deltaGradient should be a CSR matrix, or a CSC matrix
+        if the gradient is buffered."""
+        buf = None
+        if self.buffers is not None and paramName[1]==2 and not self.db.isGrowable(*paramName):
+            buf = self.buffers.bufferFor(self.db,paramName,self)
+        if buf is not None:
+            positions,data = buf.positions(deltaGradient)
+            # a scatter-add, since a gradient that is not in canonical
+            # form can have repeated positions
+            NP.add.at(buf.data,positions,data)
+            self._touched.setdefault(paramName,[]).append(positions)
+            return
+        deltaGradient = mutil.asCSR(deltaGradient,'GradAccumulator')
         mutil.checkCSR(deltaGradient,('deltaGradient for %s' % str(paramName)))
         if not paramName in self.runningSum:
             self.runningSum[paramName] = deltaGradient
@@ -57,6 +93,29 @@ class GradAccumulator(object):
             self.runningSum[paramName] = self.runningSum[paramName] + deltaGradient
             mutil.checkCSR(self.runningSum[paramName],('runningSum for %s' % str(paramName)))
 
+    def __getstate__(self):
+        # buffers are local to a learner, so send only the sums
+        # when pickled (e.g., by a parallel learner's workers)
+        self._flushBuffers()
+        state = dict(self.__dict__)
+        state['buffers'] = state['db'] = None
+        return state
+
+    def _flushBuffers(self):
+        """Move buffered gradients into runningSum, and clear the parts of
+        the buffers that were used."""
+        for paramName,touched in list(self._touched.items()):
+            buf = self.buffers.buffer[paramName]
+            positions = NP.unique(NP.concatenate(touched))
+            m = buf.asMatrix(positions)
+            buf.data[positions] = 0.0
+            if paramName in self.runningSum:
+                m = self.runningSum[paramName] + m
+            self.runningSum[paramName] = m
+        self._touched = {}
+        if self.buffers is not None and self.buffers.owner is self:
+            self.buffers.owner = None
+
     #
     # manipulate gradients
     #
@@ -81,6 +140,29 @@ class GradAccumulator(object):
                     self.runningSum[(functor,arity)] = mat * (1.0/self.counter['n'])
             self.reshaped = True
 
+    def appendChunk(self,other,numRows):
+        """Merge in the gradients of another accumulator, which were
+        computed for the next numRows examples.  Gradients of matrix
+        parameters are summed, and the per-example gradients of
+        row-vector parameters are stacked, as if all the examples
+        were in one minibatch."""
+        priorRows = self.chunkRows
+        for ((functor,arity),m) in list(other.items()):
+            key = (functor,arity)
+            if arity==1:
+                parts = [self.runningSum[key]] if key in self.runningSum else []
+                if not parts and priorRows:
+                    parts = [SS.csr_matrix((priorRows,mutil.numCols(m)),dtype=mutil.DATA_DTYPE)]
+                self.runningSum[key] = mutil.stack(parts + [mutil.asCSR(m,'appendChunk')])
+            else:
+                self.accum(key,m)
+        # row-vector gradients not computed for this chunk are zero
+        for (key,m) in list(self.runningSum.items()):
+            if key[1]==1 and mutil.numRows(m)<priorRows+numRows:
+                missing = priorRows+numRows-mutil.numRows(m)
+                self.runningSum[key] = mutil.stack([m,SS.csr_matrix((missing,mutil.numCols(m)),dtype=mutil.DATA_DTYPE)])
+        self.chunkRows = priorRows + numRows
+
     #TODO only used by adagrad, is this the right place for this?
     def mapData(self,mapFun):
         """Apply some function to every gradient in the accumulator (in place)."""
@@ -145,6 +227,82 @@ class GradAccumulator(object):
             del ctr[(k,weightedTotalPrefix)]
         return ctr
 
+class GradientBuffers(object):
+    """Preallocated buffers that GradAccumulators scatter-add gradients
+    into, one per matrix parameter.  A buffer is dense if the parameter has
+    at most conf.denseGradientLimit cells, and otherwise is aligned
+    with the parameter's sparsity pattern, in which case gradients
+    for cells outside the pattern are dropped (as they would be when
+    the update is applied).  A learner keeps one GradientBuffers and
+    reuses it for every minibatch.
+    """
+    def __init__(self):
+        self.buffer = {}
+        # the GradAccumulator currently using the buffers
+        self.owner = None
+
+    def bufferFor(self,db,paramName,gradAccum):
+        if self.owner is not gradAccum:
+            if self.owner is not None: self.owner._flushBuffers()
+            self.owner = gradAccum
+        m,_ = db.getScaledParameter(*paramName)
+        buf = self.buffer.get(paramName)
+        if buf is None or not buf.fits(m):
+            if m.shape[0]*m.shape[1] <= conf.denseGradientLimit:
+                buf = _DenseGradientBuffer(m)
+            else:
+                buf = _PatternGradientBuffer(m)
+            self.buffer[paramName] = buf
+        return buf
+
+class _GradientBuffer(object):
+    """Base class for gradient buffers: a data array, plus a way of
+    mapping cells of a gradient to positions in it."""
+    def _cells(self,m):
+        """Return rows,cols,data for the non-zeros of a CSR or CSC matrix."""
+        if isinstance(m,SS.csc_matrix):
+            cols = NP.repeat(NP.arange(mutil.numCols(m),dtype=mutil.LONG_INDEX_DTYPE),NP.diff(m.indptr))
+            return m.indices,cols,m.data
+        mutil.checkCSR(m,'gradient')
+        return mutil.rowIndices(m),m.indices,m.data
+
+class _DenseGradientBuffer(_GradientBuffer):
+    def __init__(self,m):
+        self.shape = m.shape
+        self.data = NP.zeros(m.shape[0]*m.shape[1],dtype=mutil.DATA_DTYPE)
+    def fits(self,m):
+        return m.shape==self.shape
+    def positions(self,grad):
+        rows,cols,data = self._cells(grad)
+        return NP.asarray(rows,dtype=mutil.LONG_INDEX_DTYPE)*self.shape[1] + cols,data
+    def asMatrix(self,positions):
+        rows = positions // self.shape[1]
+        return mutil.csrFromCOO(self.data[positions],rows,positions % self.shape[1],self.shape,'gradient')
+
+class _PatternGradientBuffer(_GradientBuffer):
+    def __init__(self,m):
+        self.shape = m.shape
+        # a copy of the sparsity pattern, since parameters are updated
+        # in place and a growable parameter's pattern can change
+        self.indptr = m.indptr.copy()
+        self.indices = m.indices[:m.nnz].copy()
+        self.patternKeys = mutil.cellKeys(m)
+        self.data = NP.zeros(m.nnz,dtype=mutil.DATA_DTYPE)
+    def fits(self,m):
+        return (m.shape==self.shape and m.nnz==len(self.indices)
+                and NP.array_equal(m.indptr,self.indptr)
+                and NP.array_equal(m.indices[:m.nnz],self.indices))
+    def positions(self,grad):
+        rows,cols,data = self._cells(grad)
+        keys = NP.asarray(rows,dtype=mutil.LONG_INDEX_DTYPE)*self.shape[1] + cols
+        positions = mutil.keyPositions(self.patternKeys,keys)
+        found = positions>=0
+        return positions[found],data[found]
+    def asMatrix(self,positions):
+        keys = self.patternKeys[positions]
+        return mutil.csrFromCOO(self.data[positions],keys // self.shape[1],keys % self.shape[1],
+                                self.shape,'gradient')
+
 class Tracer(object):
 
     """ Functions to pass in as arguments to a learner's "tracer"
@@ -226,7 +384,8 @@ class Tracer(object):
     @staticmethod
     def loss(learner,Y,P,kw):
         #perExample=False since we care about the sum xe+reg which is being optimized
-        xe = learner.crossEntropy(Y,P,perExample=False)  
+        #(the learner may have computed it already, along with P)
+        xe = kw['crossEnt'] if 'crossEnt' in kw else learner.crossEntropy(Y,P,perExample=False)
         reg = learner.regularizer.regularizationCost(learner.prog)
         return [('loss', (xe+reg)), ('crossEnt', xe), ('reg',reg)]
 
@@ -288,6 +447,376 @@ class EpochTracer(Tracer):
 
         print((' '.join([('%s=%g'%(k_v[0],k_v[1])) for k_v in pairs])))
 
+class AsyncTracer(object):
+
+    """A tracer that computes loss and accuracy on a background thread,
+    so that the training loop only pays for handing over Y and P.
+    Metrics are only computed for every k-th minibatch of an epoch,
+    starting with the first, and if rows is positive, on a random
+    sample of at most that many rows of it.  Snapshots that arrive
+    while depth others are waiting are dropped, rather than making
+    the learner wait.  Regularization costs are computed on the
+    training thread, since the worker can't read parameters while they
+    are being updated; this is cheap, since L2Regularizer maintains
+    sums of squares incrementally.
+
+    At the end of each epoch the learner calls finishEpoch, which
+    waits for the worker and merges the metrics into the epoch's
+    counter, where totals are scaled up by the fraction of the
+    examples that were measured.  Use as:
+
+       tracer = learn.AsyncTracer(every=10)
+       learner = learn.FixedRateSGDLearner(prog,tracer=tracer)
+
+    The stats dictionary records the time the training loop spent in
+    the tracer (callTime), the time the worker spent computing
+    metrics (workTime), and the number of minibatches measured and
+    dropped.
+    """
+
+    # metrics computed by the worker, which are merged into epoch counters
+    metrics = ['loss','crossEnt','reg','acc']
+
+    def __init__(self,every=1,rows=0,accuracy=False,announce=False,depth=4,seed=0):
+        assert every>0, 'every must be positive'
+        self.every = every
+        self.rows = rows
+        self.accuracy = accuracy
+        self.announce = announce
+        self.stats = collections.Counter()
+        self.rand = NP.random.RandomState(seed)
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = None
+        self._calls = 0
+        self._results = []
+        self._error = None
+
+    def __call__(self,learner,gradAccum,Y,P,**kw):
+        start = time.time()
+        n = mutil.numRows(Y)
+        gradAccum.counter['n'] = n
+        ident = Tracer.identification(learner,kw) + Tracer.timing(learner,kw)
+        Tracer._record(gradAccum,ident)
+        if self._calls % self.every == 0:
+            rowNums = None
+            if self.rows>0 and n>self.rows:
+                rowNums = NP.sort(self.rand.choice(n,self.rows,replace=False))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work,name='AsyncTracer')
+                self._thread.daemon = True
+                self._thread.start()
+            try:
+                reg = learner.regularizer.regularizationCost(learner.prog)
+                self._queue.put_nowait((learner,Y,P,rowNums,kw.get('crossEnt'),reg,ident))
+            except queue.Full:
+                self.stats['dropped'] += 1
+        self._calls += 1
+        self.stats['callTime'] += time.time() - start
+
+    def finishEpoch(self,learner,epochCounter):
+        """Wait for the metrics of the epoch's minibatches, and merge them
+        into the epoch counter."""
+        self._queue.join()
+        self._calls = 0
+        if self._error is not None:
+            error,self._error = self._error,None
+            raise error
+        if self._results:
+            measured = GradAccumulator.mergeCounters(self._results)
+            scale = epochCounter[('n','tot')]/measured[('n','tot')]
+            for k in AsyncTracer.metrics:
+                if (k,'tot') in measured:
+                    for stat in ['min','max','avg']:
+                        epochCounter[(k,stat)] = measured[(k,stat)]
+                    epochCounter[(k,'tot')] = measured[(k,'tot')]*scale
+            epochCounter['measured'] = len(self._results)
+            self._results = []
+
+    def _work(self):
+        while True:
+            (learner,Y,P,rowNums,xe,reg,ident) = self._queue.get()
+            try:
+                start = time.time()
+                if self._error is None:
+                    self._results.append(self._measure(learner,Y,P,rowNums,xe,reg,ident))
+                self.stats['measured'] += 1
+                self.stats['workTime'] += time.time() - start
+            except Exception as ex:
+                self._error = ex
+            finally:
+                self._queue.task_done()
+
+    def _measure(self,learner,Y,P,rowNums,xe,reg,ident):
+        n = mutil.numRows(Y)
+        if rowNums is not None:
+            Y,P = mutil.gatherRows(Y,rowNums),mutil.gatherRows(P,rowNums)
+        if xe is None:
+            #scale up the loss on the sampled rows to the whole minibatch
+            xe = learner.crossEntropy(Y,P,perExample=False)*float(n)/mutil.numRows(Y)
+        pairs = ident + [('loss', (xe+reg)), ('crossEnt', xe), ('reg',reg)]
+        if self.accuracy:
+            pairs += Tracer.accuracy(learner,Y,P,{})
+        result = GradAccumulator()
+        result.counter['n'] = n
+        if self.announce:
+            Tracer._announce(result,pairs)
+        else:
+            Tracer._record(result,pairs)
+        return result.counter
+
+
+##############################################################################
+# optimizers
+##############################################################################
+
+class Optimizer(object):
+    """Abstract class for optimizers, which turn gradients into parameter
+    updates.  An optimizer can be passed to a learner's 'optimizer'
+    keyword argument; the default is FixedRateOptimizer.
+
+    Parameters are updated in place, on their existing sparsity
+    pattern: gradient values for cells outside the pattern are
+    dropped, unless the parameter has been marked with
+    db.markAsGrowable, in which case the pattern is extended.  Updates
+    are lazy: only the coordinates with a non-zero gradient are
+    touched, at a cost that is linear in the size of the gradient,
+    not the parameter.  Parameters are clipped to be non-negative.
+
+    Adaptive optimizers keep per-coordinate state for each parameter
+    in arrays that are aligned with the parameter's data array.
+    """
+
+    # names of the state arrays kept for each parameter
+    stateNames = []
+
+    def __init__(self,epsilon=1e-8):
+        self.epsilon = epsilon
+        # number of updates performed so far
+        self.t = 0
+        # state[(functor,arity)][name] is an array aligned with the data
+        # of the parameter
+        self.state = {}
+        # owned[(functor,arity)] is the parameter matrix last written by
+        # this optimizer, which it can safely update in place
+        self.owned = {}
+
+    def applyUpdate(self,db,paramGrads,rate):
+        """Update the parameters in db using the gradients in paramGrads,
+        with base learning rate rate."""
+        paramGrads.fitParameterShapes()
+        self.t += 1
+        for (functor,arity),grad in list(paramGrads.items()):
+            m,scale,positions,g = self._alignedGradient(db,functor,arity,grad)
+            step = self._step(self.state[(functor,arity)],positions,g,rate)
+            # the parameter's value is m*scale - see MatrixDB.scaleParameter
+            old = m.data[positions]
+            new = NP.clip(old + step/scale, 0.0, NP.finfo('float32').max)
+            m.data[positions] = new
+            sumSquaresDelta = float(NP.dot(new,new) - NP.dot(old,old))
+            db.setParameter(functor,arity,m,scale=scale,sumSquaresDelta=sumSquaresDelta)
+
+    def _alignedGradient(self,db,functor,arity,grad):
+        """Return the stored matrix m for a parameter, its scale, and
+        arrays positions,g such that the gradient for m.data[positions]
+        is g.
+        """
+        key = (functor,arity)
+        m,scale = db.getScaledParameter(functor,arity)
+        if self.owned.get(key) is not m:
+            # the parameter is new to the optimizer, or was replaced by
+            # someone else, so work on a copy, to avoid altering other
+            # references to it
+            m = mutil.asCSR(m.copy(),'Optimizer')
+            m.sum_duplicates()
+            self._realignState(key,m)
+        grad = mutil.asCSR(grad,'Optimizer gradient')
+        grad.sum_duplicates()
+        positions = mutil.patternPositions(m,grad)
+        g = grad.data
+        outside = positions<0
+        if NP.any(outside):
+            if db.isGrowable(functor,arity):
+                self.owned[key] = m
+                m,_ = mutil.unionPattern(m,grad)
+                self._realignState(key,m)
+                positions = mutil.patternPositions(m,grad)
+            else:
+                positions = positions[~outside]
+                g = g[~outside]
+        self.owned[key] = m
+        return m,scale,positions,g
+
+    def _realignState(self,key,m):
+        """Make the state arrays for a parameter match the sparsity pattern
+        of m, which replaces self.owned[key]."""
+        old = self.owned.get(key)
+        if key not in self.state or old is None or old.shape!=m.shape:
+            self.state[key] = dict((name,NP.zeros(m.nnz,dtype=mutil.DATA_DTYPE)) for name in self.stateNames)
+        elif not (old.nnz==m.nnz and NP.array_equal(old.indptr,m.indptr) and NP.array_equal(old.indices,m.indices)):
+            positions = mutil.patternPositions(m,old)
+            found = positions>=0
+            for name,arr in list(self.state[key].items()):
+                newArr = NP.zeros(m.nnz,dtype=mutil.DATA_DTYPE)
+                newArr[positions[found]] = arr[found]
+                self.state[key][name] = newArr
+
+    def _step(self,state,positions,g,rate):
+        """Update the state arrays for the coordinates in positions, which
+        have gradient g, and return the change to the parameter."""
+        assert False, 'abstract method called'
+
+class FixedRateOptimizer(Optimizer):
+    """Plain gradient steps of size rate, used by default."""
+
+    def _step(self,state,positions,g,rate):
+        return rate * g
+
+class AdaGradOptimizer(Optimizer):
+    """AdaGrad: each coordinate's rate is scaled by the inverse square root
+    of the sum of its squared gradients."""
+
+    stateNames = ['sumSquareGrads']
+
+    def _step(self,state,positions,g,rate):
+        sumSq = state['sumSquareGrads']
+        sumSq[positions] += g*g
+        return rate * g / (NP.sqrt(sumSq[positions]) + self.epsilon)
+
+class RMSPropOptimizer(Optimizer):
+    """RMSProp: like AdaGrad but using an exponential moving average of the
+    squared gradients."""
+
+    stateNames = ['meanSquareGrads']
+
+    def __init__(self,decay=0.9,epsilon=1e-8):
+        super(RMSPropOptimizer,self).__init__(epsilon=epsilon)
+        self.decay = decay
+
+    def _step(self,state,positions,g,rate):
+        meanSq = state['meanSquareGrads']
+        meanSq[positions] = self.decay*meanSq[positions] + (1.0-self.decay)*g*g
+        return rate * g / (NP.sqrt(meanSq[positions]) + self.epsilon)
+
+class AdamOptimizer(Optimizer):
+    """Adam, with lazy updates of the moment estimates: a coordinate's
+    moments decay only on steps where its gradient is non-zero."""
+
+    stateNames = ['firstMoment','secondMoment']
+
+    def __init__(self,beta1=0.9,beta2=0.999,epsilon=1e-8):
+        super(AdamOptimizer,self).__init__(epsilon=epsilon)
+        self.beta1 = beta1
+        self.beta2 = beta2
+
+    def _step(self,state,positions,g,rate):
+        m1 = state['firstMoment']
+        m2 = state['secondMoment']
+        m1[positions] = self.beta1*m1[positions] + (1.0-self.beta1)*g
+        m2[positions] = self.beta2*m2[positions] + (1.0-self.beta2)*g*g
+        correctedRate = rate * math.sqrt(1.0 - self.beta2**self.t) / (1.0 - self.beta1**self.t)
+        return correctedRate * m1[positions] / (NP.sqrt(m2[positions]) + self.epsilon)
+
+##############################################################################
+# negative sampling
+##############################################################################
+
+class NegativeSampler(object):
+    """Picks the answers that a sampled softmax is computed over, for a
+    learner with a 'sampler'.  For each example, these are the gold
+    answers, the null entity, and numNegatives entities of the output
+    type drawn with replacement from a proposal distribution.  The
+    sampled loss approximates the full cross-entropy, since the
+    score of each sampled negative is corrected by subtracting the
+    log of the probability it was drawn, and its gradient is
+    non-zero only for the answers picked, so backprop starts from a
+    few columns of the output.
+
+    The answers are drawn before the predict function is evaluated,
+    and the VecMatMulOps that compute its output score only those
+    answers, when that reads less of their matrices than the full
+    product - see SoftmaxFunction.evalWithLoss and
+    bench.measure.samplingTimes.  The other steps are evaluated in
+    full.
+
+    Answers with no proofs have probability zero under the full
+    softmax, so only answers with non-zero scores are kept.  The
+    proposal decides how negatives are drawn:
+     - 'uniform': entities are drawn uniformly
+     - 'frequency': entities are drawn in proportion to one plus the
+       number of facts they appear in as the last argument
+    """
+
+    proposals = ['uniform','frequency']
+
+    def __init__(self,db,numNegatives=None,proposal=None,seed=0):
+        self.db = db
+        self.numNegatives = conf.numNegatives if numNegatives is None else numNegatives
+        self.proposal = conf.proposal if proposal is None else proposal
+        assert self.proposal in NegativeSampler.proposals,'unknown proposal %r' % self.proposal
+        self.rand = NP.random.RandomState(seed)
+        # proposal probabilities for each type and set of relations
+        # counted, and their cumulative sums
+        self._proposal = {}
+
+    def proposalProbabilities(self,typeName,numCols,relations=None):
+        """The probability of drawing each entity id of a type.  Reserved
+        ids, like the null entity, are never drawn.  For the
+        'frequency' proposal, facts are counted in the given
+        (functor,arity) pairs, or in every relation if relations is
+        None."""
+        if self.proposal=='uniform':
+            q = NP.ones(numCols)
+        else:
+            typeName = self.db.schema.defaultType() if typeName is None else typeName
+            q = NP.ones(numCols)
+            for (functor,arity) in (self.db.relationKeys() if relations is None else sorted(relations)):
+                rangeType = self.db.schema.getArgType(functor,arity,arity-1)
+                if (self.db.schema.defaultType() if rangeType is None else rangeType)==typeName:
+                    m = self.db.relationMatrix(functor,arity)
+                    q += NP.bincount(m.indices[:m.nnz],minlength=numCols)[:numCols]
+        # ids 1 and 2 are the null and out-of-vocabulary entities
+        q[:3] = 0.0
+        return q/q.sum()
+
+    def _cumulativeProposal(self,typeName,numCols,relations):
+        # renumbering the symbols moves the counts to other ids
+        key = (self.db.symbolEpoch,numCols,typeName,None if relations is None else frozenset(relations))
+        if key not in self._proposal:
+            q = self.proposalProbabilities(typeName,numCols,relations)
+            self._proposal[key] = (q,NP.cumsum(q))
+        return self._proposal[key]
+
+    def candidates(self,Y,typeName=None,relations=None):
+        """Given gold answers Y, draw the negatives for each example, and
+        return a pattern matrix with the cells of the answers picked.
+        The relations are those read by the predict function - see
+        proposalProbabilities."""
+        n,numCols = Y.shape
+        k = self.numNegatives
+        q,cumulative = self._cumulativeProposal(typeName,numCols,relations)
+        draws = NP.searchsorted(cumulative,self.rand.rand(n*k)*cumulative[-1],side='right')
+        rowKeys = NP.arange(n,dtype=mutil.LONG_INDEX_DTYPE)*numCols
+        # id 1 is the null entity
+        keys = NP.unique(NP.concatenate([NP.repeat(rowKeys,k) + draws, rowKeys + 1,
+                                         mutil.cellKeys(mutil.withSortedIndices(mutil.asCSR(Y,'NegativeSampler')))]))
+        indptr = NP.zeros(n+1,dtype=mutil.LONG_INDEX_DTYPE)
+        NP.cumsum(NP.bincount(keys//numCols,minlength=n),out=indptr[1:])
+        return mutil.patternMatrix(keys%numCols,indptr,Y.shape,'NegativeSampler')
+
+    def restrict(self,mat,candidates,Y,typeName=None,relations=None):
+        """Given scores mat, the candidates picked for them, and gold
+        answers Y, return a matrix of the corrected scores of the
+        candidates."""
+        mat = mutil.restrictToPattern(mat,candidates)
+        isGold = mutil.keyPositions(mutil.cellKeys(mutil.withSortedIndices(Y)),mutil.cellKeys(mat))>=0
+        q,_ = self._cumulativeProposal(typeName,mat.shape[1],relations)
+        # probability an entity is drawn at least once in k draws
+        with NP.errstate(divide='ignore'):
+            logKeep = NP.log(-NP.expm1(self.numNegatives*NP.log1p(-NP.minimum(q[mat.indices],1.0-1e-12))))
+        # the null entity is always kept
+        exact = isGold | (mat.indices==1)
+        data = mat.data - NP.where(exact,0.0,logKeep)
+        return mutil.csr(data,mat.indices,mat.indptr,mat.shape,'NegativeSampler')
 
 ##############################################################################
 # Learners
@@ -298,20 +827,38 @@ class Learner(object):
     """Abstract class with some utility functions.."""
 
     # prog pts to db, rules
-    def __init__(self,prog,regularizer,tracer,epochTracer):
+    def __init__(self,prog,regularizer,tracer,epochTracer,optimizer=None,sampler=None):
         self.prog = prog
         self.regularizer = regularizer or NullRegularizer()
         self.tracer = tracer or Tracer.default
         self.epochTracer = epochTracer or EpochTracer.default
+        self.optimizer = optimizer or FixedRateOptimizer()
+        # if given, a NegativeSampler, and crossEntropyGrad uses a
+        # sampled softmax
+        self.sampler = sampler
+        # outputs of the parameter-free parts of the program, which
+        # are reused across epochs - see subtreecache.py
+        self.subtreeCache = subtreecache.SubtreeCache() if subtreecache.conf.budget>0 else None
+        # reused for the gradients of every minibatch
+        self.gradBuffers = GradientBuffers()
 
     #
     # using and measuring performance
     #
 
     def predict(self,mode,X,pad=None):
-        """Make predictions on a data matrix associated with the given mode."""
-        if not pad: pad = opfunutil.Scratchpad() 
+        """Make predictions on a data matrix associated with the given
+        mode.  If no scratchpad is given and X is too large for the
+        memory budget, predictions are made for chunks of rows - see
+        memory.py."""
         predictFun = self.prog.getPredictFunction(mode)
+        if not pad and memory.needsChunking(mutil.numRows(X)):
+            def predictRows(lo,hi):
+                chunkPad = opfunutil.Scratchpad()
+                P = predictFun.eval(self.prog.db, [mutil.selectRows(X,lo,hi)], chunkPad)
+                return P,memory.padBytes(chunkPad)
+            return mutil.stack(memory.evalInChunks(predictRows,mutil.numRows(X)))
+        if not pad: pad = opfunutil.Scratchpad() 
         result = predictFun.eval(self.prog.db, [X], pad)
         return result
 
@@ -393,7 +940,9 @@ class Learner(object):
         gradient computation will be saved on that scratchpad.
         """
 
-        if not pad: pad = opfunutil.Scratchpad()
+        if not pad and memory.needsChunking(mutil.numRows(X)):
+            return self._chunkedCrossEntropyGrad(mode,X,Y,tracerArgs)
+        if not pad: pad = self._newScratchpad(X)
 
         # More detail: in learning we use a softmax normalization
         # followed immediately by a crossEntropy loss, which has a
@@ -408,28 +957,55 @@ class Learner(object):
         # do the prediction, saving intermediate outputs on the scratchpad
         predictFun = self.prog.getPredictFunction(mode)
         assert isinstance(predictFun,funs.SoftmaxFunction),'crossEntropyGrad specialized to work for softmax normalization'
-        P = self.predict(mode,X,pad)
+        P,rowLoss,delta = predictFun.evalWithLoss(self.prog.db,[X],Y,pad,sampler=self.sampler)
 
         # compute gradient
-        paramGrads = GradAccumulator()
+        paramGrads = GradAccumulator(buffers=self.gradBuffers,db=self.prog.db)
         #TODO assert rowSum(Y) = all ones - that's assumed here in
         #initial delta of Y-P
-        predictFun.fun.backprop(Y-P,paramGrads,pad)
+        predictFun.fun.backprop(delta,paramGrads,pad)
 
         # the tracer function may output status, and may also write
         # information to the counters in paramGrads
-        self.tracer(self,paramGrads,Y,P,**tracerArgs)
+        self.tracer(self,paramGrads,Y,P,crossEnt=float(rowLoss.sum()),**tracerArgs)
 
         return paramGrads
 
+    def _newScratchpad(self,X):
+        """A scratchpad for computing gradients for inputs X, which uses
+        the learner's subtree cache."""
+        pad = opfunutil.Scratchpad()
+        if self.subtreeCache is not None:
+            pad.memo = self.subtreeCache.view(X)
+        return pad
+
+    def _chunkedCrossEntropyGrad(self,mode,X,Y,tracerArgs):
+        """Like crossEntropyGrad, but compute the gradients for chunks of
+        rows that fit in the memory budget, and merge them."""
+        predictFun = self.prog.getPredictFunction(mode)
+        assert isinstance(predictFun,funs.SoftmaxFunction),'crossEntropyGrad specialized to work for softmax normalization'
+        paramGrads = GradAccumulator(buffers=self.gradBuffers,db=self.prog.db)
+        def gradRows(lo,hi):
+            chunkX = mutil.selectRows(X,lo,hi)
+            chunkPad = self._newScratchpad(chunkX)
+            P,rowLoss,delta = predictFun.evalWithLoss(self.prog.db,[chunkX],mutil.selectRows(Y,lo,hi),chunkPad,sampler=self.sampler)
+            chunkGrads = GradAccumulator()
+            predictFun.fun.backprop(delta,chunkGrads,chunkPad)
+            paramGrads.appendChunk(chunkGrads,hi-lo)
+            return (P,float(rowLoss.sum())),memory.padBytes(chunkPad)
+        results = memory.evalInChunks(gradRows,mutil.numRows(X))
+        P = mutil.stack([p for (p,loss) in results])
+        self.tracer(self,paramGrads,Y,P,crossEnt=sum(loss for (p,loss) in results),**tracerArgs)
+        return paramGrads
+
     #
     # parameter updates
     #
 
     def meanUpdate(self,functor,arity,delta,n,totalN=0):
-        #clip the delta vector to avoid exploding gradients
-        delta = mutil.mapData(lambda d:NP.clip(d,conf.minGradient,conf.maxGradient), delta)
         if arity==1:
+            #clip the delta vector to avoid exploding gradients
+            delta = mutil.mapData(lambda d:NP.clip(d,conf.minGradient,conf.maxGradient), delta)
             #for a parameter that is a row-vector, we have one
             #gradient per example and we will take the mean
             compensation = 1.0 if totalN==0 else float(n)/totalN
@@ -437,19 +1013,26 @@ class Learner(object):
         else:
             #for a parameter that is a matrix, we have one gradient for the whole matrix
             compensation = (1.0/n) if totalN==0 else (1.0/totalN)
-            return delta*compensation
+            result = delta*compensation
+            #clip the scaled copy in place, which is the same as scaling
+            #the clipped delta
+            NP.clip(result.data,conf.minGradient*compensation,conf.maxGradient*compensation,out=result.data)
+            return result
         
 
+    def traceEpoch(self,epochCounter,**kw):
+        """Pass the counters for an epoch to the epoch tracer, after adding
+        any metrics an AsyncTracer is still computing."""
+        if isinstance(self.tracer,AsyncTracer):
+            self.tracer.finishEpoch(self,epochCounter)
+        self.epochTracer(self,epochCounter,**kw)
+
     def applyUpdate(self,paramGrads,rate):
         """Add each gradient to the appropriate param, after scaling by rate,
-        and clip negative parameters to zero.
+        and clip negative parameters to zero.  The work is done by the
+        learner's optimizer, which by default is a FixedRateOptimizer.
         """ 
-        paramGrads.fitParameterShapes()
-        for (functor,arity),delta in list(paramGrads.items()):
-            m0 = self.prog.db.getParameter(functor,arity)
-            m1 = m0 + rate * delta
-            m2 = mutil.mapData(lambda d:NP.clip(d,0.0,NP.finfo('float32').max), m1)
-            self.prog.db.setParameter(functor,arity,m2)
+        self.optimizer.applyUpdate(self.prog.db,paramGrads,rate)
 
 #
 # actual learner implementations
@@ -458,8 +1041,8 @@ class Learner(object):
 class OnePredFixedRateGDLearner(Learner):
     """ Simple one-predicate learner.
     """  
-    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,epochTracer=None):
-        super(OnePredFixedRateGDLearner,self).__init__(prog,regularizer=regularizer,tracer=tracer,epochTracer=epochTracer)
+    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,epochTracer=None,optimizer=None,sampler=None):
+        super(OnePredFixedRateGDLearner,self).__init__(prog,regularizer=regularizer,tracer=tracer,epochTracer=epochTracer,optimizer=optimizer,sampler=sampler)
         self.epochs=epochs
         self.rate=rate
     
@@ -477,8 +1060,8 @@ class FixedRateGDLearner(Learner):
     """ A batch gradient descent learner.
     """
 
-    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,epochTracer=None):
-        super(FixedRateGDLearner,self).__init__(prog,regularizer=regularizer,tracer=tracer,epochTracer=epochTracer)
+    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,epochTracer=None,optimizer=None,sampler=None):
+        super(FixedRateGDLearner,self).__init__(prog,regularizer=regularizer,tracer=tracer,epochTracer=epochTracer,optimizer=optimizer,sampler=sampler)
         self.epochs=epochs
         self.rate=rate
     
@@ -500,7 +1083,7 @@ class FixedRateGDLearner(Learner):
                 except:
                     print(("Unexpected error at %s:" % str(args), sys.exc_info()[:2]))
                     raise
-            self.epochTracer(self,epochCounter,i=i,startTime=trainStartTime)
+            self.traceEpoch(epochCounter,i=i,startTime=trainStartTime)
             
 
 class FixedRateSGDLearner(FixedRateGDLearner):
@@ -508,10 +1091,12 @@ class FixedRateSGDLearner(FixedRateGDLearner):
     """ A stochastic gradient descent learner.
     """
 
-    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,miniBatchSize=100):
+    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,miniBatchSize=100,prefetch=None,optimizer=None,sampler=None):
         super(FixedRateSGDLearner,self).__init__(
-            prog,epochs=epochs,rate=rate,regularizer=regularizer,tracer=tracer)
+            prog,epochs=epochs,rate=rate,regularizer=regularizer,tracer=tracer,optimizer=optimizer,sampler=sampler)
         self.miniBatchSize = miniBatchSize
+        # number of minibatches to build ahead in the background - see Dataset.minibatchIterator
+        self.prefetch = prefetch
     
     def train(self,dset):
         trainStartTime = time.time()
@@ -521,7 +1106,7 @@ class FixedRateSGDLearner(FixedRateGDLearner):
             startTime = time.time()
             epochCounter = GradAccumulator.counter()
             k = 0
-            for (mode,X,Y) in dset.minibatchIterator(batchSize=self.miniBatchSize):
+            for (mode,X,Y) in dset.minibatchIterator(batchSize=self.miniBatchSize,prefetch=self.prefetch):
                 n = mutil.numRows(X)
                 k = k+1
                 args = {'i':i,'k':k,'startTime':startTime,'mode':mode}
@@ -534,7 +1119,7 @@ class FixedRateSGDLearner(FixedRateGDLearner):
                     print(("Unexpected error at %s:" % str(args), sys.exc_info()[:2]))
                     raise
 
-            self.epochTracer(self,epochCounter,i=i,startTime=trainStartTime)
+            self.traceEpoch(epochCounter,i=i,startTime=trainStartTime)
 
 ##############################################################################
 # regularizers
@@ -562,20 +1147,20 @@ class NullRegularizer(object):
         return 0.0
 
 class L2Regularizer(Regularizer):
-    """ L2 regularization toward 0."""
+    """ L2 regularization toward 0.  Parameters are shrunk lazily, by
+    adjusting a scale factor kept by the database, and their sums of
+    squares are maintained incrementally, so the cost of regularizing
+    doesn't depend on the size of the parameters."""
 
     def __init__(self,regularizationConstant=0.01):
         self.regularizationConstant = regularizationConstant
 
     def regularizeParams(self,prog,n):
         for functor,arity in prog.getParamList():
-            m0 = prog.db.getParameter(functor,arity)
-            m1 = m0 * (1.0 - self.regularizationConstant)
-            prog.db.setParameter(functor,arity,m1)
+            prog.db.scaleParameter(functor,arity,1.0 - self.regularizationConstant)
 
     def regularizationCost(self,prog):
         result = 0
         for functor,arity in prog.getParamList():
-            m = prog.db.getParameter(functor,arity)
-            result += (m.data * m.data).sum()
+            result += prog.db.parameterSquaredNorm(functor,arity)
         return result*self.regularizationConstant
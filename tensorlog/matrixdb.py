@@ -10,6 +10,7 @@ import scipy.sparse
 import scipy.io
 import collections
 import logging
+import numpy as NP
 
 from tensorlog import config
 from tensorlog import declare
@@ -23,6 +24,10 @@ conf = config.Config()
 conf.allow_weighted_tuples = True;     conf.help.allow_weighted_tuples = 'Allow last column of cfacts file to be a weight for the fact'
 conf.default_to_typed_schema = False;  conf.help.default_to_typed_schema = 'If true use TypedSchema() as default schema in MatrixDB'
 conf.ignore_types = False;             conf.help.ignore_types = 'Ignore type declarations, even if they are present'
+conf.update_merge_threshold = 10000;   conf.help.update_merge_threshold = 'Merge buffered fact updates for a relation into its matrix when this many are pending'
+conf.min_parameter_scale = 1e-3;       conf.help.min_parameter_scale = 'Multiply a lazily scaled parameter by its scale factor when the factor falls below this'
+conf.constant_cache_size = 10000;      conf.help.constant_cache_size = 'Maximum number of onehot, ones, zeros and null matrices cached by a MatrixDB'
+conf.pattern_storage = True;           conf.help.pattern_storage = 'Store relations whose weights are all 1.0 without a data array, unless they are parameters'
 
 NULL_ENTITY_NAME = dbschema.NULL_ENTITY_NAME
 THING = dbschema.THING
@@ -31,6 +36,113 @@ OOV_ENTITY_NAME = dbschema.OOV_ENTITY_NAME
 #functor in declarations of trainable relations, eg trainable(posWeight,1)
 TRAINABLE_DECLARATION_FUNCTOR = 'trainable'
 
+# subdirectory of a serialized db holding one set of files per relation
+RELATION_DIR = 'relations'
+RELATION_INDEX_FILE = 'index.txt'
+
+class LazyRelations(dict):
+  """A dictionary mapping (functor,arity) pairs to matrices, used as
+  the matEncoding of a MatrixDB, where each matrix is read from a
+  directory written by MatrixDB.serializeRelations the first time it
+  is accessed.  Iterating over the values or items loads everything.
+  """
+
+  def __init__(self,direc):
+    super(LazyRelations,self).__init__()
+    self.direc = direc
+    # stored[(functor,arity)] is the information needed to load a
+    # relation that hasn't been accessed yet
+    self._stored = {}
+    for line in util.linesIn(os.path.join(direc,RELATION_INDEX_FILE)):
+      parts = line.strip().split("\t")
+      key = (parts[0],int(parts[1]))
+      (k,numRows,numCols,nnz,isPattern) = [int(p) for p in parts[2:7]]
+      self._stored[key] = (k,numRows,numCols,nnz,NP.dtype(parts[7]),isPattern)
+
+  def isLoaded(self,key):
+    return key not in self._stored
+
+  def storedBytes(self,key):
+    """The bytes a relation that hasn't been loaded will use once it
+    is, computed from the index without reading it."""
+    (k,numRows,numCols,nnz,indexType,isPattern) = self._stored[key]
+    dataBytes = 0 if isPattern else nnz*NP.dtype(mutil.DATA_DTYPE).itemsize
+    return dataBytes + (nnz+numRows+1)*indexType.itemsize
+
+  def _load(self,key):
+    (k,numRows,numCols,nnz,indexType,isPattern) = self._stored.pop(key)
+    def read(suffix,dtype):
+      return NP.fromfile(os.path.join(self.direc,'r%d%s' % (k,suffix)),dtype=dtype)
+    indices = read('.indices',indexType)
+    indptr = read('.indptr',indexType)
+    if isPattern:
+      m = mutil.patternMatrix(indices,indptr,(numRows,numCols),'LazyRelations')
+    else:
+      m = mutil.csr(read('.data',mutil.DATA_DTYPE),indices,indptr,(numRows,numCols),'LazyRelations')
+    logging.info('loaded relation %s/%d with %d non-zeros from %s' % (key[0],key[1],nnz,self.direc))
+    super(LazyRelations,self).__setitem__(key,m)
+    return m
+
+  def __missing__(self,key):
+    if key in self._stored:
+      return self._load(key)
+    raise KeyError(key)
+
+  def __contains__(self,key):
+    return super(LazyRelations,self).__contains__(key) or key in self._stored
+
+  def __setitem__(self,key,m):
+    self._stored.pop(key,None)
+    super(LazyRelations,self).__setitem__(key,m)
+
+  def __delitem__(self,key):
+    if key in self._stored:
+      del self._stored[key]
+    else:
+      super(LazyRelations,self).__delitem__(key)
+
+  def __len__(self):
+    return super(LazyRelations,self).__len__() + len(self._stored)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def get(self,key,default=None):
+    return self[key] if key in self else default
+
+  def pop(self,key,*default):
+    if key in self._stored:
+      self._load(key)
+    return super(LazyRelations,self).pop(key,*default)
+
+  def keys(self):
+    return list(super(LazyRelations,self).keys()) + list(self._stored.keys())
+
+  def values(self):
+    return [self[key] for key in self.keys()]
+
+  def items(self):
+    return [(key,self[key]) for key in self.keys()]
+
+class _UpdateBuffer(object):
+  """Incremental changes to a relation, in the order they were made,
+  as chunks of parallel arrays of rows, columns, weights and reset
+  flags.  An update with the reset flag set replaces the weight of
+  its cell, and the others add to it.
+  """
+
+  def __init__(self):
+    self.chunks = []
+    self.size = 0
+
+  def append(self,rows,cols,weights,reset):
+    self.chunks.append((rows,cols,weights,NP.full(rows.size,reset,dtype=bool)))
+    self.size += rows.size
+
+  def arrays(self):
+    """Return the concatenated rows, columns, weights and reset flags."""
+    return [NP.concatenate(parts) for parts in zip(*self.chunks)]
+
 class MatrixDB(object):
   """ A logical database implemented with sparse matrices """
 
@@ -40,8 +152,31 @@ class MatrixDB(object):
     # mark which matrices are 'parameters' by (functor,arity) pair
     self.paramSet = set()
     self.paramList = []
+    # parameters whose sparsity pattern can grow during learning
+    self.growableSet = set()
+    # paramScale[(functor,arity)] is a factor that the stored matrix
+    # for a parameter must be multiplied by to get its value, so that
+    # scaling a parameter (eg for regularization) is O(1)
+    self._paramScale = {}
+    # paramSumSquares[(functor,arity)], if present, is the sum of the
+    # squares of the stored (unscaled) matrix for a parameter
+    self._paramSumSquares = {}
+    # LRU cache for constant matrices like ones(typeName) - see _constant
+    self._constantCache = collections.OrderedDict()
     # buffers for reading in facts in tab-sep form
     self._databuf = self._rowbuf = self._colbuf = None
+    # pendingUpdates[(functor,arity)] is an _UpdateBuffer holding
+    # incremental changes that have not yet been merged into
+    # matEncoding
+    self._pendingUpdates = {}
+    # version counters, bumped whenever a relation changes, so that
+    # caches which depend on the db can be invalidated
+    self.version = 0
+    self._relationVersion = collections.defaultdict(int)
+    # bumped whenever symbols are renumbered (see permuteSymbols),
+    # which changes cached values that mention symbol ids, eg
+    # one-hot vectors, without changing any relation
+    self.symbolEpoch = 0
     if initSchema is not None:
       self.schema = initSchema
     elif conf.default_to_typed_schema and not conf.ignore_types:
@@ -75,20 +210,29 @@ class MatrixDB(object):
         return self.onehot(OOV_ENTITY_NAME,typeName)
     assert self.schema.hasId(typeName,s),'constant %s (type %s) not in db' % (s,typeName)
     n = self.dim(typeName)
-    i = self.schema.getId(typeName,s)
-    return scipy.sparse.csr_matrix( ([float(1.0)],([0],[i])), shape=(1,n), dtype='float32')
+    def build():
+      i = self.schema.getId(typeName,s)
+      idt = mutil.indexDtype(n)
+      return mutil.csr(NP.ones(1,dtype=mutil.DATA_DTYPE),NP.array([i],dtype=idt),NP.array([0,1],dtype=idt),(1,n),'onehot')
+    return self._constant(('onehot',typeName,s,n),build)
 
   def zeros(self,numRows=1,typeName=None):
     typeName = self._fillDefault(typeName)
     """An all-zeros matrix."""
     n = self.dim(typeName)
-    return scipy.sparse.csr_matrix( ([],([],[])), shape=(numRows,n), dtype='float32')
+    def build():
+      idt = mutil.indexDtype(max(n,numRows))
+      return mutil.csr(NP.zeros(0,dtype=mutil.DATA_DTYPE),NP.zeros(0,dtype=idt),NP.zeros(numRows+1,dtype=idt),(numRows,n),'zeros')
+    return self._constant(('zeros',typeName,numRows,n),build)
 
   def ones(self,typeName=None):
     """An all-ones row matrix."""
     typeName = self._fillDefault(typeName)
     n = self.dim(typeName)
-    return scipy.sparse.csr_matrix( ([float(1.0)]*n,([0]*n,[j for j in range(n)])), shape=(1,n), dtype='float32')
+    def build():
+      idt = mutil.indexDtype(n)
+      return mutil.csr(NP.ones(n,dtype=mutil.DATA_DTYPE),NP.arange(n,dtype=idt),NP.array([0,n],dtype=idt),(1,n),'ones')
+    return self._constant(('ones',typeName,n),build)
 
   def nullMatrix(self,numRows=1,typeName=None,numCols=0):
     """A matrix where every row is a one-hot encoding of the null entity.
@@ -98,11 +242,31 @@ class MatrixDB(object):
     """
     if typeName is None: typeName = THING
     if numCols==0: numCols = self.dim(typeName)
-    nullId = 1
-    return scipy.sparse.csr_matrix( ([float(1.0)]*numRows,
-                                     (list(range(numRows)),[nullId]*numRows)),
-                                    shape=(numRows,numCols),
-                                    dtype='float32' )
+    def build():
+      nullId = 1
+      idt = mutil.indexDtype(max(numRows,numCols))
+      return mutil.csr(NP.ones(numRows,dtype=mutil.DATA_DTYPE),
+                       NP.full(numRows,nullId,dtype=idt),
+                       NP.arange(numRows+1,dtype=idt),
+                       (numRows,numCols),'nullMatrix')
+    return self._constant(('null',numRows,numCols),build)
+
+  def _constant(self,key,build):
+    """Return a cached constant matrix, building it with build() if
+    needed.  The key includes the dimensions of the matrix, and
+    permuteSymbols, the only thing that renumbers symbols, clears the
+    cache, so entries never become stale.  When the cache is full the
+    least recently used entry is evicted.  The matrices are shared, so
+    callers must not modify them.
+    """
+    result = self._constantCache.get(key)
+    if result is None:
+      if len(self._constantCache) >= conf.constant_cache_size:
+        self._constantCache.popitem(last=False)
+      result = self._constantCache[key] = build()
+    else:
+      self._constantCache.move_to_end(key)
+    return result
 
   @staticmethod
   def transposeNeeded(mode,transpose=False):
@@ -114,32 +278,72 @@ class MatrixDB(object):
     leftRight = (mode.isInput(0) and mode.isOutput(1))
     return leftRight == transpose
 
-  def matrix(self,mode,transpose=False):
+  def _encoding(self,key,fold=True):
+    """Return the up-to-date matrix encoding for a (functor,arity) pair,
+    merging pending updates and growing the matrix if new symbols
+    have been added to its types.  If fold is False, the matrix for
+    a parameter is returned without applying its scale factor.
+    """
+    if key in self._paramScale and (fold or key in self._pendingUpdates):
+      self._foldScale(key)
+    if key in self._pendingUpdates:
+      self._mergeUpdates(key)
+      self._paramSumSquares.pop(key,None)
+    m = self.matEncoding[key]
+    shape = self._encodingShape(key)
+    if m.shape!=shape:
+      m = self.matEncoding[key] = MatrixDB._resized(m,shape)
+    return m
+
+  def matrix(self,mode,transpose=False,_fold=True):
     """The matrix associated with this mode - eg if mode is p(i,o) return
     a sparse matrix M_p so that v*M_p is appropriate for forward
     propagation steps from v.  If mode is p(o,i) then return the
     transpose of M_p.
     """
     assert mode.arity==2,'arity of '+str(mode) + ' is wrong: ' + str(mode.arity)
-    assert (mode.functor,mode.arity) in self.matEncoding, \
+    assert self.inDB(mode.functor,mode.arity), \
            "can't find matrix for %s: is this defined in the program or database?" % str(mode)
     if not self.transposeNeeded(mode,transpose):
-      result = self.matEncoding[(mode.functor,mode.arity)]
+      result = self._encoding((mode.functor,mode.arity),fold=_fold)
     else:
-      result = self.matEncoding[(mode.functor,mode.arity)].transpose()
-      result = scipy.sparse.csr_matrix(result,dtype='float32')
+      m = self._encoding((mode.functor,mode.arity),fold=_fold)
+      if mutil.isPatternMatrix(m):
+        result = mutil.transposePattern(m)
+      else:
+        result = mutil.asCSR(m.transpose(),'db.matrix transpose')
       mutil.checkCSR(result,'db.matrix mode %s transpose %s' % (str(mode),str(transpose)))
     return result
 
   def vector(self,mode):
     """Returns a row vector for a unary predicate."""
     assert mode.arity==1, "mode arity for '%s' must be 1" % mode
-    result = self.matEncoding[(mode.functor,mode.arity)]
+    result = self._encoding((mode.functor,mode.arity))
     return result
 
+  def scaledMatrix(self,mode,transpose=False):
+    """Like matrix(mode,transpose) but returns a pair (M,scale), where
+    M*scale is the matrix for the mode.  This avoids multiplying
+    through a scaled parameter - see scaleParameter."""
+    key = (mode.functor,mode.arity)
+    self._encoding(key,fold=False)
+    return self.matrix(mode,transpose,_fold=False),self._paramScale.get(key,1.0)
+
+  def scaledVector(self,mode):
+    """Like vector(mode), but returns a pair (v,scale), where v*scale
+    is the vector for the mode."""
+    assert mode.arity==1, "mode arity for '%s' must be 1" % mode
+    key = (mode.functor,mode.arity)
+    return self._encoding(key,fold=False),self._paramScale.get(key,1.0)
+
   def matrixPreimage(self,mode):
     """The preimage associated with this mode, eg if mode is p(i,o) then
     return a row vector equivalent to 1 * M_p^T."""
+    key = (mode.functor,mode.arity)
+    m = self._encoding(key)
+    if mutil.isPatternMatrix(m):
+      # 1 * M is just the number of non-zeros in each row or column
+      return mutil.patternCounts(m,axis=(1 if self.transposeNeeded(mode,transpose=True) else 0))
     return self.matrixPreimageOnes(mode) * self.matrixPreimageMat(mode)
 
   def matrixPreimageMat(self,mode):
@@ -177,22 +381,264 @@ class MatrixDB(object):
     if (functor,arity) not in self.paramSet:
       self.paramSet.add((functor,arity))
       self.paramList.append((functor,arity))
+      # parameters are updated in place, so they need real weights
+      if (functor,arity) in self.matEncoding:
+        self.matEncoding[(functor,arity)] = mutil.withExplicitWeights(self.matEncoding[(functor,arity)])
 
   def clearParameterMarkings(self):
     """ Clear previously marked parameters"""
     self.paramSet = set()
     self.paramList = []
+    # parameters whose sparsity pattern can grow during learning
+    self.growableSet = set()
+
+  def markAsGrowable(self,functor,arity):
+    """Allow learning to add non-zeros to a parameter.  By default, a
+    parameter is updated in place on its existing sparsity pattern,
+    and gradients for cells outside that pattern are ignored.
+    """
+    assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
+    self.growableSet.add((functor,arity))
+
+  def isGrowable(self,functor,arity):
+    return (functor,arity) in self.growableSet
 
   def getParameter(self,functor,arity):
     assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
-    return self.matEncoding[(functor,arity)]
+    return self._encoding((functor,arity))
+
+  def getScaledParameter(self,functor,arity):
+    """Return a pair (M,scale) such that the value of the parameter is
+    M*scale."""
+    assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
+    return self._encoding((functor,arity),fold=False),self._paramScale.get((functor,arity),1.0)
 
   def parameterIsInitialized(self,functor,arity):
     return (functor,arity) in self.matEncoding
 
-  def setParameter(self,functor,arity,replacement):
-    assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
-    self.matEncoding[(functor,arity)] = replacement
+  def setParameter(self,functor,arity,replacement,scale=1.0,sumSquaresDelta=None):
+    """Replace the value of a parameter with replacement*scale.  If
+    sumSquaresDelta is given, replacement differs from the stored
+    matrix for the parameter (ie the first value returned by
+    getScaledParameter) only in cells whose squares change by a total
+    of sumSquaresDelta, which lets the sum of squares of the parameter
+    be maintained incrementally.
+    """
+    key = (functor,arity)
+    assert key in self.paramSet,'%s/%d not a parameter' % (functor,arity)
+    sumSquares = self._paramSumSquares.pop(key,None)
+    if sumSquares is not None and sumSquaresDelta is not None:
+      self._paramSumSquares[key] = sumSquares + sumSquaresDelta
+    self.matEncoding[key] = replacement
+    if scale!=1.0:
+      self._paramScale[key] = scale
+    else:
+      self._paramScale.pop(key,None)
+    self._pendingUpdates.pop(key,None)
+    self._bumpVersion(key)
+
+  def scaleParameter(self,functor,arity,factor):
+    """Multiply a parameter by a constant factor.  This only changes
+    the parameter's scale factor, which is multiplied into the stored
+    matrix when it falls below conf.min_parameter_scale, or when the
+    value of the parameter is needed."""
+    key = (functor,arity)
+    assert key in self.paramSet,'%s/%d not a parameter' % (functor,arity)
+    self._paramScale[key] = self._paramScale.get(key,1.0) * factor
+    if self._paramScale[key] < conf.min_parameter_scale:
+      self._foldScale(key)
+    self._bumpVersion(key)
+
+  def parameterSquaredNorm(self,functor,arity):
+    """The sum of the squares of the entries of a parameter, which is
+    maintained incrementally when possible."""
+    key = (functor,arity)
+    m,scale = self.getScaledParameter(functor,arity)
+    if key not in self._paramSumSquares:
+      self._paramSumSquares[key] = float(NP.dot(m.data,m.data.astype('float64')))
+    return self._paramSumSquares[key] * scale * scale
+
+  def _foldScale(self,key):
+    scale = self._paramScale.pop(key)
+    # a copy, since other code may hold references to the old matrix
+    self.matEncoding[key] = self.matEncoding[key] * scale
+    if key in self._paramSumSquares:
+      self._paramSumSquares[key] *= scale*scale
+
+  def permuteSymbols(self,typeName,newToOld):
+    """Renumber the symbols of a type, so that the symbol with id
+    newToOld[i] gets id i, and relabel the rows and columns of every
+    relation with arguments of that type to match.  Returns the
+    inverse permutation, which maps old ids to new ones.  Matrices
+    built with the old numbering, eg in datasets, must be relabeled
+    with it too - see mutil.relabel.
+    """
+    typeName = self._fillDefault(typeName)
+    newToOld = NP.asarray(newToOld,dtype=mutil.LONG_INDEX_DTYPE)
+    assert len(newToOld)==self.dim(typeName), 'permutation should have length %d' % self.dim(typeName)
+    oldToNew = NP.empty_like(newToOld)
+    oldToNew[newToOld] = NP.arange(len(newToOld),dtype=mutil.LONG_INDEX_DTYPE)
+    keys = list(self.matEncoding.keys()) + list(self._pendingUpdates.keys())
+    for key in set(keys):
+      (functor,arity) = key
+      m = self._encoding(key)
+      argTypes = [self.schema.getArgType(functor,arity,i) for i in range(arity)]
+      if typeName not in argTypes: continue
+      # the matrix may predate symbols added since, so pad it out to
+      # the current dimension along the permuted axes
+      n = len(newToOld)
+      if arity==1:
+        m = mutil.relabel(m,colMap=oldToNew,shape=(1,n))
+      else:
+        rowMap = oldToNew if argTypes[0]==typeName else None
+        colMap = oldToNew if argTypes[1]==typeName else None
+        shape = (n if rowMap is not None else m.shape[0], n if colMap is not None else m.shape[1])
+        m = mutil.relabel(m,rowMap=rowMap,colMap=colMap,shape=shape)
+      self.matEncoding[key] = m
+      self._bumpVersion(key)
+    self.schema.permuteIds(typeName,newToOld)
+    self._constantCache.clear()
+    self.symbolEpoch += 1
+    self.version += 1
+    return oldToNew
+
+  #
+  # incremental updates
+  #
+
+  def getVersion(self,functor=None,arity=None):
+    """Version number of a relation, or of the whole database if no
+    relation is given.  Version numbers increase whenever the
+    relation (or any relation) is changed.
+    """
+    if functor is None: return self.version
+    return self._relationVersion[(functor,arity)]
+
+  def _bumpVersion(self,key):
+    self.version += 1
+    self._relationVersion[key] = self.version
+
+  def addFacts(self,functor,arity,argTuples,weights=None):
+    """Add facts to a relation without reloading the database.
+    argTuples is a list of argument tuples (or, for unary
+    relations, of symbols) and weights an optional parallel list of
+    weights, which default to 1.0.  Adding a fact which is already
+    present increases its weight, as happens when a fact is
+    repeated in a .cfacts file.  New symbols are added to the
+    schema, so the dimensions of the affected types grow.
+    """
+    self._bufferUpdates('add',functor,arity,argTuples,weights)
+
+  def removeFacts(self,functor,arity,argTuples):
+    """Remove facts from a relation.  Facts that are not present are
+    ignored. """
+    self._bufferUpdates('del',functor,arity,argTuples,None)
+
+  def upsertWeights(self,functor,arity,argTuples,weights):
+    """Set the weights of facts in a relation, inserting the facts that
+    are not already present. """
+    self._bufferUpdates('set',functor,arity,argTuples,weights)
+
+  def flushUpdates(self):
+    """Merge all pending incremental updates into the matrix encodings."""
+    for key in list(self._pendingUpdates.keys()):
+      self._mergeUpdates(key)
+
+  def _bufferUpdates(self,op,functor,arity,argTuples,weights):
+    key = (functor,arity)
+    assert arity in (1,2), 'can only update relations of arity 1 or 2: %s/%d' % key
+    ti = self.schema.getArgType(functor,arity,0)
+    tj = self.schema.getArgType(functor,arity,1) if arity==2 else None
+    assert ti is not None and (tj is not None or arity==1), 'undeclared relation %s/%d' % key
+    if key not in self.matEncoding and key not in self._pendingUpdates:
+      logging.info('creating new relation %s/%d' % key)
+    # deleting a fact never adds its symbols, which get the id 0
+    insert = (op!='del')
+    if arity==1:
+      symbols = [args if isinstance(args,str) else args[0] for args in argTuples]
+      cols = self.schema.getIds(ti,symbols,insert)
+      rows = NP.zeros(cols.size,dtype=NP.int64)
+      present = cols>0
+    else:
+      rows = self.schema.getIds(ti,[args[0] for args in argTuples],insert)
+      cols = self.schema.getIds(tj,[args[1] for args in argTuples],insert)
+      present = (rows>0) & (cols>0)
+    if op=='del':
+      # a deletion sets the weight to zero, which removes the cell
+      rows,cols = rows[present],cols[present]
+      ws = NP.zeros(rows.size,dtype=mutil.DATA_DTYPE)
+    elif weights is None:
+      ws = NP.ones(rows.size,dtype=mutil.DATA_DTYPE)
+    else:
+      ws = NP.asarray(weights,dtype=mutil.DATA_DTYPE)
+    buf = self._pendingUpdates.setdefault(key,_UpdateBuffer())
+    buf.append(rows,cols,ws,op!='add')
+    self._bumpVersion(key)
+    if buf.size>=conf.update_merge_threshold:
+      self._mergeUpdates(key)
+
+  def _encodingShape(self,key):
+    (functor,arity) = key
+    if arity==2:
+      return (self.dim(self.schema.getDomain(functor,arity)), self.dim(self.schema.getRange(functor,arity)))
+    else:
+      return (1, self.dim(self.schema.getDomain(functor,arity)))
+
+  @staticmethod
+  def _resized(m,shape):
+    """Return a copy-free version of m with more rows and/or columns."""
+    (nrows,ncols) = shape
+    assert nrows>=m.shape[0] and ncols>=m.shape[1], 'cannot shrink a relation from %r to %r' % (m.shape,shape)
+    indptr = m.indptr
+    if nrows>m.shape[0]:
+      indptr = NP.concatenate([indptr, NP.full(nrows-m.shape[0],indptr[-1],dtype=indptr.dtype)])
+    return mutil.csr(m.data,m.indices,indptr,shape,'resize')
+
+  def _mergeUpdates(self,key):
+    """Merge the pending updates for a relation into its matrix encoding."""
+    buf = self._pendingUpdates.pop(key)
+    shape = self._encodingShape(key)
+    ncols = shape[1]
+    if key in self.matEncoding:
+      base = self.matEncoding[key]
+      rows = NP.repeat(NP.arange(base.shape[0],dtype=NP.int64),NP.diff(base.indptr))
+      cols = base.indices.astype(NP.int64)
+      data = base.data
+    else:
+      rows = cols = NP.zeros(0,dtype=NP.int64)
+      data = NP.zeros(0,dtype=mutil.DATA_DTYPE)
+    (urows,ucols,ws,reset) = buf.arrays()
+    # group the updates by cell, keeping the order they were made in
+    cellKeys = urows*ncols + ucols
+    order = NP.argsort(cellKeys,kind='stable')
+    (cells,group) = NP.unique(cellKeys[order],return_inverse=True)
+    ws = ws[order]
+    reset = reset[order]
+    # the updates to a cell before its last reset are discarded
+    pos = NP.arange(order.size)
+    lastReset = NP.full(cells.size,-1,dtype=NP.int64)
+    NP.maximum.at(lastReset,group[reset],pos[reset])
+    live = pos>=lastReset[group]
+    sums = NP.bincount(group[live],weights=ws[live],minlength=cells.size)
+    # drop base entries which are overwritten or deleted
+    keep = ~NP.isin(rows*ncols + cols, cells[lastReset>=0])
+    m = mutil.csrFromCOO(
+        NP.concatenate([data[keep], sums]),
+        NP.concatenate([rows[keep], cells//ncols]),
+        NP.concatenate([cols[keep], cells%ncols]),
+        shape,'mergeUpdates')
+    # deletions and zero weights leave explicit zeros
+    m.eliminate_zeros()
+    self.matEncoding[key] = self._compacted(key,m)
+    logging.debug('merged %d updates into %s/%d' % (buf.size,key[0],key[1]))
+
+  def _compacted(self,key,m):
+    """Return the form in which a relation's matrix should be stored,
+    which is a pattern matrix if the relation is unweighted and not a
+    parameter."""
+    if conf.pattern_storage and key not in self.paramSet:
+      return mutil.asPatternMatrix(m)
+    return m
 
   #
   # convert from vectors, matrixes to symbols - for i/o and debugging
@@ -272,13 +718,27 @@ class MatrixDB(object):
   #
 
   def inDB(self,functor,arity):
-    return (functor,arity) in self.matEncoding
+    return (functor,arity) in self.matEncoding or (functor,arity) in self._pendingUpdates
+
+  def relationKeys(self):
+    """Sorted list of the (functor,arity) pairs of the relations in the
+    database, including relations that only have pending updates.
+    Relations of a database loaded with lazy=True are not loaded."""
+    return sorted(set(self.matEncoding.keys()) | set(self._pendingUpdates.keys()))
+
+  def relationMatrix(self,functor,arity):
+    """The up-to-date matrix storing a relation: pending updates are
+    merged, it has the current dimensions of its types, and for a
+    parameter, its scale factor is applied.  Code outside this class
+    should read relations with this, not from matEncoding."""
+    return self._encoding((functor,arity))
 
   def summary(self,functor,arity):
-    m = self.matEncoding[(functor,arity)]
+    m = self._encoding((functor,arity))
     return 'in DB: %s' % mutil.pprintSummary(m)
 
   def listing(self):
+    self.flushUpdates()
     for (functor,arity),m in sorted(self.matEncoding.items()):
       print(('%s/%d: %s' % (functor,arity,self.summary(functor,arity))))
     if not self.isTypeless():
@@ -287,12 +747,29 @@ class MatrixDB(object):
         print(('typing: %s(%s)' % (functor,",".join(typenames))))
 
   def numMatrices(self):
+    self.flushUpdates()
     return len(list(self.matEncoding.keys()))
 
   def size(self):
+    self.flushUpdates()
     return sum([m.nnz for m in list(self.matEncoding.values())])
 
+  def relationBytes(self):
+    """Return a dictionary mapping each (functor,arity) pair to the bytes
+    used by the matrix that stores it.  For a database loaded with
+    lazy=True, relations that haven't been loaded are not read, and
+    are reported at the size they will have once they are."""
+    self.flushUpdates()
+    # dict.items() doesn't load relations of a LazyRelations
+    result = dict((key,mutil.matrixBytes(m)) for (key,m) in dict.items(self.matEncoding))
+    if isinstance(self.matEncoding,LazyRelations):
+      for key in self.matEncoding.keys():
+        if not self.matEncoding.isLoaded(key):
+          result[key] = self.matEncoding.storedBytes(key)
+    return result
+
   def parameterSize(self):
+    self.flushUpdates()
     return sum([m.nnz for  ((fun,arity),m) in list(self.matEncoding.items()) if (fun,arity) in self.paramSet])
 
   def createPartner(self):
@@ -307,17 +784,43 @@ class MatrixDB(object):
   # i/o
   #
 
-  def serialize(self,direc):
+  def serialize(self,direc,perRelation=False):
+    """Save the database in a directory.  If perRelation is True, each
+    relation is stored in its own files, so that the database can be
+    deserialized with lazy=True."""
     if not os.path.exists(direc):
       os.makedirs(direc)
     self.schema.serialize(direc)
-    self.serializeDataTo(os.path.join(direc,"db.mat"))
+    if perRelation:
+      self.serializeRelations(os.path.join(direc,RELATION_DIR))
+    else:
+      self.serializeDataTo(os.path.join(direc,"db.mat"))
+
+  def serializeRelations(self,direc):
+    """Store each relation as raw binary arrays in a directory: for the
+    k-th relation, rk.indices and rk.indptr, and rk.data unless the
+    relation is a pattern matrix.  The relations are listed in an
+    index file."""
+    self.flushUpdates()
+    if not os.path.exists(direc):
+      os.makedirs(direc)
+    with open(os.path.join(direc,RELATION_INDEX_FILE),'w') as fp:
+      for k,key in enumerate(sorted(self.matEncoding.keys())):
+        m = self._encoding(key)
+        isPattern = mutil.isPatternMatrix(m)
+        indexType = mutil.indexDtype(max(m.shape[0],m.shape[1],m.nnz))
+        m.indices.astype(indexType).tofile(os.path.join(direc,'r%d.indices' % k))
+        m.indptr.astype(indexType).tofile(os.path.join(direc,'r%d.indptr' % k))
+        if not isPattern:
+          NP.asarray(m.data,dtype=mutil.DATA_DTYPE).tofile(os.path.join(direc,'r%d.data' % k))
+        fp.write('\t'.join([key[0],str(key[1]),str(k),str(m.shape[0]),str(m.shape[1]),str(m.nnz),str(int(isPattern)),indexType.name]) + '\n')
 
   def serializeDataTo(self,fileLike,filter=None):
     """ Serialize a subset of the data into a file-like object.
     Values of the filter are None (save everything), 'fixed' (save non-parameters)
     or 'params' (save parameters only).
     """
+    self.flushUpdates()
     if filter is None:
       d = self.matEncoding
     elif filter=='params':
@@ -326,6 +829,7 @@ class MatrixDB(object):
       d = dict([(key,m) for (key,m) in list(self.matEncoding.items()) if key not in self.paramSet])
     else:
       assert False,"illegal filter: legal ones are None, 'params', or 'fixed'"
+    d = dict([(key,self._encoding(key)) for key in d])
     self._saveMatDictWithScipy(fileLike,d)
 
   def importSerializedDataFrom(self,fileLike):
@@ -334,7 +838,9 @@ class MatrixDB(object):
     """
     d = MatrixDB._restoreMatDictWithScipy(fileLike)
     for key in d:
-      self.matEncoding[key] = d[key]
+      self.matEncoding[key] = self._compacted(key,d[key])
+      self._paramScale.pop(key,None)
+      self._paramSumSquares.pop(key,None)
 
   @staticmethod
   def deserializeDataFrom(fileLike):
@@ -357,15 +863,30 @@ class MatrixDB(object):
     for stringKey,mat in list(d.items()):
       del d[stringKey]
       if not stringKey.startswith('__'):
-        d[eval(stringKey)] = scipy.sparse.csr_matrix(mat,dtype='float32')
+        d[eval(stringKey)] = mutil.asCSR(scipy.sparse.csr_matrix(mat),'restoreMatDict')
     return d
 
   @staticmethod
-  def deserialize(direc):
+  def deserialize(direc,lazy=False):
+    """Restore a database saved with serialize.  If it was saved with
+    perRelation=True and lazy is True, each relation is only read
+    from disk when it is first used."""
     logging.info('deserializing database from %s' % direc)
     db = MatrixDB()
     db.schema = dbschema.AbstractSchema.deserialize(direc)
-    db.matEncoding = db._restoreMatDictWithScipy(os.path.join(direc,"db.mat"))
+    relationDir = os.path.join(direc,RELATION_DIR)
+    if os.path.exists(os.path.join(relationDir,RELATION_INDEX_FILE)):
+      db.matEncoding = LazyRelations(relationDir)
+      if lazy:
+        logging.info('deserialized database has %d relations, which will be loaded when used' % len(db.matEncoding))
+        db.checkTyping()
+        return db
+      db.matEncoding = dict(db.matEncoding.items())
+    else:
+      assert not lazy, 'lazy loading needs a database serialized with perRelation=True'
+      db.matEncoding = db._restoreMatDictWithScipy(os.path.join(direc,"db.mat"))
+      for key in list(db.matEncoding.keys()):
+        db.matEncoding[key] = db._compacted(key,db.matEncoding[key])
     logging.info('deserialized database has %d relations and %d non-zeros' % (db.numMatrices(),db.size()))
     db.checkTyping()
     return db
@@ -418,6 +939,10 @@ class MatrixDB(object):
     self._databuf = collections.defaultdict(list)
     self._rowbuf = collections.defaultdict(list)
     self._colbuf = collections.defaultdict(list)
+    # facts for relations that are already encoded, which are added
+    # as one incremental update per relation when the buffers are
+    # flushed
+    self._updatebuf = collections.defaultdict(list)
 
   def bufferFile(self,filename):
     """Load triples from a file and buffer them internally."""
@@ -431,6 +956,8 @@ class MatrixDB(object):
     """Flush all triples from the buffer."""
     for f,arity in list(self._databuf.keys()):
       self._flushBuffer(f,arity)
+    for (f,arity),facts in list(self._updatebuf.items()):
+      self.addFacts(f,arity,[args for (args,w) in facts],[w for (args,w) in facts])
     self._databuf = None
     self.startBuffers()
 
@@ -445,15 +972,16 @@ class MatrixDB(object):
     else:
       nrows = 1
       ncols = self.schema.getMaxId(self.schema.getDomain(functor,arity)) + 1
-    coo_matrix = scipy.sparse.coo_matrix((self._databuf[key],(self._rowbuf[key],self._colbuf[key])), shape=(nrows,ncols))
-    self.matEncoding[key] = scipy.sparse.csr_matrix(coo_matrix,dtype='float32')
-    self.matEncoding[key].sort_indices()
+    m = mutil.csrFromCOO(self._databuf[key],self._rowbuf[key],self._colbuf[key],(nrows,ncols),'flushBuffer')
+    self.matEncoding[key] = self._compacted(key,m)
     mutil.checkCSR(self.matEncoding[key], 'flushBuffer %s/%d' % key)
 
   def _bufferTriplet(self,functor,arity,a1,a2,w,filename,k):
     key = (functor,arity)
     if (key in self.matEncoding):
-      logging.error("predicate encoding is already completed for "+str(key)+ " at line: "+line)
+      # the relation has already been encoded, so treat this as an
+      # incremental update
+      self._updatebuf[key].append(((a1,a2) if arity==2 else a1,w))
       return
     ti = self.schema.getArgType(functor,arity,0)
     tj = self.schema.getArgType(functor,arity,1)
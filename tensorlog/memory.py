@@ -0,0 +1,69 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# memory accounting for messages computed during evaluation, and a
+# memory budget: when it is set, Program.eval, Learner.predict and
+# Learner.crossEntropyGrad split inputs with many rows into chunks of
+# rows whose messages fit in the budget, and restack the results.
+#
+# The memory needed per row is estimated by evaluating the first
+# conf.probe_rows rows and measuring the messages they produce.
+
+import logging
+
+import numpy as NP
+
+from tensorlog import config
+from tensorlog import mutil
+
+conf = config.Config()
+conf.budget = 0;          conf.help.budget = 'Bytes allowed for the messages computed for one input matrix, or 0 for no limit'
+conf.probe_rows = 100;    conf.help.probe_rows = 'Number of rows evaluated first to estimate the bytes used per row'
+
+def matrixBytes(m):
+  """Memory used by a message, which may be sparse or dense."""
+  if isinstance(m,NP.ndarray):
+    return m.nbytes
+  return mutil.matrixBytes(m)
+
+def messageBytes(pad):
+  """Return a dictionary mapping the id of each op or function that
+  was evaluated with the scratchpad to the bytes used by its output
+  message and, after backprop, the delta passed back through it."""
+  result = {}
+  for id,slot in list(pad.d.items()):
+    total = 0
+    for attr in ['output','delta']:
+      m = getattr(slot,attr,None)
+      if m is not None and not NP.isscalar(m): total += matrixBytes(m)
+    result[id] = total
+  return result
+
+def padBytes(pad):
+  """Total bytes of the messages stored in a scratchpad."""
+  return sum(messageBytes(pad).values())
+
+def needsChunking(numRows,budget=None):
+  """True if an input with this many rows should be evaluated in
+  chunks."""
+  budget = conf.budget if budget is None else budget
+  return budget>0 and numRows>conf.probe_rows
+
+def evalInChunks(evalRows,numRows,budget=None):
+  """Evaluate an input with numRows rows in chunks, where
+  evalRows(lo,hi) evaluates rows lo,...,hi-1 and returns a pair
+  (result,bytes), bytes being the memory used by the messages it
+  computed.  The first chunk has conf.probe_rows rows, and is used to
+  pick the size of the others.  Returns the list of results."""
+  budget = conf.budget if budget is None else budget
+  probe = min(numRows,conf.probe_rows)
+  result,used = evalRows(0,probe)
+  results = [result]
+  bytesPerRow = max(1.0,float(used)/probe)
+  rowsPerChunk = max(1,int(budget/bytesPerRow))
+  if probe<numRows:
+    logging.info('evaluating %d rows in chunks of %d: %.0f bytes per row, budget %d bytes'
+                 % (numRows,rowsPerChunk,bytesPerRow,budget))
+  for lo in range(probe,numRows,rowsPerChunk):
+    result,used = evalRows(lo,min(numRows,lo+rowsPerChunk))
+    results.append(result)
+  return results
@@ -0,0 +1,246 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# mine plausible rules from the binary relations of a database, and
+# write them as a ProPPR program.  This computes the same rules and
+# scores as helper/minerules.py, but with sparse matrix operations
+# instead of GuineaPig joins.  Usage:
+#
+#  python -m tensorlog.minerules --db foo.cfacts|foo.db --out rules.ppr [--parallel k] [--minSupport n] [--maxChainPaths n]
+#
+# Three kinds of rules are mined, where n(...) is the number of pairs
+# (X,Y) for which something holds:
+#
+#  p(X,Y) :- q(X,Y) {if_p_q}                scored log n(p and q)/n(q)
+#  p(X,Y) :- q(Y,X) {ifInv_p_q}             scored log n(p and q^T)/n(q)
+#  p(X,Y) :- q(X,Z),r(Z,Y) {chain_p_q_r}    scored log n(p and qr)/#paths(qr)
+#
+# For a pair q,r of relations, n(p and qr) is computed for all p at
+# once, by looking up the non-zero cells of M_q M_r in a sorted index
+# of the cells of all relations.
+
+import getopt
+import logging
+import math
+import multiprocessing
+import multiprocessing.pool
+import sys
+import time
+
+import numpy as NP
+import scipy.sparse as SS
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import declare
+from tensorlog import mutil
+
+conf = config.Config()
+conf.min_support = 1;               conf.help.min_support = 'Only output rules supported by at least this many pairs'
+conf.max_chain_paths = 100000000;   conf.help.max_chain_paths = 'Skip chains q(X,Z),r(Z,Y) with more than this many paths, to bound memory'
+
+ENTAILMENT = 'if'
+INVERSION = 'ifInv'
+CHAIN = 'chain'
+
+class RuleMiner(object):
+  """Mines rules from the binary relations of a database.  Relations
+  are binarized, so weights are ignored."""
+
+  def __init__(self,db,minSupport=None,maxChainPaths=None):
+    self.minSupport = conf.min_support if minSupport is None else minSupport
+    self.maxChainPaths = conf.max_chain_paths if maxChainPaths is None else maxChainPaths
+    self.functors = [f for (f,a) in db.relationKeys() if a==2]
+    self.relId = dict((f,i) for i,f in enumerate(self.functors))
+    self.types = dict((f,(db.schema.getDomain(f,2),db.schema.getRange(f,2))) for f in self.functors)
+    self.pattern = {}
+    for f in self.functors:
+      m = db.matrix(declare.asMode('%s(i,o)' % f))
+      if not NP.all(m.data!=0):
+        m = m.copy()
+        m.eliminate_zeros()
+      self.pattern[f] = mutil.csr(NP.ones(m.nnz),m.indices,m.indptr,m.shape,'RuleMiner')
+    self.nnz = NP.array([self.pattern[f].nnz for f in self.functors])
+    self._buildIndex()
+    self._buildRowCounts()
+    self._buildStacks()
+
+  def _buildIndex(self):
+    """For each pair of types, a sorted array of the cell keys of all
+    relations with those types that could have enough support, and
+    the relation that each key belongs to."""
+    keys = {}
+    rels = {}
+    for f in self.functors:
+      if self.pattern[f].nnz < self.minSupport: continue
+      keys.setdefault(self.types[f],[]).append(mutil.cellKeys(self.pattern[f]))
+      rels.setdefault(self.types[f],[]).append(NP.full(self.pattern[f].nnz,self.relId[f]))
+    self._index = {}
+    for typePair in keys:
+      allKeys = NP.concatenate(keys[typePair])
+      allRels = NP.concatenate(rels[typePair])
+      order = NP.argsort(allKeys,kind='stable')
+      self._index[typePair] = (allKeys[order],allRels[order])
+
+  def _buildRowCounts(self):
+    """For each type, a matrix with a row for each relation whose domain
+    has that type, holding the number of non-zeros in each row of the
+    relation.  Multiplying by the column counts of q gives the number
+    of paths q(X,Z),r(Z,Y) for every r at once."""
+    self._rowCounts = {}
+    for domType in set(d for (d,r) in self.types.values()):
+      fs = [f for f in self.functors if self.types[f][0]==domType]
+      counts = [NP.diff(self.pattern[f].indptr) for f in fs]
+      self._rowCounts[domType] = (fs,SS.csr_matrix(NP.vstack(counts).astype(NP.float64)))
+
+  def _buildStacks(self):
+    """For each pair of types, the relations with those types, and
+    their matrices side by side in one matrix, so that a relation q
+    can be multiplied by all of them with one sparse product."""
+    stacks = {}
+    for f in self.functors:
+      stacks.setdefault(self.types[f],[]).append(f)
+    self._stacks = {}
+    for typePair,fs in list(stacks.items()):
+      self._stacks[typePair] = (fs,mutil.asCSR(SS.hstack([self.pattern[f] for f in fs],format='csr'),'RuleMiner'))
+
+  def _matches(self,typePair,keys):
+    """For cell keys of a matrix with the given types, return arrays
+    (k,rel) listing each key position k that is a non-zero of
+    relation number rel."""
+    if typePair not in self._index or len(keys)==0:
+      return NP.zeros(0,dtype=NP.int64),NP.zeros(0,dtype=NP.int64)
+    allKeys,allRels = self._index[typePair]
+    lo = NP.searchsorted(allKeys,keys,side='left')
+    hi = NP.searchsorted(allKeys,keys,side='right')
+    lens = hi - lo
+    # positions lo[k],...,lo[k]+lens[k]-1 for each key k
+    offsets = NP.cumsum(lens) - lens
+    positions = NP.repeat(lo - offsets,lens) + NP.arange(lens.sum())
+    return NP.repeat(NP.arange(len(keys)),lens),allRels[positions]
+
+  def _support(self,typePair,m):
+    """Return an array giving, for each relation, the number of
+    non-zero cells of m that are also non-zero in that relation."""
+    if m.nnz==0: return NP.zeros(len(self.functors),dtype=NP.int64)
+    _,rels = self._matches(typePair,mutil.cellKeys(mutil.asCSR(m,'support')))
+    return NP.bincount(rels,minlength=len(self.functors))
+
+  def mine(self,q):
+    """Return a list of rules with q as the first body goal, as tuples
+    (kind,p,q,r,support,count), where r is None for entailments and
+    inversions, and the score of the rule is log(support/count)."""
+    result = []
+    mq = self.pattern[q]
+    nq = mq.nnz
+    if nq==0: return result
+    (domq,rngq) = self.types[q]
+    # entailments p(X,Y):-q(X,Y)
+    support = self._support((domq,rngq),mq)
+    for i in NP.flatnonzero(support>=self.minSupport):
+      if self.functors[i]!=q:
+        result.append((ENTAILMENT,self.functors[i],q,None,support[i],nq))
+    # inversions p(X,Y):-q(Y,X)
+    support = self._support((rngq,domq),mq.transpose())
+    for i in NP.flatnonzero(support>=self.minSupport):
+      result.append((INVERSION,self.functors[i],q,None,support[i],nq))
+    # chains p(X,Y):-q(X,Z),r(Z,Y)
+    if rngq in self._rowCounts:
+      fs,rowCounts = self._rowCounts[rngq]
+      colCounts = NP.bincount(mq.indices,minlength=rowCounts.shape[1])
+      numPaths = dict(zip(fs,rowCounts.dot(colCounts.astype(NP.float64))))
+      for (domr,rngr),(rs,stack) in sorted(self._stacks.items()):
+        if domr!=rngq: continue
+        total = sum(numPaths[r] for r in rs)
+        if total==0: continue
+        if total<=self.maxChainPaths:
+          support = self._chainSupport(domq,rngr,mq*stack,len(rs))
+        else:
+          # one r at a time, skipping the r's with too many paths
+          support = NP.zeros((len(rs),len(self.functors)),dtype=NP.int64)
+          for k,r in enumerate(rs):
+            if numPaths[r]>self.maxChainPaths:
+              logging.warn('skipping chain %s,%s with %d paths' % (q,r,numPaths[r]))
+            elif numPaths[r]>=self.minSupport:
+              support[k] = self._support((domq,rngr),mq*self.pattern[r])
+        for k,i in zip(*NP.nonzero(support>=self.minSupport)):
+          result.append((CHAIN,self.functors[i],q,rs[k],support[k,i],int(numPaths[rs[k]])))
+    return result
+
+  def _chainSupport(self,domq,rngr,products,numBlocks):
+    """Given the product of q with the side-by-side matrices of
+    numBlocks relations r, return a numBlocks-by-numRelations array
+    with the support of each chain p(X,Y):-q(X,Z),r(Z,Y)."""
+    products = mutil.asCSR(products,'chainSupport')
+    if not products.has_sorted_indices: products.sort_indices()
+    width = mutil.numCols(products)//numBlocks
+    blocks = products.indices // width
+    keys = mutil.rowIndices(products)*width + products.indices % width
+    # keys are sorted within each block, but not across blocks
+    k,rels = self._matches((domq,rngr),keys)
+    counts = NP.bincount(blocks[k]*len(self.functors) + rels,minlength=numBlocks*len(self.functors))
+    return counts.reshape(numBlocks,len(self.functors))
+
+def asRule(minedRule):
+  """Convert a tuple returned by RuleMiner.mine to a line of a ProPPR
+  program."""
+  (kind,p,q,r,support,count) = minedRule
+  score = math.log(support/float(count))
+  if kind==ENTAILMENT:
+    return '%s(X,Y):-%s(X,Y) {if_%s_%s}.\t#score %.3f' % (p,q,p,q,score)
+  elif kind==INVERSION:
+    return '%s(X,Y):-%s(Y,X) {ifInv_%s_%s}.\t#score %.3f' % (p,q,p,q,score)
+  else:
+    return '%s(X,Y):-%s(X,Z),%s(Z,Y) {chain_%s_%s_%s}.\t#score %.3f' % (p,q,r,p,q,r,score)
+
+##############################################################################
+# These functions are defined at the top-level of the module so that
+# they can be sent to worker processes via pickling - see plearn.py
+##############################################################################
+
+def _initWorker(db,minSupport,maxChainPaths):
+  global workerMiner
+  workerMiner = RuleMiner(db,minSupport,maxChainPaths)
+
+def _doMineTask(q):
+  return workerMiner.mine(q)
+
+def mineRules(db,parallel=1,minSupport=None,maxChainPaths=None):
+  """Mine rules from a database, with a pool of parallel worker
+  processes if parallel>1, and return them as ProPPR rule strings,
+  with entailments first, then inversions, then chains."""
+  miner = RuleMiner(db,minSupport,maxChainPaths)
+  if parallel>1:
+    pool = multiprocessing.pool.Pool(parallel,initializer=_initWorker,initargs=(db,minSupport,maxChainPaths))
+    mined = pool.map(_doMineTask,miner.functors,chunksize=1)
+    pool.close()
+    pool.join()
+  else:
+    mined = [miner.mine(q) for q in miner.functors]
+  allRules = [rule for rules in mined for rule in rules]
+  kindOrder = {ENTAILMENT:0,INVERSION:1,CHAIN:2}
+  allRules.sort(key=lambda rule:(kindOrder[rule[0]],rule[1],rule[2],rule[3] or ''))
+  return [asRule(rule) for rule in allRules]
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.minerules --db dbspec --out rules.ppr [--parallel k] [--minSupport n] [--maxChainPaths n]')
+  argspec = ["db=","out=","parallel=","minSupport=","maxChainPaths="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if '--db' not in optdict or '--out' not in optdict:
+    usage()
+    sys.exit(-1)
+  db = comline.parseDBSpec(optdict['--db'])
+  start = time.time()
+  rules = mineRules(db,
+                    parallel=int(optdict.get('--parallel',multiprocessing.cpu_count())),
+                    minSupport=(int(optdict['--minSupport']) if '--minSupport' in optdict else None),
+                    maxChainPaths=(int(optdict['--maxChainPaths']) if '--maxChainPaths' in optdict else None))
+  with open(optdict['--out'],'w') as fp:
+    for rule in rules:
+      fp.write(rule + '\n')
+  print('mined %d rules in %.1f sec' % (len(rules),time.time()-start))
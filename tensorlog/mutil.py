@@ -9,6 +9,8 @@ import numpy as NP
 import numpy.random as NR
 import math
 import logging
+import collections
+import contextlib
 
 from tensorlog import config
 
@@ -50,6 +52,118 @@ def checkNoNANs(mat,context='unknown'):
         checkCSR(mat)
         assert not NP.any(NP.isnan(mat.data)), 'nan\'s found: %s' % context
 
+#
+# dtype policy: every CSR matrix built by tensorlog holds float32 data
+# and, whenever the dimensions allow it, int32 indices.  All CSR
+# constructors should go through csr(), csrFromCOO() or asCSR(), which
+# reuse the arrays they are given when no conversion is needed.
+#
+
+DATA_DTYPE = NP.dtype('float32')
+INDEX_DTYPE = NP.dtype('int32')
+LONG_INDEX_DTYPE = NP.dtype('int64')
+
+class CopyTracker(object):
+    """Records the conversions of existing numpy arrays performed by the
+    dtype policy functions, indexed by context.  If strict is True an
+    unexpected conversion raises an error, so tests can check that a
+    hot path never silently copies or upcasts.
+    """
+    def __init__(self,strict=False):
+        self.strict = strict
+        self.copies = collections.Counter()
+    def total(self):
+        return sum(self.copies.values())
+    def record(self,context):
+        self.copies[context] += 1
+        assert not self.strict, 'unexpected array copy [context %s]' % context
+
+_copyTrackers = []
+
+@contextlib.contextmanager
+def trackCopies(strict=False):
+    """Context manager that yields a CopyTracker that sees every array
+    conversion done by the dtype policy while the context is active."""
+    tracker = CopyTracker(strict=strict)
+    _copyTrackers.append(tracker)
+    try:
+        yield tracker
+    finally:
+        _copyTrackers.remove(tracker)
+
+def _noteCopy(context):
+    for tracker in _copyTrackers:
+        tracker.record(context)
+
+def indexDtype(maxValue):
+    """The index dtype to use for arrays holding values up to maxValue."""
+    return INDEX_DTYPE if maxValue <= NP.iinfo(INDEX_DTYPE).max else LONG_INDEX_DTYPE
+
+def asDataArray(a,context='unknown'):
+    """Return a as a float32 array, without copying if it already is one."""
+    if isinstance(a,NP.ndarray):
+        if a.dtype==DATA_DTYPE: return a
+        _noteCopy(context)
+    return NP.asarray(a,dtype=DATA_DTYPE)
+
+def asIndexArray(a,maxValue,context='unknown'):
+    """Return a as an index array that can hold values up to maxValue,
+    without copying if it already has an appropriate dtype."""
+    if isinstance(a,NP.ndarray):
+        if a.dtype==INDEX_DTYPE or (a.dtype==LONG_INDEX_DTYPE and maxValue>NP.iinfo(INDEX_DTYPE).max):
+            return a
+        _noteCopy(context)
+    return NP.asarray(a,dtype=indexDtype(maxValue))
+
+def csr(data,indices,indptr,shape,context='unknown'):
+    """Build a CSR matrix from its component arrays, following the dtype
+    policy.  The arrays are shared with the result, not copied, if
+    they already have the right dtypes."""
+    maxValue = max(shape[0],shape[1],len(indices))
+    return SS.csr_matrix(
+        (asDataArray(data,context),asIndexArray(indices,maxValue,context),asIndexArray(indptr,maxValue,context)),
+        shape=shape, copy=False)
+
+def asCSR(m,context='unknown'):
+    """Return m as a CSR matrix that follows the dtype policy.  If m
+    already does, it is returned unchanged."""
+    if not isinstance(m,SS.csr_matrix):
+        _noteCopy(context)
+        m = m.tocsr()
+    elif m.data.dtype==DATA_DTYPE and m.indices.dtype==m.indptr.dtype==INDEX_DTYPE:
+        return m
+    return csr(m.data,m.indices,m.indptr,m.shape,context)
+
+def csrFromCOO(data,rows,cols,shape,context='unknown'):
+    """Build a CSR matrix from coordinate-format triples, summing
+    duplicate entries, without building an intermediate coo_matrix.
+    Indices within each row are sorted."""
+    data = asDataArray(data,context)
+    rows = NP.asarray(rows)
+    cols = NP.asarray(cols)
+    (numRows,numCols) = shape
+    if rows.size:
+        order = NP.lexsort((cols,rows))
+        rows = rows[order]
+        cols = cols[order]
+        data = data[order]
+        # merge duplicate (row,col) pairs
+        isNew = NP.empty(rows.size,dtype=bool)
+        isNew[0] = True
+        NP.logical_or(rows[1:]!=rows[:-1], cols[1:]!=cols[:-1], out=isNew[1:])
+        if not isNew.all():
+            starts = NP.flatnonzero(isNew)
+            data = NP.add.reduceat(data,starts)
+            rows = rows[starts]
+            cols = cols[starts]
+    maxValue = max(numRows,numCols,rows.size)
+    counts = NP.bincount(rows,minlength=numRows) if rows.size else NP.zeros(numRows,dtype=indexDtype(maxValue))
+    indptr = NP.zeros(numRows+1,dtype=indexDtype(maxValue))
+    # the cumulative sum below would wrap around silently
+    assert rows.size <= NP.iinfo(indptr.dtype).max,'%s: %d non-zeros overflow %s indices' % (context,rows.size,indptr.dtype)
+    NP.cumsum(counts,out=indptr[1:])
+    return SS.csr_matrix((data,NP.asarray(cols,dtype=indexDtype(maxValue)),indptr),shape=shape,copy=False)
+
 def maxValue(mat):
     try:
         return NP.max(mat.data)
@@ -76,7 +190,7 @@ def densify(mat,maxExpandFactor=-1,maxExpandIntercept=-1):
         return None,None
     else:
         newShape = (numRows(mat),hiIndex-loIndex+1)
-        D = SS.csr_matrix((mat.data,mat.indices-loIndex,mat.indptr),shape=newShape,dtype='float32').todense()
+        D = csr(mat.data,mat.indices-loIndex,mat.indptr,newShape,'densify').todense()
         return D,(loIndex,numCols(mat))
 
 def denseSize(m,loIndex,hiIndex):
@@ -102,22 +216,25 @@ def codensify(m1,m2,maxExpandFactor=-1,maxExpandIntercept=-1):
         return None,None,None
     newShape1 = (numRows(m1),hiIndex-loIndex+1)
     newShape2 = (numRows(m2),hiIndex-loIndex+1)
-    D1 = SS.csr_matrix((m1.data,m1.indices-loIndex,m1.indptr),shape=newShape1,dtype='float32').todense()
-    D2 = SS.csr_matrix((m2.data,m2.indices-loIndex,m2.indptr),shape=newShape2,dtype='float32').todense()
+    D1 = csr(m1.data,m1.indices-loIndex,m1.indptr,newShape1,'codensify').todense()
+    D2 = csr(m2.data,m2.indices-loIndex,m2.indptr,newShape2,'codensify').todense()
     return D1,D2,(loIndex,numCols(m1))
 
 def undensify(denseMat, info):
     loIndex,numCols = info
     (numRows,_) = denseMat.shape
-    tmp = SS.csr_matrix(denseMat)
-    result = SS.csr_matrix((tmp.data,tmp.indices+loIndex,tmp.indptr),shape=(numRows,numCols),dtype='float32')
-    result.eliminate_zeros()
-    return result
+    denseMat = NP.asarray(denseMat)
+    # read off the non-zeros in row-major order, which is already CSR order
+    rows,cols = NP.nonzero(denseMat)
+    maxValue = max(numRows,numCols,rows.size)
+    indptr = NP.zeros(numRows+1,dtype=indexDtype(maxValue))
+    NP.cumsum(NP.bincount(rows,minlength=numRows),out=indptr[1:])
+    return csr(denseMat[rows,cols],(cols+loIndex).astype(indexDtype(maxValue)),indptr,(numRows,numCols),'undensify')
 
 def mean(mat):
     """Return the average of the rows in a matrix."""
     checkCSR(mat)
-    return SS.csr_matrix(mat.mean(axis=0))
+    return asCSR(SS.csr_matrix(mat.mean(axis=0)),'mean')
 #    r = numRows(mat)
 #    return rowsum(mat) * (1.0/r)
 
@@ -142,22 +259,43 @@ def rowsum(mat):
         return undensify(denseMat.sum(0), undensifier)
     else:
         ndense = mat.data.shape[0]
-        indptr2 = NP.arange(0,ndense+1)
-        m2 = SS.csr_matrix((mat.data,mat.indices,indptr2),(ndense,numCols(mat)))
-        sparseOnes = SS.csr_matrix((NP.ones(ndense),NP.arange(0,ndense),NP.array([0,ndense])), (1,ndense), dtype='float32')
+        idt = indexDtype(max(ndense,numCols(mat)))
+        indptr2 = NP.arange(0,ndense+1,dtype=idt)
+        m2 = csr(mat.data,mat.indices,indptr2,(ndense,numCols(mat)),'rowsum')
+        sparseOnes = csr(NP.ones(ndense,dtype=DATA_DTYPE),NP.arange(0,ndense,dtype=idt),NP.array([0,ndense],dtype=idt),(1,ndense),'rowsum')
         rowSum = sparseOnes.dot(m2)
-        return rowSum
+        return asCSR(rowSum,'rowsum')
 
 def mapData(dataFun,mat):
     """Apply some function to the mat.data array of the sparse matrix and return a new one."""
     checkCSR(mat)
     newdata = dataFun(mat.data)
-    return SS.csr_matrix((newdata,mat.indices,mat.indptr), shape=mat.shape, dtype='float32')
+    return csr(newdata,mat.indices,mat.indptr,mat.shape,'mapData')
 
 def stack(mats):
     """Vertically stack matrices and return a sparse csr matrix."""
     for m in mats: checkCSR(m)
-    return SS.csr_matrix(SS.vstack(mats, dtype='float32'))
+    assert mats, 'cannot stack an empty list of matrices'
+    n = numCols(mats[0])
+    for m in mats:
+        assert numCols(m)==n, 'cannot stack matrices with %d and %d columns' % (n,numCols(m))
+    # concatenate the CSR arrays directly, shifting each indptr by the
+    # number of non-zeros that precede it
+    nnz = sum(m.nnz for m in mats)
+    numRows = sum(m.shape[0] for m in mats)
+    idt = indexDtype(max(numRows,n,nnz))
+    data = NP.concatenate([asDataArray(m.data,'stack') for m in mats])
+    indices = NP.concatenate([m.indices[m.indptr[0]:m.indptr[-1]] for m in mats]).astype(idt,copy=False)
+    indptr = NP.empty(numRows+1,dtype=idt)
+    indptr[0] = 0
+    r = 0
+    offset = 0
+    for m in mats:
+        k = m.shape[0]
+        indptr[r+1:r+k+1] = m.indptr[1:] - m.indptr[0] + offset
+        r += k
+        offset += m.nnz
+    return csr(data,indices,indptr,(numRows,n),'stack')
 
 def numRows(m):
     """Number of rows in matrix"""
@@ -184,11 +322,8 @@ def repeat(row,n):
     inds = NP.tile(row.indices,n)
     #create the indptr
     numNZCols = row.indptr[1]
-    if numNZCols>0:
-        ptrs = NP.array(range(0,numNZCols*n+1,numNZCols))
-    else:
-        ptrs = NP.zeros(n+1, dtype='int')
-    return SS.csr_matrix((d,inds,ptrs),shape=(n,numCols(row)), dtype='float32')
+    ptrs = NP.arange(n+1,dtype=indexDtype(numNZCols*n)) * numNZCols
+    return csr(d,inds,ptrs,(n,numCols(row)),'repeat')
 
 
 def alterMatrixRows(mat,alterationFun):
@@ -200,26 +335,69 @@ def alterMatrixRows(mat,alterationFun):
 def softmax(db,mat):
     """ Compute the softmax of each row of a matrix.
     """
+    return softmaxCrossEntropy(db,mat)[0]
+
+def softmaxCrossEntropy(db,mat,Y=None):
+    """Compute the row-wise softmax P of a matrix of unnormalized scores
+    and, if labels Y are given, the cross-entropy loss of each row
+    and the initial delta Y-P used in backprop, which is the
+    derivative of the loss of softmax followed by cross-entropy.
+    Returns a triple (P,rowLoss,delta), where rowLoss and delta are
+    None if Y is None.
+
+    Every row is smoothed by including the null entity with a score
+    of -10 (added to any score it already has), so all rows are
+    non-empty.  Entries that underflow are replaced with exp(-10).
+    Only the entries of Y in the support of P contribute to the loss.
+    """
     nullEpsilon = -10  # scores for null entity will be exp(nullMatrix)
-    result = db.nullMatrix(numRows(mat),numCols=numCols(mat))*nullEpsilon + mat
-    denseResult,undensifier = densify(result)
-    if type(denseResult)!=NONETYPE:
-        return undensify(denseSoftmax(denseResult), undensifier)
-    else:
-        def softMaxAlteration(data,lo,hi,unused):
-            rowMax = max(data[lo:hi])
-            assert not math.isnan(rowMax),"softMaxAlteration: NaN rowMax"
-            data[lo:hi] = NP.exp(data[lo:hi] - rowMax)
-            rowNorm = sum(data[lo:hi])
-            assert not math.isnan(rowNorm),"softMaxAlteration: NaN rowNorm"
-            data[lo:hi] /= rowNorm
-            #replace the zeros in data, which are underflow, with something small
-            minValue = math.exp(nullEpsilon)
-            segment = data[lo:hi]
-            segment[segment==0] = minValue
-            data[lo:hi] = segment
-        alterMatrixRows(result,softMaxAlteration)
-        return result
+    nullId = 1         # see MatrixDB.nullMatrix
+    checkCSR(mat,'softmax input')
+    mat = withSortedIndices(mat)
+    n = numRows(mat)
+    ncols = numCols(mat)
+    # splice the null entity into each row
+    keys = cellKeys(mat)
+    nullKeys = NP.arange(n,dtype=LONG_INDEX_DTYPE)*ncols + nullId
+    nullPositions = NP.searchsorted(keys,nullKeys)
+    present = nullPositions < len(keys)
+    present[present] = keys[nullPositions[present]]==nullKeys[present]
+    data = asDataArray(mat.data,'softmax').copy()
+    data[nullPositions[present]] += nullEpsilon
+    missing = ~present
+    data = NP.insert(data,nullPositions[missing],nullEpsilon)
+    indices = NP.insert(mat.indices,nullPositions[missing],nullId)
+    counts = NP.diff(mat.indptr) + missing
+    idt = indexDtype(max(n,ncols,len(data)))
+    indptr = NP.zeros(n+1,dtype=idt)
+    NP.cumsum(counts,out=indptr[1:])
+    # row-wise softmax, in place on data
+    starts = indptr[:-1]
+    rowMax = NP.maximum.reduceat(data,starts)
+    assert not NP.isnan(rowMax).any(),"softmax: NaN rowMax"
+    data -= NP.repeat(rowMax,counts)
+    NP.exp(data,out=data)
+    rowNorm = NP.add.reduceat(data,starts)
+    assert not NP.isnan(rowNorm).any(),"softmax: NaN rowNorm"
+    data /= NP.repeat(rowNorm,counts)
+    #replace the zeros in data, which are underflow, with something small
+    data[data==0] = math.exp(nullEpsilon)
+    P = csr(data,indices.astype(idt,copy=False),indptr,mat.shape,'softmax')
+    if Y is None:
+        return P,None,None
+    # align the labels with the entries of P
+    checkCSR(Y,'softmax labels')
+    assert Y.shape==P.shape, 'shape mismatch %r vs %r' % (Y.shape,P.shape)
+    Y = withSortedIndices(Y)
+    yRows = rowIndices(Y)
+    yPositions = keyPositions(cellKeys(P),yRows*ncols + Y.indices)
+    found = yPositions>=0
+    rowLoss = -NP.bincount(yRows[found],weights=Y.data[found]*NP.log(data[yPositions[found]]),minlength=n)
+    # delta = Y - P, on the union of the two patterns
+    delta,_ = unionPattern(P,Y)
+    NP.negative(delta.data,out=delta.data)
+    delta.data[keyPositions(cellKeys(delta),yRows*ncols + Y.indices)] += Y.data
+    return P,rowLoss,delta
 
 def denseSoftmax(m):
     #we want to make sure we keep the zero entries as zero
@@ -285,46 +463,228 @@ def shuffleRows(m,shuffledRowNums=None):
     if type(shuffledRowNums)==NONETYPE:
         shuffledRowNums = NP.arange(numRows(m))
         NR.shuffle(shuffledRowNums)
-    data = NP.array(m.data)
-    indices = NP.array(m.indices)
-    indptr = NP.array(m.indptr)
-    lo = 0
-    for i in range(m.indptr.size-1 ):
-        r = shuffledRowNums[i]
-        rowLen = m.indptr[r+1] - m.indptr[r]
-        indptr[i] = lo
-        indptr[i+1] = lo + rowLen
-        lo += rowLen
-        for j in range(rowLen):
-            data[indptr[i]+j] = m.data[m.indptr[r]+j]
-            indices[indptr[i]+j] = m.indices[m.indptr[r]+j]
-    result = SS.csr_matrix((data,indices,indptr), shape=m.shape, dtype='float32')
-    result.sort_indices()
-    return result
+    return gatherRows(m,shuffledRowNums)
+
+def gatherRows(m,rowNums):
+    """Return a sparse matrix whose i-th row is row rowNums[i] of m.
+    Only the selected rows are read, so this is suitable for matrices
+    whose arrays are memory-mapped.
+    """
+    checkCSR(m)
+    rowNums = NP.asarray(rowNums,dtype=LONG_INDEX_DTYPE)
+    starts = NP.asarray(m.indptr[rowNums],dtype=LONG_INDEX_DTYPE)
+    rowLens = NP.asarray(m.indptr[rowNums+1],dtype=LONG_INDEX_DTYPE) - starts
+    indptr = NP.zeros(len(rowNums)+1,dtype=LONG_INDEX_DTYPE)
+    NP.cumsum(rowLens,out=indptr[1:])
+    # position in m of each non-zero in the result
+    positions = NP.arange(indptr[-1],dtype=LONG_INDEX_DTYPE) + NP.repeat(starts-indptr[:-1],rowLens)
+    maxValue = max(len(rowNums),numCols(m),len(positions))
+    return csr(
+        NP.asarray(m.data[positions],dtype=DATA_DTYPE),
+        NP.asarray(m.indices[positions],dtype=indexDtype(maxValue)),
+        NP.asarray(indptr,dtype=indexDtype(maxValue)),
+        (len(rowNums),numCols(m)),'gatherRows')
+
+def relabel(m,rowMap=None,colMap=None,shape=None):
+    """Return a copy of m where the non-zero at (i,j) moves to
+    (rowMap[i],colMap[j]).  The maps are arrays, or None to leave
+    the rows or columns unchanged.  The result has the shape of m
+    unless another shape is given."""
+    checkCSR(m)
+    rows = rowIndices(m)
+    cols = m.indices
+    if rowMap is not None: rows = NP.asarray(rowMap)[rows]
+    if colMap is not None: cols = NP.asarray(colMap)[cols]
+    result = csrFromCOO(m.data,rows,cols,m.shape if shape is None else shape,'relabel')
+    return asPatternMatrix(result) if isPatternMatrix(m) else result
+
+#
+# pattern matrices: relations where every non-zero is 1.0 are stored
+# without a data array.  Their data is a read-only, zero-stride view
+# of a single 1.0, so they are still ordinary CSR matrices, but cost
+# only the memory of their indices.
+#
+
+def _unitData(n):
+    return NP.broadcast_to(NP.ones(1,dtype=DATA_DTYPE),(n,))
+
+def isPatternMatrix(m):
+    """True if m is a pattern matrix, built by asPatternMatrix."""
+    return isinstance(m,SS.csr_matrix) and m.data.ndim==1 and m.data.strides==(0,) and m.nnz>0
+
+def patternMatrix(indices,indptr,shape,context='unknown'):
+    """Build a pattern matrix, whose non-zeros are all 1.0, from the
+    index arrays of a CSR matrix, without allocating a data array."""
+    return csr(_unitData(len(indices)),indices,indptr,shape,context)
+
+def asPatternMatrix(m):
+    """Return m as a pattern matrix if all its non-zeros are 1.0, and
+    otherwise return m unchanged.  The indices are shared with m."""
+    if m.nnz==0 or isPatternMatrix(m) or not NP.all(m.data==1.0):
+        return m
+    return patternMatrix(m.indices,m.indptr,m.shape,'asPatternMatrix')
+
+def withExplicitWeights(m):
+    """Return a copy of a pattern matrix whose data can be modified, or
+    m itself if it is not a pattern matrix."""
+    if not isPatternMatrix(m):
+        return m
+    return csr(NP.ones(m.nnz,dtype=DATA_DTYPE),m.indices.copy(),m.indptr.copy(),m.shape,'withExplicitWeights')
+
+def transposePattern(m):
+    """The transpose of a pattern matrix, as a pattern matrix in CSR
+    format.  The data array of the transpose is dropped, so only its
+    indices are kept."""
+    checkCSR(m)
+    t = m.transpose().tocsr()
+    return csr(_unitData(t.nnz),t.indices,t.indptr,t.shape,'transposePattern')
+
+def matmul(X,M):
+    """Return X*M.  If M is a pattern matrix and each row of X has at
+    most one non-zero, which is the usual case for a minibatch of
+    queries, row i of the product is just a row of M scaled by
+    X[i,j], so it is built by gathering the rows of M instead of
+    with a general sparse product."""
+    if not isPatternMatrix(M) or not isinstance(X,SS.csr_matrix) or numCols(X)!=numRows(M):
+        return X*M
+    rowLens = NP.diff(X.indptr)
+    if NP.any(rowLens>1):
+        return X*M
+    result = gatherRows(M,X.indices)
+    rowsOut = NP.diff(result.indptr)
+    result.data = NP.repeat(asDataArray(X.data,'matmul'),rowsOut)
+    if len(rowLens)==len(X.indices):
+        return result
+    # some rows of X are empty, so spread out the gathered rows
+    indptr = NP.zeros(numRows(X)+1,dtype=result.indptr.dtype)
+    indptr[1:][rowLens>0] = rowsOut
+    NP.cumsum(indptr,out=indptr)
+    return csr(result.data,result.indices,indptr,(numRows(X),numCols(M)),'matmul')
+
+def matrixBytes(m):
+    """Memory used by the arrays of a CSR matrix, where the data of a
+    pattern matrix takes no space."""
+    dataBytes = 0 if isPatternMatrix(m) else m.data.nbytes
+    return dataBytes + m.indices.nbytes + m.indptr.nbytes
+
+def patternCounts(m,axis):
+    """For a pattern matrix, return a row vector with the number of
+    non-zeros in each column (axis=0) or each row (axis=1)."""
+    if axis==0:
+        counts = NP.bincount(m.indices,minlength=numCols(m))
+    else:
+        counts = NP.diff(m.indptr)
+    nz = NP.flatnonzero(counts)
+    maxValue = max(len(counts),len(nz))
+    return csr(NP.asarray(counts[nz],dtype=DATA_DTYPE),
+               NP.asarray(nz,dtype=indexDtype(maxValue)),
+               NP.array([0,len(nz)],dtype=indexDtype(maxValue)),
+               (1,len(counts)),'patternCounts')
+
+#
+# sparsity patterns: used to update a parameter matrix in place
+#
+
+def rowIndices(m):
+    """Row number of each non-zero entry of a CSR matrix."""
+    return NP.repeat(NP.arange(numRows(m),dtype=LONG_INDEX_DTYPE),NP.diff(m.indptr))
+
+def withSortedIndices(m):
+    """Return m if the indices in each row are sorted, and otherwise a
+    copy of m with sorted indices.  Unlike m.sort_indices(), this
+    never writes into m, which may share its arrays with a dataset or
+    be a read-only memory map."""
+    return m if m.has_sorted_indices else m.sorted_indices()
+
+def cellKeys(m):
+    """Return an array that encodes the (row,column) cell of each
+    non-zero of a CSR matrix as a single integer, row*numCols+col.
+    The indices of m are sorted, if necessary, so the keys are in
+    increasing order."""
+    if not m.has_sorted_indices: m.sort_indices()
+    return rowIndices(m)*numCols(m) + m.indices
+
+def keyPositions(patternKeys,keys):
+    """Return the position of each of the keys in the sorted array
+    patternKeys, or -1 if it is not present."""
+    positions = NP.searchsorted(patternKeys,keys)
+    found = positions < len(patternKeys)
+    found[found] = patternKeys[positions[found]]==keys[found]
+    return NP.where(found,positions,-1)
+
+def patternPositions(pattern,m):
+    """For each non-zero of m, return the position of the same cell in
+    pattern.data, or -1 if pattern has no entry for that cell.
+    """
+    assert pattern.shape==m.shape, 'shape mismatch %r vs %r' % (pattern.shape,m.shape)
+    return keyPositions(cellKeys(pattern),cellKeys(m))
+
+def restrictToPattern(m,pattern):
+    """Return a matrix with the entries of m that are in the cells of
+    pattern, and no others."""
+    m = withSortedIndices(asCSR(m,'restrictToPattern'))
+    keep = keyPositions(cellKeys(withSortedIndices(pattern)),cellKeys(m))>=0
+    if keep.all():
+        return m
+    indptr = NP.zeros(numRows(m)+1,dtype=LONG_INDEX_DTYPE)
+    NP.cumsum(NP.bincount(rowIndices(m)[keep],minlength=numRows(m)),out=indptr[1:])
+    return csr(m.data[keep],m.indices[keep],indptr,m.shape,'restrictToPattern')
+
+def sampledProduct(X,MT,pattern):
+    """Return the entries of X*M in the cells of a pattern matrix,
+    given MT, the transpose of M in CSR format.  Each entry is the
+    dot product of a row of X and a row of MT, so the cost is
+    proportional to the non-zeros in the rows the pattern picks,
+    rather than to the work of the full product."""
+    pattern = withSortedIndices(pattern)
+    rows = rowIndices(pattern)
+    products = gatherRows(X,rows).multiply(gatherRows(MT,pattern.indices))
+    data = NP.asarray(products.sum(axis=1)).ravel()
+    # cells with no paths through M are not in X*M
+    keep = data!=0
+    indptr = NP.zeros(numRows(pattern)+1,dtype=LONG_INDEX_DTYPE)
+    NP.cumsum(NP.bincount(rows[keep],minlength=numRows(pattern)),out=indptr[1:])
+    return csr(data[keep],pattern.indices[keep],indptr,pattern.shape,'sampledProduct')
+
+def sampledProductCost(X,MT,pattern):
+    """The number of non-zeros sampledProduct(X,MT,pattern) reads."""
+    rows = rowIndices(pattern)
+    return int(NP.diff(X.indptr)[rows].sum() + NP.diff(MT.indptr)[pattern.indices].sum())
+
+def unionPattern(pattern,m):
+    """Return a pair (u,positions) where u is a CSR matrix that has the
+    values of pattern, plus explicit zeros for every cell of m that
+    is not in pattern, and positions gives the location in u.data of
+    each entry of pattern.data.
+    """
+    patternKeys = cellKeys(pattern)
+    keys = NP.union1d(patternKeys,cellKeys(m))
+    ncols = numCols(m)
+    rows = keys // ncols
+    indptr = NP.zeros(numRows(m)+1,dtype=LONG_INDEX_DTYPE)
+    NP.cumsum(NP.bincount(rows,minlength=numRows(m)),out=indptr[1:])
+    positions = NP.searchsorted(keys,patternKeys)
+    data = NP.zeros(len(keys),dtype=DATA_DTYPE)
+    data[positions] = pattern.data
+    maxValue = max(numRows(m),ncols,len(keys))
+    u = csr(data,
+            NP.asarray(keys % ncols,dtype=indexDtype(maxValue)),
+            NP.asarray(indptr,dtype=indexDtype(maxValue)),
+            m.shape,'unionPattern')
+    return u,positions
 
 def selectRows(m,lo,hi):
-    """Return a sparse matrix that copies rows lo...hi-1 of m.  If hi is
-    too large it will be adjusted. """
+    """Return a sparse matrix that holds rows lo...hi-1 of m.  If hi is
+    too large it will be adjusted.  The data and indices of the result
+    are views of m's arrays, so they should not be modified in place.
+    """
     checkCSR(m)
     if hi>numRows(m): hi=numRows(m)
     #data for rows [lo, hi) are in cells [jLo...jHi)
     jLo = m.indptr[lo]
     jHi = m.indptr[hi]
-    #allocate space
-    data = NP.zeros(jHi - jLo)
-    indices = NP.zeros(jHi - jLo, dtype='int')
-    indptr = NP.zeros(hi - lo + 1, dtype='int')
-    for i in range(hi - lo):
-        rowLen = m.indptr[lo+i+1] - m.indptr[lo+i]
-        #translate the index pointers
-        indptr[i] = m.indptr[lo+i] - jLo
-        for j in range(rowLen):
-            k = m.indptr[lo+i]+j
-            data[indptr[i] + j] = m.data[k]
-            indices[indptr[i] + j] = m.indices[k]
-    indptr[hi-lo] = m.indptr[hi] - jLo
-    result = SS.csr_matrix((data,indices,indptr), shape=(hi-lo,numCols(m)), dtype='float32')
-    return result
+    indptr = m.indptr[lo:hi+1] - jLo
+    return csr(m.data[jLo:jHi],m.indices[jLo:jHi],indptr,(hi-lo,numCols(m)),'selectRows')
 
 if __name__=="__main__":
     tmp = []
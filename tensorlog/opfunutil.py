@@ -53,6 +53,24 @@ class OperatorOrFunction(object):
     def children(self):
         """List of substructures."""
         assert False, 'abstract method called'
+
+    def relationsUsed(self):
+        """Set of (functor,arity) pairs for the database relations that
+        are read when self is evaluated.  This is used to decide when
+        cached results are out of date.
+        """
+        result = set()
+        for c in self.children():
+            result.update(c.relationsUsed())
+        return result
+
+    def constantsUsed(self):
+        """Set of (constant,typeName) pairs for the constants that are
+        looked up in the database when self is evaluated."""
+        result = set()
+        for c in self.children():
+            result.update(c.constantsUsed())
+        return result
     
 
 class MutableObject(object):
@@ -70,6 +88,9 @@ class Scratchpad(object):
     """
     def __init__(self):
         self.d = dict()
+        # if set, a subtreecache.SubtreeCacheView that functions use to
+        # reuse the outputs of their parameter-free ops
+        self.memo = None
     #override pad[id] to access d
     def __getitem__(self,key):
         if key not in self.d:
@@ -5,6 +5,7 @@
 #
 
 import logging
+import numpy as NP
 import scipy.sparse
 
 from tensorlog import opfunutil
@@ -19,6 +20,19 @@ conf.max_trace = False;  conf.help.max_trace =     "Print max value of functions
 conf.check_nan = True;   conf.help.check_overflow =  "Check if output of each op is nan."
 conf.pprintMaxdepth=0;   conf.help.pprintMaxdepth =  "Controls op.pprint() output"
 
+def _relationKey(db,mode,dstType):
+  """Key for caching a constant computed from a non-parameter relation,
+  which changes whenever the relation changes or the type of the
+  output grows."""
+  if db.isParameter(mode): return None
+  return (db,db.symbolEpoch,db.getVersion(mode.functor,mode.arity),db.dim(dstType))
+
+def _scaled(m,scale):
+  """Multiply a newly-computed matrix by a scale factor from the db, in place."""
+  if scale!=1.0:
+    m.data *= scale
+  return m
+
 
 class Op(opfunutil.OperatorOrFunction):
   """Sort of like a function but side-effects an environment.  More
@@ -35,6 +49,10 @@ class Op(opfunutil.OperatorOrFunction):
     self.dstType = None
     # used for debugging
     self.msgFrom = self.msgTo = None
+    # set by the compiler if the output is a constant that can be
+    # cached - see BPCompiler.foldConstants
+    self.folded = False
+    self._constant = None
 
   def setMessage(self,msgFrom,msgTo):
     """For debugging/tracing, record the BP message associated with this
@@ -42,11 +60,19 @@ class Op(opfunutil.OperatorOrFunction):
     self.msgFrom = msgFrom
     self.msgTo = msgTo
 
-  def eval(self,env,pad):
-    """Evaluate an operator inside an environment."""
+  def eval(self,env,pad,candidates=None):
+    """Evaluate an operator inside an environment.  If candidates, a
+    pattern matrix, is given, the output is only needed in its cells,
+    and an op may skip computing the others - see
+    learn.NegativeSampler."""
     if conf.trace:
       print(('op eval'),self, end=' ')
-    self._doEval(env,pad)
+    if self.folded:
+      self._evalConstant(env,pad)
+    elif candidates is not None:
+      self._doEvalCandidates(env,pad,candidates)
+    else:
+      self._doEval(env,pad)
     pad[self.id].output = env[self.dst]
     if conf.trace:
       print(('stores'),mutil.summary(env[self.dst]), end=' ')
@@ -70,6 +96,42 @@ class Op(opfunutil.OperatorOrFunction):
     if conf.trace:
       print(('end op bp'),self)
 
+  def _doEvalCandidates(self,env,pad,candidates):
+    # by default the output is computed in full
+    self._doEval(env,pad)
+
+  def inputVars(self):
+    """Names of the variables whose bindings this op reads."""
+    return []
+
+  def isParameterFree(self,db):
+    """True if this op, including any functions it calls, reads no
+    parameters of the database."""
+    return not (self.relationsUsed() & db.paramSet)
+
+  def isConstant(self):
+    """True if the output of this op doesn't depend on the bindings of
+    any variables."""
+    return False
+
+  def constantKey(self,db):
+    """For an op where isConstant() is true, return a key which changes
+    whenever the output would change, or None if the output should
+    not be cached."""
+    return None
+
+  def _evalConstant(self,env,pad):
+    key = self.constantKey(env.db)
+    if key is not None and self._constant is not None and self._constant[0]==key:
+      env[self.dst] = self._constant[1]
+    else:
+      self._doEval(env,pad)
+      self._constant = (key,env[self.dst]) if key is not None else None
+
+  def _copyFolding(self,op):
+    op.folded = self.folded
+    return op
+
   def pprint(self,depth=0):
     description = ('%-2d ' % self.id) + self.pprintSummary()
     comment = self.pprintComment()
@@ -115,10 +177,17 @@ class DefinedPredOp(Op):
     return "DefinedPredOp(%r,%r,%s,%d)" % (self.dst,self.src,str(self.funMode),self.depth)
   def _ppLHS(self):
     return "f_[%s,%d](%s)" % (str(self.funMode),self.depth,self.src)
+  def inputVars(self):
+    return [self.src]
   def _doEval(self,env,pad):
     vals = [env[self.src]]
     outputs = self.subfun.eval(self.tensorlogProg.db, vals, pad)
     env[self.dst] = outputs
+  def _doEvalCandidates(self,env,pad,candidates):
+    # the output is the output of the called function
+    pad[self.subfun.id].candidates = candidates
+    self._doEval(env,pad)
+    pad[self.subfun.id].candidates = None
   def _doBackprop(self,env,gradAccum,pad):
     newDelta = self.subfun.backprop(env.delta[self.dst],gradAccum,pad)
     env.delta[self.src] = newDelta
@@ -153,13 +222,19 @@ class AssignPreimageToVar(Op):
     return "AssignPreimageToVar(%s,%s)" % (self.dst,self.matMode)
   def _ppLHS(self):
     return "M_[%s]" % str(self.matMode)
+  def relationsUsed(self):
+    return set([(self.matMode.functor,self.matMode.arity)])
+  def isConstant(self):
+    return True
+  def constantKey(self,db):
+    return _relationKey(db,self.matMode,self.dstType)
   def _doEval(self,env,pad):
     env[self.dst] = env.db.matrixPreimage(self.matMode)
   def _doBackprop(self,env,gradAccum,pad):
     #TODO implement preimages
     assert False,'backprop with preimages not implemented'
   def copy(self):
-    return AssignPreimageToVar(self.dst,self.matMode)
+    return self._copyFolding(AssignPreimageToVar(self.dst,self.matMode))
 
 class AssignVectorToVar(Op):
   """Mat is a unary predicate like p(X). Assign a row vector which
@@ -172,15 +247,22 @@ class AssignVectorToVar(Op):
     return "AssignVectorToVar(%s,%s)" % (self.dst,self.matMode)
   def _ppLHS(self):
     return "V_[%s]" % str(self.matMode)
+  def relationsUsed(self):
+    return set([(self.matMode.functor,self.matMode.arity)])
+  def isConstant(self):
+    return True
+  def constantKey(self,db):
+    return _relationKey(db,self.matMode,self.dstType)
   def _doEval(self,env,pad):
-    env[self.dst] = env.db.vector(self.matMode)
+    v,scale = env.db.scaledVector(self.matMode)
+    env[self.dst] = v if scale==1.0 else v * scale
   def _doBackprop(self,env,gradAccum,pad):
     if env.db.isParameter(self.matMode):
       update = env.delta[self.dst]
       key = (self.matMode.functor,self.matMode.arity)
       gradAccum.accum(key,update)
   def copy(self):
-    return AssignVectorToVar(self.dst,self.matMode)
+    return self._copyFolding(AssignVectorToVar(self.dst,self.matMode))
 
 
 class AssignOnehotToVar(Op):
@@ -197,14 +279,20 @@ class AssignOnehotToVar(Op):
       self.dstType = mode.arg(1)
   def __repr__(self):
     return "AssignOnehotToVar(%s,%s)" % (self.dst,self.onehotConst)
+  def constantsUsed(self):
+    return set([(self.onehotConst,self.dstType)])
   def _ppLHS(self):
     return 'U_[%s]' % self.onehotConst
+  def isConstant(self):
+    return True
+  def constantKey(self,db):
+    return (db,db.symbolEpoch,db.dim(self.dstType))
   def _doEval(self,env,pad):
     env[self.dst] = env.db.onehot(self.onehotConst,self.dstType)
   def _doBackprop(self,env,gradAccum,pad):
     pass
   def copy(self):
-    return AssignOnehotToVar(self.dst,self.mode)
+    return self._copyFolding(AssignOnehotToVar(self.dst,self.mode))
 
 class VecMatMulOp(Op):
   """Op of the form "dst = src*mat or dst=src*mat.tranpose()"
@@ -220,31 +308,62 @@ class VecMatMulOp(Op):
     buf = "%s * M_[%s]" % (self.src,self.matMode)
     if self.transpose: buf += ".T"
     return buf
+  def relationsUsed(self):
+    return set([(self.matMode.functor,self.matMode.arity)])
+  def inputVars(self):
+    return [self.src]
   def _doEval(self,env,pad):
-    env[self.dst] = env[self.src] * env.db.matrix(self.matMode,self.transpose)
+    # scaling the (usually smaller) product is cheaper than scaling
+    # a lazily-scaled parameter matrix
+    m,scale = env.db.scaledMatrix(self.matMode,self.transpose)
+    env[self.dst] = _scaled(mutil.matmul(env[self.src],m),scale)
+    pad[self.id].transposed = None
+  def _doEvalCandidates(self,env,pad,candidates):
+    # Each candidate cell is the dot product of a row of src and a
+    # column of the matrix, which is a row of its transpose.  Backprop
+    # needs the transpose as well, so it is kept for _doBackprop, and
+    # the cells are computed this way if that reads fewer non-zeros
+    # than the full product
+    src = env[self.src]
+    m,_ = env.db.scaledMatrix(self.matMode,self.transpose)
+    if (mutil.numRows(src),mutil.numCols(m))!=candidates.shape:
+      return self._doEval(env,pad)
+    mT,scale = pad[self.id].transposed = env.db.scaledMatrix(self.matMode,(not self.transpose))
+    if mutil.sampledProductCost(src,mT,candidates) >= NP.diff(m.indptr)[src.indices].sum():
+      env[self.dst] = _scaled(mutil.matmul(src,m),scale)
+    else:
+      env[self.dst] = _scaled(mutil.sampledProduct(src,mT,candidates),scale)
   def _doBackprop(self,env,gradAccum,pad):
     # dst = f(src,mat)
-    env.delta[self.src] = env.delta[self.dst] * env.db.matrix(self.matMode,(not self.transpose))
+    m,scale = getattr(pad[self.id],'transposed',None) or env.db.scaledMatrix(self.matMode,(not self.transpose))
+    pad[self.id].transposed = None
+    env.delta[self.src] = _scaled(mutil.matmul(env.delta[self.dst],m),scale)
     mutil.checkCSR(env.delta[self.src],'delta[%s]' % self.src)
     if env.db.isParameter(self.matMode):
-      update = env[self.src].transpose() * (env.delta[self.dst])
-      update = scipy.sparse.csr_matrix(update)
-      # The transpose flag is set in BP when sending a message
-      # 'backward' from a goal output to variable, and indicates
-      # if the operation needs to transpose the matrix.  Since
-      # the db stores predicates p(a,b) internally as a matrix
-      # where a is a row and b is a column, when the matMode is
-      # p(o,i) then another internal transposition happens, by
-      # the database.  We need to transpose the update when
-      # exactly one of these transpositions happen, not two or
-      # zero
+      # The update is src.transpose()*delta[dst].  The transpose flag
+      # is set in BP when sending a message 'backward' from a goal
+      # output to variable, and indicates if the operation needs to
+      # transpose the matrix.  Since the db stores predicates p(a,b)
+      # internally as a matrix where a is a row and b is a column,
+      # when the matMode is p(o,i) then another internal
+      # transposition happens, by the database.  We need to
+      # transpose the update when exactly one of these
+      # transpositions happen, not two or zero
       transposeUpdate = env.db.transposeNeeded(self.matMode,self.transpose)
+      key = (self.matMode.functor,self.matMode.arity)
+      # src and delta[dst] are CSR, and a CSR product needs the rows
+      # of its left operand, which are columns of src or delta[dst].
+      # So one operand is always converted, in O(nnz) time and space:
+      # scipy would do it silently for a CSC-times-CSR product, so
+      # convert the left operand here, where copy trackers see it,
+      # and multiply two CSR matrices into a CSR update
       if transposeUpdate:
-        update = update.transpose()
-        update = scipy.sparse.csr_matrix(update)
+        left,right = env.delta[self.dst],env[self.src]
+      else:
+        left,right = env[self.src],env.delta[self.dst]
+      update = mutil.asCSR(mutil.asCSR(left.transpose(),'VecMatMulOp operand') * right,'VecMatMulOp update')
+      mutil.checkCSR(update,'update for %s mode %s' % (str(key),str(self.matMode)))
       # finally save the update
-      key = (self.matMode.functor,self.matMode.arity)
-      mutil.checkCSR(update,'update for %s mode %s transpose %s' % (str(key),str(self.matMode),transposeUpdate))
       gradAccum.accum(key,update)
   def copy(self):
     return VecMatMulOp(self.dst,self.src,self.matMode,self.transpose)
@@ -262,6 +381,11 @@ class CallPlugin(Op):
     return "BuiltInOp(%r,%r,%s)" % (self.dst,",".join(self.srcs),self.mode)
   def _ppLHS(self):
     return "CallPlugin{%s}(%s)" % (str(self.mode),",".join(self.srcs))
+  def inputVars(self):
+    return list(self.srcs)
+  def isParameterFree(self,db):
+    # nothing is known about what a plugin computes
+    return False
   def _doEval(self,env,pad):
     assert False,'CallPlugin only supported in cross-compilation'
   def _doBackprop(self,env,gradAccum,pad):
@@ -281,6 +405,8 @@ class ComponentwiseVecMulOp(Op):
     return "ComponentwiseVecMulOp(%r,%r,%s)" % (self.dst,self.src,self.src2)
   def _ppLHS(self):
     return "%s o %s" % (self.src,self.src2)
+  def inputVars(self):
+    return [self.src,self.src2]
   def _doEval(self,env,pad):
     env[self.dst] = mutil.broadcastAndComponentwiseMultiply(env[self.src],env[self.src2])
   def _doBackprop(self,env,gradAccum,pad):
@@ -302,6 +428,8 @@ class WeightedVec(Op):
     return "WeightedVec(%s,%s.sum(),%s)" % (self.dst,self.weighter,self.vec)
   def _ppLHS(self):
     return "%s * %s.sum()" % (self.vec,self.weighter)
+  def inputVars(self):
+    return [self.weighter,self.vec]
   def _doEval(self,env,pad):
     env[self.dst] = mutil.broadcastAndWeightByRowSum(env[self.vec],env[self.weighter])
   def _doBackprop(self,env,gradAccum,pad):
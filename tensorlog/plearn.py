@@ -90,13 +90,17 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
         """ Return predictions on a dataset. """
         xDictBuffer = collections.defaultdict(list)
         yDictBuffer = collections.defaultdict(list)
-        miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize,shuffleFirst=False))
-        logging.info('predicting for %d miniBatches with the worker pool...' % len(miniBatches))
-        predictOutputs = self.pool.map(_doPredict, miniBatches, chunksize=1)
-        for (mode,X,P) in predictOutputs:
+        # minibatches are streamed to the workers, so the inputs of a
+        # dataset that doesn't fit in memory (eg a MemmapDataset) are
+        # never all read at once
+        miniBatches = dset.minibatchIterator(batchSize=self.miniBatchSize,shuffleFirst=False)
+        logging.info('predicting for miniBatches with the worker pool...')
+        numBatches = 0
+        for (mode,X,P) in self.pool.imap(_doPredict, miniBatches, chunksize=1):
             if copyXs: xDictBuffer[mode].append(X) 
             yDictBuffer[mode].append(P)
-        logging.info('predictions for %d miniBatches done' % len(miniBatches))
+            numBatches += 1
+        logging.info('predictions for %d miniBatches done' % numBatches)
         xDict = {}
         yDict = {}
         if copyXs:
@@ -114,9 +118,10 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
         args = {'i':i,'k':k,'startTime':startTime,'mode':mode}
         return (mode,X,Y,args)
         
-    def totalNumExamples(self,miniBatches):
-        """The total nummber of examples in all the miniBatches"""
-        return sum(mutil.numRows(X) for (mode,X,Y) in miniBatches)
+    def totalNumExamples(self,bpOutputs):
+        """The total nummber of examples in the miniBatches that the
+        outputs of _doBackpropTask were computed for"""
+        return sum(n for (n,paramGrads) in bpOutputs)
 
     def processGradients(self,bpOutputs,totalN):
         """ Use the gradients to update parameters """
@@ -145,15 +150,15 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
         for i in range(self.epochs):
             logging.info("starting epoch %d" % i)
             startTime = time.time()
-            #generate the tasks
-            miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize))
-            bpInputs = [ParallelFixedRateGDLearner.miniBatchToTask(k_b[1],i,k_b[0],startTime) for k_b in enumerate(miniBatches)]
-            totalN = self.totalNumExamples(miniBatches)
-            logging.info("created %d minibatch tasks, total of %d examples" % (len(bpInputs),totalN))
+            #generate the tasks lazily, so minibatches are streamed to
+            #the workers instead of all being read into memory
+            miniBatches = dset.minibatchIterator(batchSize=self.miniBatchSize)
+            bpInputs = (ParallelFixedRateGDLearner.miniBatchToTask(b,i,k,startTime) for (k,b) in enumerate(miniBatches))
             #generate gradients - in parallel
-            bpOutputs = self.pool.map(_doBackpropTask, bpInputs)
+            bpOutputs = list(self.pool.imap(_doBackpropTask, bpInputs))
+            totalN = self.totalNumExamples(bpOutputs)
             #update params using the gradients
-            logging.info("gradients for %d minibatch tasks computed" % len(bpInputs))
+            logging.info("gradients for %d minibatch tasks computed, total of %d examples" % (len(bpOutputs),totalN))
             self.processGradients(bpOutputs,totalN)
             logging.info("gradients merged")
             # send params to workers
@@ -164,64 +169,25 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
             self.epochTracer(self,epochCounter,i=i,startTime=trainStartTime)
 
 class ParallelAdaGradLearner(ParallelFixedRateGDLearner):
-    """ Not debugged yet....
+    """ A parallel learner that uses learn.AdaGradOptimizer to pick a
+    learning rate for each parameter coordinate.  At the end of each
+    epoch the gradients of all the minibatches are combined into a
+    single mean gradient, and one AdaGrad step is taken.
     """
     
     #override learning rate
     def __init__(self,prog,**kw):
-        logging.warn("ParallelAdaGradLearner does not seem to perform well - it's probably still buggy")
         if not 'rate' in kw: kw['rate']=0.5
         super(ParallelAdaGradLearner,self).__init__(prog,**kw)
+        self.optimizer = learn.AdaGradOptimizer()
 
-    def train(self,dset):
-        modes = dset.modesToLearn()
-        trainStartTime = time.time()
-        sumSquareGrads = learn.GradAccumulator()
-        for i in range(self.epochs):
-
-            logging.info("starting epoch %d" % i)
-            startTime = time.time()
-            #generate the tasks
-            miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize))
-            bpInputs = [ParallelFixedRateGDLearner.miniBatchToTask(k_b[1],i,k_b[0],startTime) for k_b in enumerate(miniBatches)]
-            totalN = self.totalNumExamples(miniBatches)
-
-            #generate gradients - in parallel
-            bpOutputs = self.pool.map(_doBackpropTask, bpInputs)
-
-            # accumulate to sumSquareGrads
-            totalGradient = learn.GradAccumulator()
-            for (n,paramGrads) in bpOutputs:
-                for (functor,arity),grad in list(paramGrads.items()):
-                    totalGradient.accum((functor,arity), self.meanUpdate(functor,arity,grad,n,totalN))
-            sumSquareGrads = sumSquareGrads.addedTo(totalGradient.mapData(NP.square))
-            #compute gradient-specific rate
-            ratePerParam = sumSquareGrads.mapData(lambda d:d+1e-1).mapData(NP.sqrt).mapData(NP.reciprocal)
-
-            # scale down totalGradient by per-feature weight
-            for (functor,arity),grad in list(totalGradient.items()):
-                totalGradient[(functor,arity)] = grad.multiply(ratePerParam[(functor,arity)])
-
-            self.regularizer.regularizeParams(self.prog,totalN)
-            for (functor,arity) in self.prog.db.paramList:
-                m = self.prog.db.getParameter(functor,arity)
-                print(('reg',functor,'/',arity,'m shape',m.shape))
-                if (functor,arity) in list(totalGradient.keys()):
-                    print(('vs totalGradient shape',totalGradient[(functor,arity)].shape))
-                else:
-                    print('not in totalGradient')
-
-            #cannot use process gradients because I've already scaled them down,
-            # need to just add and clip
-            for (functor,arity),grad in list(totalGradient.items()):
-                m0 = self.prog.db.getParameter(functor,arity)
-                m1 = m0 + self.rate * grad
-                m = mutil.mapData(lambda d:NP.clip(d,0.0,NP.finfo('float32').max), m1)
-                self.prog.db.setParameter(functor,arity,m)
-
-            # send params to workers
-            self.broadcastParameters()
-
-            # status updates
-            epochCounter = learn.GradAccumulator.mergeCounters( [n_grads[1].counter for n_grads in bpOutputs] )
-            self.epochTracer(self,epochCounter,i=i,startTime=trainStartTime)
+    def processGradients(self,bpOutputs,totalN):
+        """ Combine the gradients and take one AdaGrad step """
+        self.regularizer.regularizeParams(self.prog,totalN)
+        totalGradient = learn.GradAccumulator()
+        for (n,paramGrads) in bpOutputs:
+            for (functor,arity),grad in list(paramGrads.items()):
+                totalGradient.accum((functor,arity), self.meanUpdate(functor,arity,grad,n,totalN))
+        # meanUpdate has already averaged the gradients
+        totalGradient.reshaped = True
+        self.applyUpdate(totalGradient,self.rate)
@@ -15,9 +15,11 @@ from tensorlog import comline
 from tensorlog import declare
 from tensorlog import funs
 from tensorlog import matrixdb
+from tensorlog import memory
 from tensorlog import mutil
 from tensorlog import opfunutil
 from tensorlog import parser
+from tensorlog import querycache
 from tensorlog import util
 
 conf = config.Config()
@@ -37,6 +39,9 @@ class Program(object):
         self.maxDepth = conf.max_depth
         self.normalize = conf.normalize
         self.plugins = plugins if (plugins is not None) else Plugins()
+        # optional querycache.QueryCache used by eval
+        self.queryCache = None
+        self._relationsUsed = {}
         # check the rules aren't proppr formatted
         def checkRule(r):
             assert not r.features, 'for rules with {} features, specify --proppr: %s' % str(r)
@@ -46,6 +51,28 @@ class Program(object):
 
     def clearFunctionCache(self):
         self.function = {}
+        self._relationsUsed = {}
+        if self.queryCache is not None:
+            self.queryCache.clear()
+
+    def enableQueryCache(self,maxEntries=None,maxNnz=None):
+        """ Cache the results of eval and evalSymbols, row by row.  Cached
+        results are discarded when any relation they depend on is
+        changed, e.g., by db.setParameter or db.addFacts.  Returns the
+        querycache.QueryCache, which keeps hit/miss statistics.
+        """
+        self.queryCache = querycache.QueryCache(maxEntries=maxEntries,maxNnz=maxNnz)
+        return self.queryCache
+
+    def disableQueryCache(self):
+        self.queryCache = None
+
+    def relationsUsed(self,mode):
+        """ Return a sorted tuple of the (functor,arity) pairs for the db
+        relations read by the function for a mode """
+        if mode not in self._relationsUsed:
+            self._relationsUsed[mode] = tuple(sorted(self.getFunction(mode).relationsUsed()))
+        return self._relationsUsed[mode]
 
     def findPredDef(self,mode):
         """Find the set of rules with a lhs that match the given mode."""
@@ -116,7 +143,23 @@ class Program(object):
         """
         if (mode,0) not in self.function: self.compile(mode)
         fun = self.function[(mode,0)]
-        return fun.eval(self.db, inputs, opfunutil.Scratchpad())
+        if self.queryCache is None:
+            return self._evalWithinBudget(fun, inputs)
+        return self.queryCache.eval(
+            self.db, mode, fun, self.relationsUsed(mode), inputs,
+            lambda xs: self._evalWithinBudget(fun, xs))
+
+    def _evalWithinBudget(self,fun,inputs):
+        """ Evaluate a function, splitting the inputs into chunks of rows
+        if they are too large for the memory budget - see memory.py """
+        numRows = mutil.numRows(inputs[0])
+        if not memory.needsChunking(numRows):
+            return fun.eval(self.db, inputs, opfunutil.Scratchpad())
+        def evalRows(lo,hi):
+            pad = opfunutil.Scratchpad()
+            result = fun.eval(self.db, [mutil.selectRows(x,lo,hi) for x in inputs], pad)
+            return result,memory.padBytes(pad)
+        return mutil.stack(memory.evalInChunks(evalRows,numRows))
 
     def evalGradSymbols(self,mode,symbols):
         """ After compilation, evaluate a function.  Input is a list of
@@ -231,7 +274,7 @@ class ProPPRProgram(Program):
             pass
         elif ruleIdPred is not None:
             # TODO check this stuff and add type inference!
-            assert (ruleIdPred,1) in self.db.matEncoding,'there is no unary predicate called %s' % ruleIdPred
+            assert self.db.inDB(ruleIdPred,1),'there is no unary predicate called %s' % ruleIdPred
             self.db.markAsParameter("weighted",1)
             self.db.setParameter("weighted",1,self.db.vector(declare.asMode('%s(o)' % ruleIdPred)) * epsilon)
         else:
@@ -246,7 +289,7 @@ class ProPPRProgram(Program):
 
     def getRuleWeights(self):
         """ Return a vector of the weights for a rule """
-        return self.db.matEncoding[('weighted',1)]
+        return self.db.getParameter('weighted',1)
 
     def setFeatureWeights(self,epsilon=1.0):
         def possibleModes(rule):
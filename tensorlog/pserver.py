@@ -0,0 +1,457 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# data-parallel learning with a parameter server, for training sets
+# too large for the worker pool of one machine (see plearn.py).  A
+# ParameterServer holds the parameters of a program, and each Worker,
+# possibly on another host, owns a shard of the minibatches.  For each
+# minibatch a worker pulls the current parameters from the server over
+# TCP, computes gradients with Learner.crossEntropyGrad, and pushes
+# them back to the server, which applies the updates.
+#
+# With staleness 0 training is synchronous: the server waits for a
+# gradient from every worker, and applies them together, as
+# plearn.ParallelFixedRateGDLearner does for an epoch.  With staleness
+# s>0 each gradient is applied as soon as it arrives, and a worker may
+# get at most s minibatches ahead of the slowest worker.
+#
+# usage, with one server and k workers (the server decides the epochs
+# and minibatch size):
+#   python -m tensorlog.pserver --db ... --prog ... + --serve --workers k --port p [--staleness s ...]
+#   python -m tensorlog.pserver --db ... --prog ... --trainData ... + --worker i --server host:p
+
+import collections
+import json
+import logging
+import multiprocessing
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import numpy as NP
+import numpy.random as NR
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import learn
+from tensorlog import mutil
+
+conf = config.Config()
+conf.staleness = 0;           conf.help.staleness = 'How many minibatches a worker may get ahead of the slowest one - 0 means synchronous training'
+conf.connect_timeout = 60.0;  conf.help.connect_timeout = 'Seconds a worker keeps retrying to connect to the server'
+
+##############################################################################
+# Wire format.  A message is a JSON header followed by a list of
+# sparse matrices.  A matrix is sent as a fixed-size header giving its
+# shape, number of non-zeros, and the size of its index entries,
+# followed by the raw indptr, indices and data arrays, in little-endian
+# order.
+##############################################################################
+
+_FRAME = struct.Struct('<II')       # header bytes, number of matrices
+_LENGTH = struct.Struct('<Q')       # bytes in an encoded matrix
+_MATRIX = struct.Struct('<IIQB')    # rows, cols, nnz, bytes per index
+_DATA_DTYPE = NP.dtype('<f4')
+
+def encodeMatrix(m):
+    """Binary encoding of a sparse matrix."""
+    m = mutil.asCSR(m,'encodeMatrix')
+    nnz = int(m.indptr[-1])
+    indexDType = NP.dtype('<i4') if m.indices.dtype.itemsize<=4 and m.indptr.dtype.itemsize<=4 else NP.dtype('<i8')
+    return b''.join([
+        _MATRIX.pack(m.shape[0],m.shape[1],nnz,indexDType.itemsize),
+        m.indptr.astype(indexDType,copy=False).tobytes(),
+        m.indices[:nnz].astype(indexDType,copy=False).tobytes(),
+        m.data[:nnz].astype(_DATA_DTYPE,copy=False).tobytes()])
+
+def decodeMatrix(buf):
+    """Inverse of encodeMatrix.  The arrays of the result share storage
+    with buf, which should be writable if the result will be updated
+    in place."""
+    rows,cols,nnz,indexBytes = _MATRIX.unpack_from(buf,0)
+    indexDType = NP.dtype('<i%d' % indexBytes)
+    offset = _MATRIX.size
+    indptr = NP.frombuffer(buf,dtype=indexDType,count=rows+1,offset=offset)
+    offset += (rows+1)*indexBytes
+    indices = NP.frombuffer(buf,dtype=indexDType,count=nnz,offset=offset)
+    offset += nnz*indexBytes
+    data = NP.frombuffer(buf,dtype=_DATA_DTYPE,count=nnz,offset=offset)
+    return mutil.csr(data,indices,indptr,(rows,cols),'decodeMatrix')
+
+def sendMessage(sock,header,matrices=()):
+    """Send a JSON-able header and a list of sparse matrices."""
+    headerBytes = json.dumps(header).encode('utf-8')
+    parts = [_FRAME.pack(len(headerBytes),len(matrices)),headerBytes]
+    for m in matrices:
+        encoded = encodeMatrix(m)
+        parts.append(_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    sock.sendall(b''.join(parts))
+
+def _recvExactly(sock,numBytes):
+    buf = bytearray(numBytes)
+    view = memoryview(buf)
+    received = 0
+    while received<numBytes:
+        k = sock.recv_into(view[received:],numBytes-received)
+        if k==0: raise EOFError('connection closed')
+        received += k
+    return buf
+
+def recvMessage(sock):
+    """Receive a message sent by sendMessage, and return the header and
+    the list of matrices.  Raises EOFError if the connection closes."""
+    headerLen,numMatrices = _FRAME.unpack(bytes(_recvExactly(sock,_FRAME.size)))
+    header = json.loads(_recvExactly(sock,headerLen).decode('utf-8'))
+    matrices = []
+    for i in range(numMatrices):
+        (matrixLen,) = _LENGTH.unpack(bytes(_recvExactly(sock,_LENGTH.size)))
+        matrices.append(decodeMatrix(_recvExactly(sock,matrixLen)))
+    return header,matrices
+
+def _keyList(keys):
+    return [[functor,arity] for (functor,arity) in keys]
+
+def _keyTuples(keyList):
+    return [(str(functor),int(arity)) for (functor,arity) in keyList]
+
+##############################################################################
+# the server
+##############################################################################
+
+class _TCPServer(socketserver.ThreadingMixIn,socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ParameterServer(object):
+    """Holds the parameters of a learner's program, and applies the
+    gradients pushed by numWorkers workers, using the learner's
+    regularizer, rate and optimizer.  Workers are numbered 0,...,k-1,
+    and each connects once.  If port is 0 an unused port is picked;
+    the address actually used is self.address.
+    """
+
+    def __init__(self,learner,numWorkers,staleness=None,host='localhost',port=0):
+        self.learner = learner
+        self.numWorkers = numWorkers
+        self.staleness = conf.staleness if staleness is None else staleness
+        assert self.staleness>=0,'staleness must be non-negative'
+        # guards everything below, and is notified when it changes
+        self.cond = threading.Condition()
+        self.registered = set()
+        self.finished = set()
+        # number of gradients pushed by each worker
+        self.clock = dict((w,0) for w in range(numWorkers))
+        # in synchronous mode, the pushes (n,paramGrads) waiting for the
+        # current round to end, and the number of rounds completed
+        self.pending = []
+        self.rounds = 0
+        # number of gradients applied
+        self.updates = 0
+        # counters for each epoch, and the workers that have finished it
+        self.epochCounters = collections.defaultdict(learn.GradAccumulator.counter)
+        self.epochWorkers = collections.defaultdict(set)
+        self.startTime = time.time()
+        server = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server._serveConnection(self.request)
+        self.tcpServer = _TCPServer((host,port),Handler)
+        self.address = self.tcpServer.server_address
+        self.thread = None
+
+    def start(self):
+        """Start answering requests on a background thread."""
+        self.thread = threading.Thread(target=self.tcpServer.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('parameter server for %d workers listening on %s:%d' % ((self.numWorkers,)+tuple(self.address[:2])))
+
+    def wait(self,timeout=None):
+        """Wait until every worker has finished, and return True if they
+        have."""
+        with self.cond:
+            return self.cond.wait_for(lambda:len(self.finished)==self.numWorkers,timeout)
+
+    def stop(self):
+        self.tcpServer.shutdown()
+        self.tcpServer.server_close()
+        if self.thread: self.thread.join()
+
+    def _serveConnection(self,sock):
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        while True:
+            try:
+                header,matrices = recvMessage(sock)
+            except EOFError:
+                return
+            try:
+                replyHeader,replyMatrices = getattr(self,'_'+header['op'])(header,matrices)
+            except Exception:
+                logging.error('parameter server failed on %s request' % header.get('op'))
+                replyHeader,replyMatrices = {'error':traceback.format_exc()},[]
+            sendMessage(sock,replyHeader,replyMatrices)
+
+    #
+    # requests from workers
+    #
+
+    def _hello(self,header,matrices):
+        w = header['worker']
+        with self.cond:
+            assert 0<=w<self.numWorkers,'worker %d of %d' % (w,self.numWorkers)
+            assert w not in self.registered,'worker %d connected twice' % w
+            self.registered.add(w)
+        return {'numWorkers':self.numWorkers,'epochs':self.learner.epochs,
+                'miniBatchSize':self.learner.miniBatchSize},[]
+
+    def _pull(self,header,matrices):
+        with self.cond:
+            # wait until the updates the worker may not miss are applied
+            self.cond.wait_for(lambda:self._progress() >= header['clock']-self.staleness)
+            db = self.learner.prog.db
+            keys = list(db.paramList)
+            # copied, since the optimizer updates parameters in place
+            params = [db.getParameter(functor,arity).copy() for (functor,arity) in keys]
+        return {'keys':_keyList(keys)},params
+
+    def _push(self,header,matrices):
+        w = header['worker']
+        paramGrads = learn.GradAccumulator()
+        for key,m in zip(_keyTuples(header['keys']),matrices):
+            paramGrads[key] = m
+        for k,v in header['counter']:
+            paramGrads.counter[k] = v
+        with self.cond:
+            assert header['clock']==self.clock[w],'worker %d pushed gradient %d, expected %d' % (w,header['clock'],self.clock[w])
+            self.clock[w] += 1
+            learn.GradAccumulator.accumToCounter(self.epochCounters[header['epoch']],paramGrads.counter)
+            if self.staleness==0:
+                self.pending.append((header['n'],paramGrads))
+                self._maybeEndRound()
+            else:
+                self.learner.regularizer.regularizeParams(self.learner.prog,header['n'])
+                self.learner.applyUpdate(paramGrads,self.learner.rate)
+                self.updates += 1
+            self.cond.notify_all()
+        return {},[]
+
+    def _epoch(self,header,matrices):
+        i = header['epoch']
+        with self.cond:
+            self.epochWorkers[i].add(header['worker'])
+            if len(self.epochWorkers[i])==self.numWorkers:
+                self.learner.epochTracer(self.learner,self.epochCounters.pop(i),i=i,startTime=self.startTime)
+        return {},[]
+
+    def _done(self,header,matrices):
+        with self.cond:
+            self.finished.add(header['worker'])
+            if self.staleness==0:
+                self._maybeEndRound()
+            self.cond.notify_all()
+        return {},[]
+
+    #
+    # synchronization
+    #
+
+    def _active(self):
+        return [w for w in range(self.numWorkers) if w not in self.finished]
+
+    def _progress(self):
+        """In synchronous mode, the number of rounds completed, and
+        otherwise the number of gradients pushed by the slowest active
+        worker."""
+        if self.staleness==0:
+            return self.rounds
+        return min([self.clock[w] for w in self._active()] or [sys.maxsize])
+
+    def _maybeEndRound(self):
+        """If every active worker has pushed its gradient for this
+        round, apply them all, as ParallelFixedRateGDLearner does."""
+        if self.pending and all(self.clock[w]>self.rounds for w in self._active()):
+            totalN = sum(n for (n,paramGrads) in self.pending)
+            self.learner.regularizer.regularizeParams(self.learner.prog,totalN)
+            for (n,paramGrads) in self.pending:
+                self.learner.applyUpdate(paramGrads,self.learner.rate*(float(n)/totalN))
+            self.updates += len(self.pending)
+            self.pending = []
+            self.rounds += 1
+
+##############################################################################
+# the workers
+##############################################################################
+
+class Worker(object):
+    """Computes gradients for a shard of a dataset with a learner, whose
+    program must have the same parameters as the server's.  Worker i
+    of k gets minibatches i, i+k, i+2k, ..., which it visits in a new
+    random order each epoch.
+    """
+
+    def __init__(self,learner,dset,address,workerId):
+        self.learner = learner
+        self.dset = dset
+        self.address = address
+        self.workerId = workerId
+        self.rand = NR.RandomState(workerId)
+
+    def _connect(self):
+        deadline = time.time() + conf.connect_timeout
+        while True:
+            try:
+                sock = socket.create_connection(self.address)
+                sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                return sock
+            except socket.error:
+                # the server may not have started yet
+                if time.time()>deadline: raise
+                time.sleep(0.5)
+
+    def _call(self,sock,header,matrices=()):
+        header['worker'] = self.workerId
+        sendMessage(sock,header,matrices)
+        reply,replyMatrices = recvMessage(sock)
+        assert 'error' not in reply,'parameter server error:\n%s' % reply.get('error')
+        return reply,replyMatrices
+
+    def _pull(self,sock,clock):
+        reply,params = self._call(sock,{'op':'pull','clock':clock})
+        for (functor,arity),m in zip(_keyTuples(reply['keys']),params):
+            self.learner.prog.db.setParameter(functor,arity,m)
+
+    def _push(self,sock,paramGrads,n,clock,epoch):
+        items = paramGrads.items()
+        counter = [(k,float(v)) for (k,v) in list(paramGrads.counter.items()) if isinstance(k,str)]
+        self._call(sock,{'op':'push','clock':clock,'epoch':epoch,'n':n,
+                         'keys':_keyList([key for (key,m) in items]),'counter':counter},
+                   [m for (key,m) in items])
+
+    def run(self):
+        sock = self._connect()
+        try:
+            info,_ = self._call(sock,{'op':'hello'})
+            k = info['numWorkers']
+            # for the tracer's status messages
+            self.learner.epochs = info['epochs']
+            batches = [b for (j,b) in enumerate(self.dset.minibatchIterator(batchSize=info['miniBatchSize'],shuffleFirst=False,prefetch=0))
+                       if j%k==self.workerId]
+            logging.info('worker %d of %d has %d minibatches' % (self.workerId,k,len(batches)))
+            clock = 0
+            for i in range(info['epochs']):
+                startTime = time.time()
+                for b in self.rand.permutation(len(batches)):
+                    (mode,X,Y) = batches[b]
+                    self._pull(sock,clock)
+                    args = {'i':i,'k':clock,'startTime':startTime,'mode':mode}
+                    paramGrads = self.learner.crossEntropyGrad(mode,X,Y,tracerArgs=args)
+                    self._push(sock,paramGrads,mutil.numRows(X),clock,i)
+                    clock += 1
+                self._call(sock,{'op':'epoch','epoch':i})
+            # leave the worker's program with the final parameters
+            self._pull(sock,clock)
+            self._call(sock,{'op':'done'})
+        finally:
+            sock.close()
+
+def _runWorker(learner,dset,address,workerId):
+    Worker(learner,dset,address,workerId).run()
+
+##############################################################################
+# a learner that runs the server and local workers
+##############################################################################
+
+class DistributedFixedRateSGDLearner(learn.FixedRateSGDLearner):
+    """Train with a ParameterServer for this learner's program and
+    parallel worker processes on this machine, which each get a COPY
+    of the program when train() is called.  parallel is the number of
+    workers, or None for the number of CPUs.  To use workers on other
+    hosts, run the server and workers from the command line instead.
+    """
+
+    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,
+                 miniBatchSize=100,parallel=None,staleness=None,epochTracer=None,
+                 host='localhost',port=0):
+        tracer = tracer or learn.Tracer.recordDefaults
+        super(DistributedFixedRateSGDLearner,self).__init__(
+            prog,epochs=epochs,rate=rate,regularizer=regularizer,
+            miniBatchSize=miniBatchSize,tracer=tracer)
+        self.epochTracer = epochTracer or learn.EpochTracer.default
+        self.parallel = parallel or multiprocessing.cpu_count()
+        self.staleness = conf.staleness if staleness is None else staleness
+        self.host = host
+        self.port = port
+
+    def train(self,dset):
+        server = ParameterServer(self,self.parallel,staleness=self.staleness,host=self.host,port=self.port)
+        workers = [multiprocessing.Process(target=_runWorker,args=(self,dset,server.address,w))
+                   for w in range(self.parallel)]
+        try:
+            # the server is listening already, so the workers can be
+            # forked before it starts its threads
+            for p in workers: p.start()
+            server.start()
+            while not server.wait(timeout=1.0):
+                failed = [w for w,p in enumerate(workers) if p.exitcode not in (None,0)]
+                assert not failed,'workers %r failed' % failed
+        finally:
+            server.stop()
+            for p in workers:
+                if p.is_alive(): p.terminate()
+                p.join()
+
+##############################################################################
+# running a server or a worker from the command line
+##############################################################################
+
+if __name__ == "__main__":
+    usageLines = [
+        'server options:',
+        '    --serve              # run the parameter server',
+        '    --workers k          # number of workers that will connect',
+        '    --port p             # port to listen on',
+        '    --epochs n --rate r --miniBatchSize b --staleness s',
+        '    --params p1/k1,..    # comma-sep list of functor/arity pairs',
+        '    --growable p1/k1,..  # parameters whose sparsity pattern can grow',
+        '    --savedModel e       # where to write the trained database',
+        'worker options:',
+        '    --worker i           # run worker i, which needs --trainData',
+        '    --server host:p      # address of the parameter server',
+    ]
+    argSpec = ["serve","workers=","port=","epochs=","rate=","miniBatchSize=","staleness=",
+               "params=","growable=","savedModel=","worker=","server="]
+    optdict,args = comline.parseCommandLine(
+        sys.argv[1:],
+        extraArgConsumer="pserver", extraArgSpec=argSpec, extraArgUsage=usageLines)
+    prog = optdict['prog']
+    if '--params' in optdict:
+        for spec in optdict['--params'].split(","):
+            functor,arity = spec.split("/")
+            prog.db.markAsParameter(functor,int(arity))
+    prog.setFeatureWeights()
+    prog.setRuleWeights()
+    if '--growable' in optdict:
+        for spec in optdict['--growable'].split(","):
+            functor,arity = spec.split("/")
+            prog.db.markAsGrowable(functor,int(arity))
+    if '--serve' in optdict:
+        learner = DistributedFixedRateSGDLearner(
+            prog,epochs=int(optdict.get('--epochs',10)),rate=float(optdict.get('--rate',0.1)),
+            miniBatchSize=int(optdict.get('--miniBatchSize',100)),parallel=int(optdict['--workers']),
+            staleness=int(optdict.get('--staleness',conf.staleness)))
+        server = ParameterServer(learner,learner.parallel,staleness=learner.staleness,
+                                 host='',port=int(optdict.get('--port',0)))
+        server.start()
+        server.wait()
+        server.stop()
+        if '--savedModel' in optdict:
+            prog.db.serialize(optdict['--savedModel'])
+    else:
+        assert '--worker' in optdict and '--server' in optdict,'either --serve, or --worker and --server, are required'
+        host,port = optdict['--server'].rsplit(':',1)
+        learner = learn.FixedRateSGDLearner(prog,tracer=learn.Tracer.default)
+        Worker(learner,optdict['trainData'],(host,int(port)),int(optdict['--worker'])).run()
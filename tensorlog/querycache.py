@@ -0,0 +1,116 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2016
+#
+# a cache for the results of evaluating a compiled program on
+# individual input rows
+#
+
+import collections
+import logging
+
+from tensorlog import config
+from tensorlog import mutil
+
+conf = config.Config()
+conf.max_entries = 100000;  conf.help.max_entries = 'Maximum number of rows stored in a query cache'
+conf.max_nnz = 0;           conf.help.max_nnz = 'Maximum number of non-zeros stored in a query cache, or 0 for no limit'
+
+class QueryCache(object):
+  """An LRU cache of the outputs of compiled functions, keyed by the
+  mode and the input row.  Each entry records the versions of the
+  database relations that the function reads, and it is discarded
+  when any of those relations changes, so results are never stale.
+  """
+
+  def __init__(self,maxEntries=None,maxNnz=None):
+    self.maxEntries = conf.max_entries if maxEntries is None else maxEntries
+    self.maxNnz = conf.max_nnz if maxNnz is None else maxNnz
+    # maps (mode,rowKey) to (versions,outputRow)
+    self._entries = collections.OrderedDict()
+    self._nnz = 0
+    self.stats = collections.Counter()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def clear(self):
+    self._entries = collections.OrderedDict()
+    self._nnz = 0
+
+  def hitRate(self):
+    n = self.stats['hits'] + self.stats['misses']
+    return float(self.stats['hits'])/n if n else 0.0
+
+  def eval(self,db,mode,fun,relations,inputs,evalFun):
+    """Evaluate fun on the inputs, a list of matrices with one row per
+    query, reusing cached output rows where possible.  Rows not in
+    the cache are evaluated together, with evalFun(inputs), and
+    stored.  relations is the collection of (functor,arity) pairs
+    read by fun.
+    """
+    # symbol ids are part of the key, since renumbering them changes
+    # the output even of modes that read no relations
+    versions = (db.symbolEpoch,) + tuple(db.getVersion(functor,arity) for (functor,arity) in relations)
+    outputDim = db.dim(fun.outputType)
+    numRows = mutil.numRows(inputs[0])
+    rowKeys = [(str(mode),QueryCache._rowKey(inputs,i)) for i in range(numRows)]
+    outputs = [None]*numRows
+    missing = []
+    for i,key in enumerate(rowKeys):
+      row = self._lookup(key,versions,outputDim)
+      if row is None:
+        missing.append(i)
+      else:
+        outputs[i] = row
+    if missing:
+      if len(missing)==numRows:
+        missingInputs = inputs
+      else:
+        missingInputs = [mutil.stack([mutil.selectRows(m,i,i+1) for i in missing]) for m in inputs]
+      result = evalFun(missingInputs)
+      for k,i in enumerate(missing):
+        outputs[i] = mutil.selectRows(result,k,k+1)
+        if len(missing)>1:
+          # don't keep the whole minibatch result alive for one row
+          outputs[i] = outputs[i].copy()
+        self._store(rowKeys[i],versions,outputs[i])
+      if len(missing)==numRows:
+        return result
+    return outputs[0] if numRows==1 else mutil.stack(outputs)
+
+  @staticmethod
+  def _rowKey(inputs,i):
+    key = []
+    for m in inputs:
+      lo,hi = m.indptr[i],m.indptr[i+1]
+      key.append(m.indices[lo:hi].tobytes())
+      key.append(m.data[lo:hi].tobytes())
+    return tuple(key)
+
+  def _lookup(self,key,versions,outputDim):
+    entry = self._entries.get(key)
+    if entry is None:
+      self.stats['misses'] += 1
+      return None
+    (cachedVersions,row) = entry
+    if cachedVersions!=versions or mutil.numCols(row)!=outputDim:
+      self._remove(key)
+      self.stats['invalidations'] += 1
+      self.stats['misses'] += 1
+      return None
+    self._entries.move_to_end(key)
+    self.stats['hits'] += 1
+    return row
+
+  def _store(self,key,versions,row):
+    if key in self._entries:
+      self._remove(key)
+    self._entries[key] = (versions,row)
+    self._nnz += row.nnz
+    while self._entries and (len(self._entries)>self.maxEntries or (self.maxNnz and self._nnz>self.maxNnz)):
+      oldest = next(iter(self._entries))
+      self._remove(oldest)
+      self.stats['evictions'] += 1
+
+  def _remove(self,key):
+    (_,row) = self._entries.pop(key)
+    self._nnz -= row.nnz
@@ -0,0 +1,183 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# renumber the entities of a database so that related entities get
+# nearby ids.  This makes the non-zeros of messages and relations fall
+# in narrower ranges of columns, so mutil.densify succeeds more often
+# and sparse products have better locality.  Usage:
+#
+#  python -m tensorlog.reorder --db foo.cfacts|foo.db --out bar.db [--method rcm|degree] [--dset in.dset --dsetOut out.dset]
+#
+
+import getopt
+import sys
+import time
+
+import numpy as NP
+import numpy.random as NR
+import scipy.sparse as SS
+import scipy.sparse.csgraph
+
+from tensorlog import comline
+from tensorlog import dataset
+from tensorlog import mutil
+
+# ids of the symbols that are in every type, which keep their ids
+NUM_RESERVED_IDS = 3
+
+def entityOrder(db,typeName=None,method='rcm'):
+  """Return an array newToOld which lists the ids of the entities of a
+  type in their new order.  For method 'rcm' this is the reverse
+  Cuthill-McKee order of the graph of binary relations between
+  entities of the type, which places entities that are linked close
+  together.  For method 'degree', and for 'rcm' if there are no such
+  relations, entities are ordered by decreasing number of facts
+  they appear in.
+  """
+  assert method in ['rcm','degree'], 'unknown reordering method %r' % method
+  typeName = db._fillDefault(typeName)
+  db.flushUpdates()
+  n = db.dim(typeName)
+  if method=='rcm':
+    graph = _linkGraph(db,typeName,n)
+    if graph.nnz:
+      order = scipy.sparse.csgraph.reverse_cuthill_mckee(graph,symmetric_mode=True)
+      return _withReservedIdsFirst(order)
+  degree = _degrees(db,typeName,n)
+  order = NUM_RESERVED_IDS + NP.argsort(-degree[NUM_RESERVED_IDS:],kind='stable')
+  return _withReservedIdsFirst(order)
+
+def _withReservedIdsFirst(order):
+  order = NP.asarray(order,dtype=mutil.LONG_INDEX_DTYPE)
+  rest = order[order>=NUM_RESERVED_IDS]
+  return NP.concatenate([NP.arange(NUM_RESERVED_IDS,dtype=mutil.LONG_INDEX_DTYPE),rest])
+
+def _argTypes(db,functor,arity):
+  return [db.schema.getArgType(functor,arity,i) for i in range(arity)]
+
+def _linkGraph(db,typeName,n):
+  """Symmetric 0/1 adjacency matrix over entities of a type, linking
+  entities that appear together in a binary relation."""
+  graph = SS.csr_matrix((n,n),dtype=mutil.DATA_DTYPE)
+  for (functor,arity) in db.relationKeys():
+    if arity==2 and _argTypes(db,functor,arity)==[typeName,typeName]:
+      pattern = mutil.mapData(NP.sign,db.relationMatrix(functor,arity))
+      graph = graph + pattern + pattern.transpose()
+  return graph.tocsr()
+
+def _degrees(db,typeName,n):
+  """Number of facts each entity of a type appears in."""
+  degree = NP.zeros(n,dtype=mutil.LONG_INDEX_DTYPE)
+  for (functor,arity) in db.relationKeys():
+    argTypes = _argTypes(db,functor,arity)
+    m = db.relationMatrix(functor,arity)
+    if arity==1 and argTypes[0]==typeName:
+      degree += NP.bincount(m.indices,minlength=n)
+    elif arity==2:
+      if argTypes[0]==typeName: degree[:m.shape[0]] += NP.diff(m.indptr)
+      if argTypes[1]==typeName: degree += NP.bincount(m.indices,minlength=n)
+  return degree
+
+def reorderDB(db,method='rcm',types=None):
+  """Renumber the entities of each of the given types (by default, all
+  types) of a database in place.  Returns a dictionary mapping each
+  type name to an array oldToNew, which can be used to relabel
+  matrices that use the old numbering - see reorderDataset."""
+  if types is None: types = db.schema.getTypes()
+  result = {}
+  for typeName in types:
+    result[typeName] = db.permuteSymbols(typeName,entityOrder(db,typeName,method))
+  return result
+
+def reorderDataset(dset,xOldToNew,yOldToNew=None):
+  """Relabel the columns of the matrices in a dataset, built for a
+  database before it was reordered, to match the new numbering.  If
+  yOldToNew is not given, it's the same as xOldToNew.  Returns a new
+  Dataset."""
+  if yOldToNew is None: yOldToNew = xOldToNew
+  xDict = {}
+  yDict = {}
+  for mode in dset.modesToLearn():
+    xDict[mode] = mutil.relabel(dset.getX(mode),colMap=xOldToNew)
+    yDict[mode] = mutil.relabel(dset.getY(mode),colMap=yOldToNew)
+  return dataset.Dataset(xDict,yDict)
+
+#
+# measure the effect of reordering
+#
+
+def sampleQueries(db,numQueries=100,seed=0):
+  """For each binary relation, a matrix of one-hot rows for a sample of
+  entities in its domain.  The sample is chosen by symbol, not id, so
+  it is the same before and after the database is reordered."""
+  result = {}
+  for (functor,arity) in db.relationKeys():
+    if arity!=2: continue
+    m = db.relationMatrix(functor,arity)
+    domainType = db.schema.getArgType(functor,arity,0)
+    ids = NP.flatnonzero(NP.diff(m.indptr))
+    if not len(ids): continue
+    symbols = sorted(db.schema.getSymbol(domainType,i) for i in ids)
+    chosen = NR.RandomState(seed).choice(len(symbols),size=numQueries)
+    rows = [db.schema.getId(domainType,symbols[k]) for k in chosen]
+    result[(functor,arity)] = mutil.csrFromCOO(NP.ones(numQueries),NP.arange(numQueries),rows,
+                                               (numQueries,db.dim(domainType)),'sampleQueries')
+  return result
+
+def benchmark(db,queries,repeats=5):
+  """Multiply each batch of queries by its relation, and twice by the
+  relation if it maps a type to itself.  Returns a dictionary with
+  the throughput in output non-zeros per second of the products
+  ('spmm_nnz_per_sec'), and the fraction of products for which
+  mutil.densify succeeds ('densify_rate').
+  """
+  elapsed = 0.0
+  outputNnz = 0
+  densified = 0
+  products = 0
+  for (functor,arity),X in sorted(queries.items()):
+    M = db.matrix(_mode(functor))
+    sameType = M.shape[0]==M.shape[1] and len(set(_argTypes(db,functor,arity)))==1
+    start = time.time()
+    for r in range(repeats):
+      P = X*M
+      if sameType: P2 = P*M
+    elapsed += time.time() - start
+    results = [P,P2] if sameType else [P]
+    for Q in results:
+      outputNnz += Q.nnz*repeats
+      products += 1
+      if Q.nnz and mutil.densify(Q)[0] is not None: densified += 1
+  return {'spmm_nnz_per_sec': outputNnz/elapsed if elapsed else 0.0,
+          'densify_rate': float(densified)/products if products else 0.0}
+
+def _mode(functor):
+  from tensorlog import declare
+  return declare.asMode('%s(i,o)' % functor)
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.reorder --db dbspec --out bar.db [--method rcm|degree] [--dset in.dset --dsetOut out.dset]')
+    print('  renumber the entities of an untyped or typed database, and report the speed of')
+    print('  sparse products and the rate at which densify succeeds before and after')
+  argspec = ["db=","out=","method=","dset=","dsetOut="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if '--db' not in optdict or '--out' not in optdict:
+    usage()
+    sys.exit(-1)
+  db = comline.parseDBSpec(optdict['--db'])
+  dset = dataset.Dataset.deserialize(optdict['--dset']) if '--dset' in optdict else None
+  before = benchmark(db,sampleQueries(db))
+  maps = reorderDB(db,method=optdict.get('--method','rcm'))
+  after = benchmark(db,sampleQueries(db))
+  for key in sorted(before):
+    print('%s: before %g after %g' % (key,before[key],after[key]))
+  db.serialize(optdict['--out'])
+  if dset is not None:
+    assert db.isTypeless(), 'only datasets for untyped databases can be reordered from the command line'
+    oldToNew = list(maps.values())[0]
+    reorderDataset(dset,oldToNew).serialize(optdict['--dsetOut'])
@@ -308,11 +308,17 @@ class Compiler(object):
     else:
       assert False,'illegal dataset object %r' % dataset_obj
 
-  def minibatches(self,dataset_obj,batch_size=100,shuffle_first=True):
+  def minibatches(self,dataset_obj,batch_size=100,shuffle_first=True,prefetch=None):
     """Yields a series of pairs (mode,(X,Y)) where X and Y are a minibatch
     suitable for training the function designated by mode.  Input is
     something returned by load_small_dataset or load_big_dataset.
+
+    If prefetch is positive, up to that many minibatches are built and
+    wrapped on a background thread while the caller trains on the
+    current one.  The default is tensorlog.dataset.conf.prefetch_minibatches.
     """
+    def wrapped(mode,bx,by):
+      return str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
     if isinstance(dataset_obj,dict):
       dataset_dict = dataset_obj
       x_dict = {}
@@ -321,15 +327,13 @@ class Compiler(object):
         mode = declare.asMode(mode_str)
         x_dict[mode] = self.xc.unwrapInput(x)
         y_dict[mode] = self.xc.unwrapInput(y)
-        dset = dataset.Dataset(x_dict,y_dict)
-      for mode,bx,by in dset.minibatchIterator(batchSize=batch_size,shuffleFirst=shuffle_first):
-        yield str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
+      dset = dataset.Dataset(x_dict,y_dict)
     elif isinstance(dataset_obj, dataset.Dataset):
       dset = dataset_obj
-      for mode,bx,by in dset.minibatchIterator(batchSize=batch_size,shuffleFirst=shuffle_first):
-        yield str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
     else:
       assert False,'illegal dataset object %r' % dataset_obj
+    for item in dset.minibatchIterator(batchSize=batch_size,shuffleFirst=shuffle_first,prefetch=prefetch,transform=wrapped):
+      yield item
 
   def load_big_dataset(self,dataset_spec,verbose=True):
     """Return a dataset object, which can be used as the first argument to
@@ -339,7 +343,10 @@ class Compiler(object):
     Args:
 
       dataset_spec: a string specifying a tensorlog.dataset.Dataset.
-    See documents for load_small_dataset.
+    See documents for load_small_dataset.  A spec ending in .mdset
+    (or of the form "foo.mdset|bar.exam") is a memory-mapped
+    tensorlog.dataset.MemmapDataset, which is kept on disk and read
+    one minibatch at a time, so it can be larger than memory.
     """
 
     dset = self._as_dataset(dataset_spec)
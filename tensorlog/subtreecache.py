@@ -0,0 +1,114 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# caching the outputs of parameter-free subtrees across epochs.  In
+# a compiled function, an op whose output depends only on the input
+# rows and on relations that aren't parameters (eg the hasWord(X,W)
+# branch of a ProPPR feature rule) computes the same thing for an
+# example every epoch.  The compiler marks such ops - see
+# funs.OpSeqFunction.markParameterFree - and a learner with a
+# SubtreeCache stores their outputs for each example, so later epochs
+# only evaluate (and backprop through) the parameter-dependent ops.
+#
+# Outputs are stored per example, keyed by the example's input row,
+# so they are found even when minibatches are reshuffled.  Entries
+# are discarded, least recently used first, to stay within
+# conf.budget bytes, and are not used after a relation the cached ops
+# read changes, or symbols are renumbered.
+
+import collections
+
+import numpy as NP
+
+from tensorlog import config
+from tensorlog import mutil
+
+conf = config.Config()
+conf.budget = 256*1024*1024;  conf.help.budget = 'Bytes of cached subtree outputs a learner may keep, or 0 to disable caching'
+
+# rough size of the python objects holding a cached row
+_ENTRY_OVERHEAD = 200
+
+class SubtreeCache(object):
+  """Per-example outputs of the parameter-free ops of compiled
+  functions, for a learner."""
+
+  def __init__(self,budget=None):
+    self.budget = conf.budget if budget is None else budget
+    # (function,versions,rowKey) -> list of (indices,data) pairs, one
+    # for each cached variable of the function
+    self.rows = collections.OrderedDict()
+    self.numCols = {}
+    self.bytes = 0
+    self.hits = self.misses = 0
+
+  def view(self,X):
+    """A SubtreeCacheView, which functions evaluated on input X use to
+    find and store cached outputs - see opfunutil.Scratchpad.memo."""
+    return SubtreeCacheView(self,X)
+
+  def lookup(self,fun,versions,variables,rowKeys):
+    """Return a dictionary mapping each variable to a matrix with one
+    row per rowKey, or None unless every row is cached."""
+    entries = []
+    for rowKey in rowKeys:
+      entry = self.rows.get((fun,versions,rowKey))
+      if entry is None:
+        self.misses += 1
+        return None
+      self.rows.move_to_end((fun,versions,rowKey))
+      entries.append(entry)
+    self.hits += 1
+    result = {}
+    for k,v in enumerate(variables):
+      rowIndices = [entry[k][0] for entry in entries]
+      rowData = [entry[k][1] for entry in entries]
+      indices = NP.concatenate(rowIndices)
+      shape = (len(entries),self.numCols[(fun,v)])
+      indptr = NP.zeros(len(entries)+1,dtype=mutil.indexDtype(max(shape[0],shape[1],len(indices))))
+      NP.cumsum([len(ix) for ix in rowIndices],out=indptr[1:])
+      result[v] = mutil.csr(NP.concatenate(rowData),indices,indptr,shape,'SubtreeCache')
+    return result
+
+  def store(self,fun,versions,variables,values,rowKeys):
+    """Store row i of each value for the example with key rowKeys[i]."""
+    if self.budget<=0: return
+    mats = [mutil.asCSR(values[v],'SubtreeCache') for v in variables]
+    for v,m in zip(variables,mats):
+      self.numCols[(fun,v)] = mutil.numCols(m)
+    for i,rowKey in enumerate(rowKeys):
+      key = (fun,versions,rowKey)
+      if key in self.rows: continue
+      entry = [(m.indices[m.indptr[i]:m.indptr[i+1]].copy(),m.data[m.indptr[i]:m.indptr[i+1]].copy()) for m in mats]
+      self.rows[key] = entry
+      self.bytes += self._entryBytes(entry)
+    while self.bytes>self.budget and self.rows:
+      key,entry = self.rows.popitem(last=False)
+      self.bytes -= self._entryBytes(entry)
+
+  @staticmethod
+  def _entryBytes(entry):
+    return _ENTRY_OVERHEAD + sum(ix.nbytes + d.nbytes for (ix,d) in entry)
+
+class SubtreeCacheView(object):
+  """The part of a SubtreeCache used for one input matrix X, which
+  computes the keys of X's rows once."""
+
+  def __init__(self,cache,X):
+    self.cache = cache
+    self.X = X
+    self._rowKeys = None
+
+  def rowKeys(self):
+    if self._rowKeys is None:
+      X = mutil.asCSR(self.X,'SubtreeCacheView')
+      ix = X.indices
+      d = X.data
+      p = X.indptr
+      self._rowKeys = [(ix[p[i]:p[i+1]].tobytes(),d[p[i]:p[i+1]].tobytes()) for i in range(mutil.numRows(X))]
+    return self._rowKeys
+
+  def lookup(self,fun,versions,variables):
+    return self.cache.lookup(fun,versions,variables,self.rowKeys())
+
+  def store(self,fun,versions,variables,values):
+    self.cache.store(fun,versions,variables,values,self.rowKeys())
@@ -0,0 +1,399 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# generate large synthetic knowledge bases and examples for scaling
+# experiments.  Facts are generated as NumPy arrays and written
+# directly in the serialized MatrixDB and MemmapDataset formats, so
+# that loading them skips parsing text.  Usage:
+#
+#  python -m tensorlog.synthkb --kind grid|powerlaw|typed|smokers --n N [--seed s] --out dir [--cfacts foo.cfacts] [--exam foo.exam] [--rules foo.ppr]
+#
+# writes the database to dir/db, which can be loaded with
+# MatrixDB.deserialize(dir/db,lazy=True), the examples to dir/examples,
+# which can be opened with dataset.MemmapDataset(dir/examples), and the
+# rules to dir/rules.ppr.  Optionally the facts and examples are also
+# written as text.
+
+import getopt
+import os
+import os.path
+import sys
+import time
+
+import numpy as NP
+import numpy.random as NR
+
+from tensorlog import dataset
+from tensorlog import dbschema
+from tensorlog import declare
+from tensorlog import matrixdb
+from tensorlog import mutil
+
+# ids 1 and 2 are the null and out-of-vocabulary entities in every type
+FIRST_ENTITY_ID = 3
+
+class SyntheticKB(object):
+  """A generated knowledge base.  Entities are referred to by their
+  position in the list of names for their type, starting at zero, and
+  relations and examples are stored as arrays of these positions.
+  In an untyped KB every entity has type matrixdb.THING.
+  """
+
+  def __init__(self,typed=False):
+    self.typed = typed
+    # names[typeName] is the list of entity names for the type
+    self.names = {}
+    # relations[(functor,arity)] = (argTypes,argArrays,weights), where
+    # weights is None for an unweighted relation
+    self.relations = {}
+    # examples[functor] = (xType,yType,xs,yRows,yCols), where the
+    # answers for query xs[i] are the yCols[k] with yRows[k]==i
+    self.examples = {}
+    # types of predicates that are defined by rules, in a typed KB
+    self.declarations = {}
+    self.rules = []
+    self.proppr = False
+    self.parameters = []
+
+  def addEntities(self,typeName,names):
+    """Add entities to a type, and return the position of the first."""
+    typeName = self._typeName(typeName)
+    current = self.names.setdefault(typeName,[])
+    first = len(current)
+    current.extend(names)
+    return first
+
+  def numEntities(self,typeName):
+    return len(self.names.get(self._typeName(typeName),[]))
+
+  def addRelation(self,functor,argTypes,args,weights=None):
+    """Add a relation, given a list of types and a list of arrays of
+    entity positions, one for each argument.  Duplicate facts are
+    removed from unweighted relations."""
+    argTypes = [self._typeName(t) for t in argTypes]
+    args = [NP.asarray(a,dtype=mutil.LONG_INDEX_DTYPE) for a in args]
+    assert len(argTypes)==len(args) and len(args) in [1,2], 'relations must be unary or binary'
+    if weights is None and len(args[0]):
+      if len(args)==1:
+        args = [NP.unique(args[0])]
+      else:
+        width = args[1].max() + 1
+        keys = NP.unique(args[0]*width + args[1])
+        args = [keys//width,keys%width]
+    self.relations[(functor,len(args))] = (argTypes,args,weights)
+
+  def addExamples(self,functor,xType,yType,xs,yRows,yCols):
+    self.examples[functor] = (self._typeName(xType),self._typeName(yType),
+                              NP.asarray(xs,dtype=mutil.LONG_INDEX_DTYPE),
+                              NP.asarray(yRows,dtype=mutil.LONG_INDEX_DTYPE),
+                              NP.asarray(yCols,dtype=mutil.LONG_INDEX_DTYPE))
+    if self.typed:
+      self.declarations[functor] = [self._typeName(xType),self._typeName(yType)]
+
+  def _typeName(self,typeName):
+    return typeName if self.typed else matrixdb.THING
+
+  def numFacts(self):
+    return sum(len(args[0]) for (argTypes,args,weights) in self.relations.values())
+
+  #
+  # conversion to a database and a dataset
+  #
+
+  def toMatrixDB(self):
+    """Build a MatrixDB holding the KB's relations, without going
+    through text."""
+    if self.typed:
+      db = matrixdb.MatrixDB(initSchema=dbschema.TypedSchema())
+      for (functor,arity),(argTypes,args,weights) in sorted(self.relations.items()):
+        db.schema.declarePredicateTypes(functor,argTypes)
+      for functor,argTypes in sorted(self.declarations.items()):
+        db.schema.declarePredicateTypes(functor,argTypes)
+      for typeName in sorted(self.names):
+        if typeName not in db.schema.getTypes():
+          db.schema.insertType(typeName)
+    else:
+      db = matrixdb.MatrixDB()
+    for typeName in sorted(self.names):
+      first = db.schema.insertSymbols(typeName,self.names[typeName])
+      assert first==FIRST_ENTITY_ID, 'entity names of type %s collide with reserved names' % typeName
+    for (functor,arity),(argTypes,args,weights) in sorted(self.relations.items()):
+      n = len(args[0])
+      data = NP.ones(n) if weights is None else NP.broadcast_to(NP.asarray(weights,dtype=mutil.DATA_DTYPE),(n,))
+      if arity==1:
+        rows = NP.zeros(n,dtype=mutil.LONG_INDEX_DTYPE)
+        shape = (1,db.dim(argTypes[0]))
+      else:
+        rows = args[0] + FIRST_ENTITY_ID
+        shape = (db.dim(argTypes[0]),db.dim(argTypes[1]))
+      m = mutil.csrFromCOO(data,rows,args[-1] + FIRST_ENTITY_ID,shape,'SyntheticKB')
+      db.matEncoding[(functor,arity)] = db._compacted((functor,arity),m)
+    for (functor,arity) in self.parameters:
+      db.markAsParameter(functor,arity)
+    return db
+
+  def exampleMatrices(self,db,functor):
+    """Return the X and Y matrices for the examples of a predicate,
+    normalized as in dataset.Dataset.loadExamples."""
+    (xType,yType,xs,yRows,yCols) = self.examples[functor]
+    n = len(xs)
+    X = mutil.csrFromCOO(NP.ones(n),NP.arange(n),xs + FIRST_ENTITY_ID,(n,db.dim(xType)),'SyntheticKB')
+    yData = NP.ones(len(yRows))
+    if dataset.conf.normalize_outputs and len(yRows):
+      yData = 1.0/NP.bincount(yRows,minlength=n)[yRows]
+    Y = mutil.csrFromCOO(yData,yRows,yCols + FIRST_ENTITY_ID,(n,db.dim(yType)),'SyntheticKB')
+    return X,Y
+
+  def toDataset(self,db):
+    xDict = {}
+    yDict = {}
+    for functor in sorted(self.examples):
+      mode = declare.asMode('%s/io' % functor)
+      xDict[mode],yDict[mode] = self.exampleMatrices(db,functor)
+    return dataset.Dataset(xDict,yDict)
+
+  #
+  # output
+  #
+
+  def write(self,direc):
+    """Write the database to direc/db in the per-relation format, the
+    examples to direc/examples as a MemmapDataset, and the rules to
+    direc/rules.ppr.  Returns the database."""
+    if not os.path.exists(direc):
+      os.makedirs(direc)
+    db = self.toMatrixDB()
+    db.serialize(os.path.join(direc,'db'),perRelation=True)
+    writer = dataset.MemmapDatasetWriter(os.path.join(direc,'examples'))
+    for functor in sorted(self.examples):
+      X,Y = self.exampleMatrices(db,functor)
+      writer.addRows(declare.asMode('%s/io' % functor),X,Y)
+    writer.close()
+    self.writeRules(os.path.join(direc,'rules.ppr'))
+    return db
+
+  def writeRules(self,fileName):
+    with open(fileName,'w') as fp:
+      for rule in self.rules:
+        fp.write(rule + '\n')
+
+  def writeCFacts(self,fileName,linesPerChunk=1000000):
+    """Write the relations as a .cfacts file, with type declarations if
+    the KB is typed."""
+    with open(fileName,'w') as fp:
+      if self.typed:
+        for (functor,arity),(argTypes,args,weights) in sorted(self.relations.items()):
+          fp.write('# :- %s(%s)\n' % (functor,','.join(argTypes)))
+        for functor,argTypes in sorted(self.declarations.items()):
+          fp.write('# :- %s(%s)\n' % (functor,','.join(argTypes)))
+      for (functor,arity) in self.parameters:
+        fp.write('# :- %s(%s,%d)\n' % (matrixdb.TRAINABLE_DECLARATION_FUNCTOR,functor,arity))
+      for (functor,arity),(argTypes,args,weights) in sorted(self.relations.items()):
+        names = [self.names[t] for t in argTypes]
+        n = len(args[0])
+        w = None if weights is None else NP.broadcast_to(NP.asarray(weights),(n,))
+        for lo in range(0,n,linesPerChunk):
+          hi = min(n,lo+linesPerChunk)
+          cols = [[names[i][j] for j in args[i][lo:hi]] for i in range(arity)]
+          if w is not None:
+            cols.append(['%g' % x for x in w[lo:hi]])
+          fp.write(''.join('\t'.join((functor,) + fields) + '\n' for fields in zip(*cols)))
+
+  def writeExamples(self,fileName):
+    """Write the examples as a .exam file."""
+    with open(fileName,'w') as fp:
+      for functor in sorted(self.examples):
+        (xType,yType,xs,yRows,yCols) = self.examples[functor]
+        order = NP.argsort(yRows,kind='stable')
+        starts = NP.searchsorted(yRows[order],NP.arange(len(xs)+1))
+        xNames,yNames = self.names[xType],self.names[yType]
+        for i,x in enumerate(xs):
+          ys = [yNames[j] for j in yCols[order[starts[i]:starts[i+1]]]]
+          fp.write('\t'.join([functor,xNames[x]] + ys) + '\n')
+
+#
+# random graphs
+#
+
+def powerLawTargets(rs,numNodes,numEdges,exponent):
+  """Sample numEdges node positions from 0...numNodes-1, so that the
+  number of times each node is chosen follows a power law with the
+  given exponent.  This is the Chung-Lu model, which gives the same
+  degree distribution as preferential attachment, but is sampled
+  with a few vectorized operations."""
+  weights = NP.arange(1,numNodes+1,dtype=NP.float64) ** (-1.0/(exponent-1.0))
+  cumulative = NP.cumsum(weights)
+  ranks = NP.searchsorted(cumulative,rs.rand(numEdges)*cumulative[-1])
+  # the high-degree nodes shouldn't all have the smallest ids
+  return rs.permutation(numNodes)[NP.minimum(ranks,numNodes-1)]
+
+def neighborExamples(kb,functor,relation,queries):
+  """Add examples for functor, where the answers for each query
+  entity are its neighbors in a binary relation."""
+  (argTypes,args,weights) = kb.relations[(relation,2)]
+  m = mutil.csrFromCOO(NP.ones(len(args[0])),args[0],args[1],
+                       (kb.numEntities(argTypes[0]),kb.numEntities(argTypes[1])),'neighborExamples')
+  answers = mutil.gatherRows(m,queries)
+  # queries without any answers are dropped
+  hasAnswer = NP.diff(answers.indptr)>0
+  answers = mutil.gatherRows(answers,NP.flatnonzero(hasAnswer))
+  kb.addExamples(functor,argTypes[0],argTypes[1],queries[hasAnswer],mutil.rowIndices(answers),answers.indices)
+
+#
+# generators
+#
+
+def grid(n,edgeWeight=0.2):
+  """An n-by-n grid where each cell is linked to itself and its
+  neighbors, with the rules and examples of datasets/grid: the
+  target for each cell is the nearest corner."""
+  kb = SyntheticKB()
+  i,j = NP.divmod(NP.arange(n*n,dtype=mutil.LONG_INDEX_DTYPE),n)
+  kb.addEntities(None,['%d,%d' % (a+1,b+1) for a,b in zip(i.tolist(),j.tolist())])
+  src = []
+  dst = []
+  for di in [-1,0,+1]:
+    for dj in [-1,0,+1]:
+      ok = (i+di>=0) & (i+di<n) & (j+dj>=0) & (j+dj<n)
+      src.append((i*n+j)[ok])
+      dst.append(((i+di)*n+(j+dj))[ok])
+  kb.addRelation('edge',[None,None],[NP.concatenate(src),NP.concatenate(dst)],weights=edgeWeight)
+  kb.rules = ['path(X,Y) :- edge(X,Y).', 'path(X,Y) :- edge(X,Z), path(Z,Y).']
+  kb.parameters = [('edge',2)]
+  corner = lambda a: NP.where(a < n//2, 0, n-1)
+  cells = NP.arange(n*n)
+  kb.addExamples('path',None,None,cells,cells,corner(i)*n + corner(j))
+  return kb
+
+def powerLaw(n,edgesPerNode=5,exponent=2.1,symmetric=True,numQueries=1000,seed=0):
+  """A graph with a power-law degree distribution, where each node
+  links to edgesPerNode others, as in preferential attachment.
+  Examples ask for the neighbors of random nodes."""
+  rs = NR.RandomState(seed)
+  kb = SyntheticKB()
+  kb.addEntities(None,['v%d' % k for k in range(n)])
+  src = NP.repeat(NP.arange(n,dtype=mutil.LONG_INDEX_DTYPE),edgesPerNode)
+  dst = powerLawTargets(rs,n,len(src),exponent)
+  if symmetric:
+    src,dst = NP.concatenate([src,dst]),NP.concatenate([dst,src])
+  kb.addRelation('link',[None,None],[src,dst])
+  kb.rules = ['neighbor(X,Y) :- link(X,Y).']
+  kb.parameters = [('link',2)]
+  neighborExamples(kb,'neighbor','link',rs.choice(n,size=min(n,numQueries),replace=False))
+  return kb
+
+def typedMultiRelational(n,numTypes=4,numRelations=12,edgesPerEntity=5,exponent=2.1,
+                         numTargets=4,numQueries=1000,seed=0):
+  """A typed KB with numTypes types of n entities each, and binary
+  relations between random pairs of types with power-law degrees.
+  Each target predicate is defined by a chain of two relations, and
+  examples ask for the answers to the chain."""
+  rs = NR.RandomState(seed)
+  kb = SyntheticKB(typed=True)
+  types = ['type%d' % t for t in range(numTypes)]
+  for t,typeName in enumerate(types):
+    kb.addEntities(typeName,['t%de%d' % (t,k) for k in range(n)])
+  relTypes = []
+  for r in range(numRelations):
+    (a,b) = rs.randint(numTypes,size=2)
+    src = rs.randint(n,size=n*edgesPerEntity)
+    dst = powerLawTargets(rs,n,len(src),exponent)
+    kb.addRelation('r%d' % r,[types[a],types[b]],[src,dst])
+    relTypes.append((a,b))
+  kb.parameters = [('r%d' % r,2) for r in range(numRelations)]
+  for t in range(numTargets):
+    first = rs.randint(numRelations)
+    nexts = [r for r in range(numRelations) if relTypes[r][0]==relTypes[first][1]]
+    second = nexts[rs.randint(len(nexts))] if nexts else None
+    functor = 'target%d' % t
+    if second is None:
+      kb.rules.append('%s(X,Y) :- r%d(X,Y).' % (functor,first))
+      yType = relTypes[first][1]
+    else:
+      kb.rules.append('%s(X,Y) :- r%d(X,Z), r%d(Z,Y).' % (functor,first,second))
+      yType = relTypes[second][1]
+    m1 = _relationMatrix(kb,'r%d' % first)
+    m = m1 if second is None else mutil.asCSR(m1*_relationMatrix(kb,'r%d' % second),'typedMultiRelational')
+    queries = rs.choice(n,size=min(n,numQueries),replace=False)
+    answers = mutil.gatherRows(m,queries)
+    hasAnswer = NP.diff(answers.indptr)>0
+    answers = mutil.gatherRows(answers,NP.flatnonzero(hasAnswer))
+    kb.addExamples(functor,types[relTypes[first][0]],types[yType],queries[hasAnswer],
+                   mutil.rowIndices(answers),answers.indices)
+  return kb
+
+def _relationMatrix(kb,functor):
+  (argTypes,args,weights) = kb.relations[(functor,2)]
+  return mutil.csrFromCOO(NP.ones(len(args[0])),args[0],args[1],
+                          (kb.numEntities(argTypes[0]),kb.numEntities(argTypes[1])),'synthkb')
+
+def smokers(n,numCommunities=4,edgesPerPerson=5,crossEdges=25,exponent=2.1,seed=0):
+  """A social network like the one built by datasets/smokers/scaleup/gen.py:
+  numCommunities communities of n people, each with power-law
+  friendships, a few friendships between communities, and cancer
+  and smokes facts that depend on the community.  It comes with the
+  ProPPR rules of the smokers program, and no examples."""
+  rs = NR.RandomState(seed)
+  kb = SyntheticKB()
+  kb.proppr = True
+  tags = [chr(ord('a')+c) for c in range(numCommunities)]
+  kb.addEntities(None,['yes','no'])
+  kb.addEntities(None,['r%d' % k for k in range(1,9)])
+  firstPerson = kb.addEntities(None,['%s%d' % (tag,i) for tag in tags for i in range(n)])
+  kb.addRelation('const',[None],[NP.array([0,1])])
+  kb.addRelation('rule',[None],[NP.arange(2,10)])
+  src = []
+  dst = []
+  for c in range(numCommunities):
+    s = NP.repeat(NP.arange(n),edgesPerPerson)
+    src.append(firstPerson + c*n + s)
+    dst.append(firstPerson + c*n + powerLawTargets(rs,n,len(s),exponent))
+  numCross = crossEdges*numCommunities*numCommunities
+  src.append(firstPerson + rs.randint(n*numCommunities,size=numCross))
+  dst.append(firstPerson + rs.randint(n*numCommunities,size=numCross))
+  src,dst = NP.concatenate(src),NP.concatenate(dst)
+  kb.addRelation('friends',[None,None],[NP.concatenate([src,dst]),NP.concatenate([dst,src])])
+  people = firstPerson + NP.arange(n*numCommunities)
+  community = NP.arange(n*numCommunities)//n
+  kb.addRelation('person',[None],[people])
+  kb.addRelation('cancer',[None],[people[community%2==1]])
+  kb.addRelation('smokes',[None],[people[community>=numCommunities//2]])
+  kb.rules = [
+    't_stress(P,Yes) :- assign(Yes,yes),person(P) {r1}.',
+    't_influences(P1,P2) :- friends(P1,P2) {r2}.',
+    't_cancer_spont(P,Yes) :- assign(Yes,yes),person(P) {r3}.',
+    't_cancer_smoke(P,Yes) :- assign(Yes,yes),person(P) {r4}.',
+    't_smokes(X,Yes) :- t_stress(X,Yes) {r5}.',
+    't_smokes(X,Yes) :- assign(Yes,yes), smokes(Y), t_influences(Y,X) {r6}.',
+    't_cancer(P,Yes) :- t_cancer_spont(P,Yes) {r7}.',
+    't_cancer(P,Yes) :- t_smokes(P,Yes), t_cancer_smoke(P,Yes ) {r8}.']
+  return kb
+
+GENERATORS = {'grid':grid, 'powerlaw':powerLaw, 'typed':typedMultiRelational, 'smokers':smokers}
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.synthkb --kind grid|powerlaw|typed|smokers --n N [--seed s] --out dir')
+    print('                                   [--cfacts foo.cfacts] [--exam foo.exam] [--rules foo.ppr]')
+    print('  for grid, N is the width of the grid; otherwise it is the number of entities of each type')
+  argspec = ["kind=","n=","seed=","out=","cfacts=","exam=","rules="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if '--kind' not in optdict or '--n' not in optdict or '--out' not in optdict:
+    usage()
+    sys.exit(-1)
+  kind = optdict['--kind']
+  assert kind in GENERATORS, 'unknown kind of KB %r' % kind
+  n = int(optdict['--n'])
+  start = time.time()
+  kb = GENERATORS[kind](n) if kind=='grid' else GENERATORS[kind](n,seed=int(optdict.get('--seed',0)))
+  print('generated %d facts in %.1f sec' % (kb.numFacts(),time.time()-start))
+  start = time.time()
+  db = kb.write(optdict['--out'])
+  print('wrote database with %d relations and %d non-zeros to %s in %.1f sec' % (db.numMatrices(),db.size(),optdict['--out'],time.time()-start))
+  if '--cfacts' in optdict: kb.writeCFacts(optdict['--cfacts'])
+  if '--exam' in optdict: kb.writeExamples(optdict['--exam'])
+  if '--rules' in optdict: kb.writeRules(optdict['--rules'])
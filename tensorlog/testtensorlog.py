@@ -15,23 +15,39 @@ import math
 import os
 import os.path
 import shutil
+import socket
 import tempfile
 import scipy
+import numpy as NP
 
 from tensorlog import comline
+from tensorlog import countmin
 from tensorlog import dataset
 from tensorlog import dbschema
+from tensorlog import dbslice
 from tensorlog import declare
 from tensorlog import expt
 from tensorlog import funs
 from tensorlog import interp
 from tensorlog import learn
 from tensorlog import matrixdb
+from tensorlog import memory
+from tensorlog import minerules
 from tensorlog import mutil
+from tensorlog import opfunutil
+from tensorlog import ops
 from tensorlog import parser
 from tensorlog import plearn
 from tensorlog import program
+from tensorlog import pserver
+from tensorlog import reorder
+from tensorlog import subtreecache
+from tensorlog import synthkb
+from tensorlog import typeinfer
 from tensorlog import util
+from tensorlog.bench import measure as benchmeasure
+from tensorlog.bench import results as benchresults
+from tensorlog.bench import workloads as benchworkloads
 
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__),"test-data/")
@@ -574,6 +590,101 @@ class TestGrad(unittest.TestCase):
     updates = learner.crossEntropyGrad(mode,data.get_x(),data.get_y())
     return prog,updates
 
+  def test_gradient_buffers(self):
+    rules = rules_from_strings(['p(X,Z):-sister(X,Y),child(Y,Z).','p(X,Y):-parent(Y,X).'])
+    prog = program.Program(db=self.db,rules=rules)
+    prog.db.clearParameterMarkings()
+    for key in [('sister',2),('child',2),('parent',2)]:
+      prog.db.markAsParameter(*key)
+    mode = declare.ModeDeclaration('p(i,o)')
+    data = DataBuffer(self.db)
+    data.add_data_symbols('william',['caroline','elizabeth'])
+    data.add_data_symbols('lottie',['charlotte'])
+    X,Y = data.get_x(),data.get_y()
+    def sparseGrad():
+      learner = learn.OnePredFixedRateGDLearner(prog)
+      learner.gradBuffers = None
+      return learner.crossEntropyGrad(mode,X,Y)
+    expected = sparseGrad()
+    saved = learn.conf.denseGradientLimit
+    try:
+      for limit in [saved,0]:
+        learn.conf.denseGradientLimit = limit
+        learner = learn.OnePredFixedRateGDLearner(prog)
+        for trial in range(2):
+          updates = learner.crossEntropyGrad(mode,X,Y)
+          self.assertEqual(sorted(updates.keys()),sorted(expected.keys()))
+          for key,m in expected.items():
+            # cells outside the parameter's pattern are dropped
+            inPattern = prog.db.getParameter(*key).multiply(m)!=0
+            self.assertTrue(NP.allclose(updates[key].toarray(),m.multiply(inPattern).toarray() if limit==0 else m.toarray()))
+          buffers = dict(learner.gradBuffers.buffer)
+          # buffers are reused, and are all zero between minibatches
+          for buf in buffers.values():
+            self.assertFalse(NP.any(buf.data))
+        self.assertEqual(buffers,learner.gradBuffers.buffer)
+    finally:
+      learn.conf.denseGradientLimit = saved
+
+  def test_updates_are_not_converted(self):
+    # parent(Y,X) needs the update transposed, and the other rules don't
+    rules = rules_from_strings(['p(X,Z):-sister(X,Y),child(Y,Z).','p(X,Y):-parent(Y,X).'])
+    prog = program.Program(db=self.db,rules=rules)
+    prog.db.clearParameterMarkings()
+    for key in [('sister',2),('child',2),('parent',2)]:
+      prog.db.markAsParameter(*key)
+    mode = declare.ModeDeclaration('p(i,o)')
+    data = DataBuffer(self.db)
+    data.add_data_symbols('william',['caroline','elizabeth'])
+    data.add_data_symbols('lottie',['charlotte'])
+    learner = learn.OnePredFixedRateGDLearner(prog)
+    learner.gradBuffers = None
+    with mutil.trackCopies() as tracker:
+      learner.crossEntropyGrad(mode,data.get_x(),data.get_y())
+    self.assertEqual(tracker.copies.get('VecMatMulOp update',0), 0)
+    # each of the three parameter lookups converts one operand
+    self.assertEqual(tracker.copies.get('VecMatMulOp operand',0), 3)
+
+  def test_buffers_sum_repeated_cells(self):
+    self.db.markAsParameter('child',2)
+    m = self.db.getParameter('child',2)
+    i,j = m.nonzero()
+    cells = [(i[0],j[0]),(i[0],j[0]),(i[1],j[1])]
+    # a gradient with a repeated cell, which is not in canonical form
+    indptr = NP.concatenate([[0],NP.cumsum(NP.bincount([c[0] for c in cells],minlength=m.shape[0]))])
+    grad = scipy.sparse.csr_matrix((NP.array([1.0,2.0,4.0],dtype=mutil.DATA_DTYPE),NP.array([c[1] for c in cells],dtype=mutil.INDEX_DTYPE),
+                                    indptr.astype(mutil.INDEX_DTYPE)),shape=m.shape)
+    self.assertFalse(grad.has_canonical_format)
+    saved = learn.conf.denseGradientLimit
+    try:
+      for limit in [saved,0]:
+        learn.conf.denseGradientLimit = limit
+        paramGrads = learn.GradAccumulator(buffers=learn.GradientBuffers(),db=self.db)
+        paramGrads.accum(('child',2),grad)
+        paramGrads._flushBuffers()
+        actual = paramGrads.runningSum[('child',2)]
+        self.assertEqual(actual[i[0],j[0]],3.0)
+        self.assertEqual(actual[i[1],j[1]],4.0)
+    finally:
+      learn.conf.denseGradientLimit = saved
+
+  def test_pattern_buffer_fits(self):
+    m = self.db.relationMatrix('child',2)
+    buf = learn._PatternGradientBuffer(m)
+    # a different matrix with the same pattern fits
+    self.assertTrue(buf.fits(m.copy()))
+    moved = m.copy()
+    moved.indices[0] = (moved.indices[0]+1) % moved.shape[1]
+    self.assertFalse(buf.fits(moved))
+    # a pattern changed in place no longer fits
+    saved = m.indices[0]
+    try:
+      m.indices[0] = (saved+1) % m.shape[1]
+      self.assertFalse(buf.fits(m))
+    finally:
+      m.indices[0] = saved
+    self.assertTrue(buf.fits(m))
+
 class TestProPPR(unittest.TestCase):
 
   def setUp(self):
@@ -1008,6 +1119,113 @@ class TestDataset(unittest.TestCase):
       self.assertEqual(s[i,0], 1.0)
     dataset.conf.normalize_outputs = saved_config
 
+  def testChunkedLoadExamples(self):
+    db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts'))
+    with open(os.path.join(TEST_DATA_DIR,'toytrain.examples')) as fp:
+      lines = fp.readlines()
+    filename = os.path.join(tempfile.mkdtemp(),'big.examples')
+    with open(filename,'w') as fp:
+      for k in range(20):
+        fp.writelines(lines)
+      fp.write('predict(unknownDoc,Y)\t+predict(unknownDoc,pos)\t+predict(unknownDoc,neg)\n')
+    saved = (dataset.conf.parse_chunk_lines,dataset.conf.parse_chunk_bytes)
+    try:
+      dset = dataset.Dataset.loadExamples(db,filename,proppr=True,processes=1)
+      # split into several chunks, which are parsed by a process pool
+      dataset.conf.parse_chunk_lines = 7
+      dataset.conf.parse_chunk_bytes = 1000
+      chunked = dataset.Dataset.loadExamples(db,filename,proppr=True,processes=3)
+    finally:
+      (dataset.conf.parse_chunk_lines,dataset.conf.parse_chunk_bytes) = saved
+    mode = declare.asMode('predict/io')
+    self.assertEqual(chunked.modesToLearn(),[mode])
+    X,Y = dset.getX(mode),dset.getY(mode)
+    self.assertEqual(mutil.numRows(X),20*len(lines)+1)
+    for m1,m2 in [(chunked.getX(mode),X),(chunked.getY(mode),Y)]:
+      self.assertEqual(m1.shape,m2.shape)
+      self.assertEqual((m1-m2).nnz,0)
+    # the rows match those built from the parsed lines one by one
+    for i,line in enumerate(lines + ['predict(unknownDoc,Y)\t+predict(unknownDoc,pos)\t+predict(unknownDoc,neg)']):
+      row = i if i<len(lines) else mutil.numRows(X)-1
+      _,x,ys = dataset.Dataset._parseLine(line,proppr=True)
+      self.assertEqual(list(db.matrixAsSymbolDict(X[row]).values())[0],
+                       {x if db.schema.hasId(db.schema.defaultType(),x) else matrixdb.OOV_ENTITY_NAME:1.0})
+      self.assertEqual(list(db.matrixAsSymbolDict(Y[row]).values())[0],dict((y,1.0/len(ys)) for y in ys))
+
+  def testMemmapDataset(self):
+    filename = os.path.join(TEST_DATA_DIR,'matchtoy-train.exam')
+    direc = os.path.join(tempfile.mkdtemp(),'matchtoy.mdset')
+    # tiny chunks, so rows for a mode are appended several times
+    mdset = dataset.MemmapDataset.fromExamples(self.db,filename,direc,linesPerChunk=1)
+    dset = dataset.Dataset.loadExamples(self.db,filename)
+    self.assertEqual(set(mdset.modesToLearn()),set(dset.modesToLearn()))
+    for mode in dset.modesToLearn():
+      for m1,m2 in [(mdset.getX(mode),dset.getX(mode)),(mdset.getY(mode),dset.getY(mode))]:
+        self.assertFalse(m1.data.flags.owndata)
+        self.assertEqual(m1.indices.dtype,mutil.INDEX_DTYPE)
+        self.assertEqual((m1-m2).nnz,0)
+    # every example appears exactly once in a shuffled epoch
+    mdset = comline.parseDatasetSpec(direc,self.db)
+    for mode,bx,by in mdset.minibatchIterator(batchSize=1):
+      self.assertEqual(mutil.numRows(bx),1)
+    n = sum(mutil.numRows(bx) for (_,bx,_) in mdset.minibatchIterator(batchSize=1))
+    self.assertEqual(n,sum(mutil.numRows(dset.getX(mode)) for mode in dset.modesToLearn()))
+    for mode,bx,by in mdset.minibatchIterator(batchSize=10):
+      self.assertEqual(self.db.matrixAsSymbolDict(bx).keys(),self.db.matrixAsSymbolDict(by).keys())
+      self.check_dicts(self.db.matrixAsSymbolDict(mutil.shuffleRows(bx,NP.arange(mutil.numRows(bx)))),
+                       self.db.matrixAsSymbolDict(bx))
+
+  def testParallelLearnerOnMemmapDataset(self):
+    filename = os.path.join(TEST_DATA_DIR,'matchtoy-train.exam')
+    mdset = dataset.MemmapDataset.fromExamples(self.db,filename,os.path.join(tempfile.mkdtemp(),'matchtoy.mdset'))
+    dset = dataset.Dataset.loadExamples(self.db,filename)
+    def train(trainData):
+      db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'matchtoy.cfacts'))
+      prog = program.ProPPRProgram.loadRules(os.path.join(TEST_DATA_DIR,"matchtoy.ppr"),db=db)
+      prog.setRuleWeights(db.ones())
+      learner = plearn.ParallelFixedRateGDLearner(prog,epochs=2,parallel=2,miniBatchSize=1,
+                                                  tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent)
+      try:
+        learner.train(trainData)
+        P = learner.datasetPredict(trainData)
+      finally:
+        learner.pool.terminate()
+        learner.pool.join()
+      return db.getParameter('weighted',1),P
+    w1,P1 = train(mdset)
+    w2,P2 = train(dset)
+    # minibatches are shuffled, so gradients are summed in different orders
+    self.assertTrue(NP.allclose(w1.toarray(),w2.toarray(),atol=1e-4))
+    # training shuffles the rows of an in-memory dataset, so match
+    # the predictions by their inputs
+    def byInput(P,mode):
+      xs = self.db.matrixAsSymbolDict(P.getX(mode))
+      ys = self.db.matrixAsSymbolDict(P.getY(mode))
+      return dict((tuple(sorted(xs[i].keys())),ys[i]) for i in xs)
+    for mode in dset.modesToLearn():
+      self.assertEqual(mutil.numRows(P1.getY(mode)),mutil.numRows(dset.getX(mode)))
+      predicted1,predicted2 = byInput(P1,mode),byInput(P2,mode)
+      self.assertEqual(sorted(predicted1.keys()),sorted(predicted2.keys()))
+      for x in predicted1:
+        for y in predicted1[x]:
+          self.assertAlmostEqual(predicted1[x][y],predicted2[x][y],delta=0.01)
+
+  def testPrefetchedMinibatches(self):
+    dset = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,'matchtoy-train.exam'))
+    def batches(**kw):
+      NP.random.seed(7)
+      return [(mode,bx.todense().tolist(),by.todense().tolist())
+              for (mode,bx,by) in dset.minibatchIterator(batchSize=1,**kw)]
+    self.assertEqual(batches(prefetch=0),batches(prefetch=2))
+    self.assertEqual(dset.prefetcher.stats['minibatches'],4)
+    # transforms are applied by the producer
+    items = list(dset.minibatchIterator(batchSize=1,prefetch=1,transform=lambda mode,bx,by:str(mode)))
+    self.assertEqual(sorted(items),['amatch/io','amatch/io','match/io','match/io'])
+    # stopping early shuts down the producer thread
+    for item in dset.minibatchIterator(batchSize=1,prefetch=1):
+      break
+    self.assertTrue(dset.prefetcher._thread is None)
+
   def checkMatchExamples(self,filename,proppr):
     dset = dataset.Dataset.loadExamples(self.db,filename,proppr=proppr)
     modes = dset.modesToLearn()
@@ -1049,6 +1267,242 @@ class TestMatrixUtils(unittest.TestCase):
       self.assertTrue('poppy' in di)
       self.assertEqual(len(list(di.keys())), 2)
 
+  def testDtypePolicy(self):
+    for m in [self.row1, self.db.ones(), self.db.zeros(3), self.db.nullMatrix(2),
+              self.db.matrix(declare.asMode('parent(o,i)'))]:
+      self.assertEqual(m.data.dtype, mutil.DATA_DTYPE)
+      self.assertEqual(m.indices.dtype, mutil.INDEX_DTYPE)
+      self.assertEqual(m.indptr.dtype, mutil.INDEX_DTYPE)
+    # no conversion needed, so the arrays are shared
+    m = mutil.asCSR(self.row1)
+    self.assertTrue(m is self.row1)
+    stacked = mutil.stack([self.row1,self.db.onehot('william'),self.row1])
+    sub = mutil.selectRows(stacked,1,3)
+    self.assertTrue(isinstance(sub,scipy.sparse.csr_matrix))
+    self.assertTrue(sub.data.base is not None)
+    self.assertEqual(self.db.matrixAsSymbolDict(sub),
+                     {0:{'william':1.0}, 1:{'william':1.0,'poppy':1.0}})
+
+  def testSoftmaxCrossEntropy(self):
+    # rows with and without scores for the null entity, and an empty row
+    scores = mutil.stack([self.row1*2.0, self.db.onehot('william')+self.db.nullMatrix(1)*3.0,
+                          self.db.zeros(1), self.db.onehot('poppy')*50.0])
+    Y = mutil.stack([self.db.onehot('poppy'), self.db.onehot('william'),
+                     self.db.onehot('sarah'), self.db.onehot('poppy')])
+    P,rowLoss,delta = mutil.softmaxCrossEntropy(self.db,scores,Y)
+    # compare to the unfused computation
+    smoothed = (self.db.nullMatrix(4,numCols=mutil.numCols(scores))*-10 + scores).toarray()
+    expected = NP.where(smoothed!=0,NP.exp(smoothed - smoothed.max(axis=1,keepdims=True)),0)
+    expected /= expected.sum(axis=1,keepdims=True)
+    expected[(smoothed!=0) & (expected==0)] = NP.exp(-10)
+    self.assertTrue(NP.allclose(P.toarray(),expected))
+    self.assertTrue(NP.allclose((Y-P).toarray(),delta.toarray()))
+    for i in range(4):
+      Yi,Pi = mutil.selectRows(Y,i,i+1),mutil.selectRows(P,i,i+1)
+      self.assertAlmostEqual(rowLoss[i],learn.Learner.crossEntropy(Yi,Pi),places=5)
+    self.assertTrue(NP.allclose(mutil.softmax(self.db,scores).toarray(),P.toarray()))
+
+  def testSoftmaxCrossEntropyLeavesInputs(self):
+    scores = mutil.stack([self.row1*2.0, self.db.onehot('poppy')*3.0])
+    Y = mutil.stack([self.db.onehot('poppy')+self.db.onehot('william'), self.db.onehot('poppy')])
+    expected = mutil.softmaxCrossEntropy(self.db,scores,Y)
+    def unsortedReadOnly(m):
+      # reverse the indices within each row, and share nothing with m
+      order = NP.concatenate([NP.arange(lo,hi)[::-1] for lo,hi in zip(m.indptr[:-1],m.indptr[1:])])
+      u = scipy.sparse.csr_matrix((m.data[order],m.indices[order],m.indptr.copy()),shape=m.shape)
+      for a in [u.data,u.indices,u.indptr]:
+        a.flags.writeable = False
+      return u
+    scores2,Y2 = unsortedReadOnly(scores),unsortedReadOnly(Y)
+    self.assertFalse(Y2.has_sorted_indices)
+    before = [a.copy() for a in [scores2.indices,scores2.data,Y2.indices,Y2.data]]
+    actual = mutil.softmaxCrossEntropy(self.db,scores2,Y2)
+    for a,b in zip(before,[scores2.indices,scores2.data,Y2.indices,Y2.data]):
+      self.assertEqual(list(a),list(b))
+    for m1,m2 in [(expected[0],actual[0]),(expected[2],actual[2])]:
+      self.assertTrue(NP.allclose(m1.toarray(),m2.toarray()))
+    self.assertTrue(NP.allclose(expected[1],actual[1]))
+
+  def testCsrFromCOO(self):
+    m = mutil.csrFromCOO([1.0,2.0,3.0,4.0],[1,0,1,1],[2,3,0,2],(3,4))
+    self.assertEqual(m.data.dtype, mutil.DATA_DTYPE)
+    self.assertEqual(m.todense().tolist(), [[0,0,0,2],[3,0,5,0],[0,0,0,0]])
+
+  def testPatternMatrices(self):
+    # unweighted relations are stored without a data array
+    mode = declare.asMode('child(i,o)')
+    M = self.db.matrix(mode)
+    self.assertTrue(mutil.isPatternMatrix(M))
+    self.assertTrue(mutil.matrixBytes(M) < M.data.nbytes + M.indices.nbytes + M.indptr.nbytes)
+    weighted = mutil.withExplicitWeights(M)
+    self.assertFalse(mutil.isPatternMatrix(weighted))
+    self.assertTrue(mutil.isPatternMatrix(mutil.asPatternMatrix(weighted)))
+    self.assertFalse(mutil.isPatternMatrix(mutil.asPatternMatrix(weighted*2.0)))
+    # transposes and products agree with the general versions
+    MT = self.db.matrix(mode,transpose=True)
+    self.assertTrue(mutil.isPatternMatrix(MT))
+    self.assertEqual(MT.toarray().tolist(),M.toarray().T.tolist())
+    X = mutil.stack([self.db.onehot('william')*2.0,self.db.zeros(1),self.db.onehot('lottie')])
+    self.assertEqual(mutil.matmul(X,M).toarray().tolist(),(X*weighted).toarray().tolist())
+    X2 = X + mutil.stack([self.db.zeros(2),self.db.onehot('rachel')])
+    self.assertEqual(mutil.matmul(X2,M).toarray().tolist(),(X2*weighted).toarray().tolist())
+    self.assertEqual(self.db.matrixPreimage(mode).toarray().tolist(),
+                     (self.db.ones()*weighted.transpose()).toarray().tolist())
+    # parameters get real weights, so they can be updated in place
+    self.db.markAsParameter('child',2)
+    self.assertFalse(mutil.isPatternMatrix(self.db.getParameter('child',2)))
+
+  def testTrackCopies(self):
+    with mutil.trackCopies() as tracker:
+      mutil.asDataArray(self.row1.data)
+      self.assertEqual(tracker.total(), 0)
+      mutil.asDataArray(self.row1.data.astype('float64'),'upcast')
+      self.assertEqual(tracker.copies['upcast'], 1)
+    with mutil.trackCopies(strict=True):
+      self.assertRaises(AssertionError, mutil.asDataArray, self.row1.data.astype('float64'))
+
+  def testNoCopiesInTraining(self):
+    db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts'))
+    prog = program.ProPPRProgram.loadRules(os.path.join(TEST_DATA_DIR,"textcat.ppr"),db=db)
+    prog.setAllWeights()
+    dset = dataset.Dataset.loadExamples(db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+    learner = learn.FixedRateSGDLearner(prog,epochs=2,tracer=learn.Tracer.silent,miniBatchSize=3)
+    learner.epochTracer = learn.EpochTracer.silent
+    with mutil.trackCopies(strict=True) as tracker:
+      learner.train(dset)
+    self.assertEqual(tracker.total(), 0)
+
+class TestOptimizers(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts'))
+    self.prog = program.ProPPRProgram.loadRules(os.path.join(TEST_DATA_DIR,"textcat.ppr"),db=self.db)
+    self.prog.setAllWeights()
+    self.trainData = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+    self.testData = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,"toytest.examples"),proppr=True)
+
+  def testPatternHelpers(self):
+    p = scipy.sparse.csr_matrix(NP.array([[1.0,0,2.0],[0,3.0,0]],dtype='float32'))
+    g = scipy.sparse.csr_matrix(NP.array([[0,5.0,6.0],[0,7.0,0]],dtype='float32'))
+    self.assertEqual(list(mutil.patternPositions(p,g)), [-1,1,2])
+    u,positions = mutil.unionPattern(p,g)
+    self.assertEqual(u.nnz,4)
+    self.assertEqual(list(u.data[positions]),list(p.data))
+    self.assertEqual((u-p).nnz,0)
+
+  def checkOptimizer(self,optimizer,rate):
+    weights0 = self.db.getParameter('weighted',1)
+    learner = learn.FixedRateSGDLearner(self.prog,epochs=10,rate=rate,tracer=learn.Tracer.silent,
+                                        miniBatchSize=3,optimizer=optimizer)
+    learner.epochTracer = learn.EpochTracer.silent
+    learner.train(self.trainData)
+    P = learner.datasetPredict(self.testData)
+    self.assertEqual(learn.Learner.datasetAccuracy(self.testData,P), 1.0)
+    for key,m in [(k,self.db.getParameter(*k)) for k in self.db.paramList]:
+      self.assertTrue(NP.all(m.data>=0))
+      for arr in optimizer.state[key].values():
+        self.assertEqual(len(arr),m.nnz)
+    # the optimizer works on its own copy of the parameters
+    self.assertFalse(weights0 is self.db.getParameter('weighted',1))
+
+  def testAdaGrad(self):
+    self.checkOptimizer(learn.AdaGradOptimizer(),0.5)
+
+  def testRMSProp(self):
+    self.checkOptimizer(learn.RMSPropOptimizer(),0.05)
+
+  def testAdam(self):
+    self.checkOptimizer(learn.AdamOptimizer(),0.05)
+
+  def testLazyUpdates(self):
+    optimizer = learn.AdaGradOptimizer()
+    learner = learn.FixedRateSGDLearner(self.prog,tracer=learn.Tracer.silent,optimizer=optimizer)
+    mode = self.trainData.modesToLearn()[0]
+    X = mutil.selectRows(self.trainData.getX(mode),0,1)
+    Y = mutil.selectRows(self.trainData.getY(mode),0,1)
+    paramGrads = learner.crossEntropyGrad(mode,X,Y)
+    touched = set(self.db.matrixAsSymbolDict(paramGrads['weighted',1])[0].keys())
+    w0 = self.db.rowAsSymbolDict(self.db.getParameter('weighted',1))
+    learner.applyUpdate(paramGrads,0.5)
+    w1 = self.db.rowAsSymbolDict(self.db.getParameter('weighted',1))
+    for feature in w0:
+      if feature not in touched:
+        self.assertEqual(w0[feature],w1[feature])
+
+  def testInPlaceFixedPattern(self):
+    learner = learn.FixedRateSGDLearner(self.prog,tracer=learn.Tracer.silent)
+    def gradient():
+      paramGrads = learn.GradAccumulator()
+      paramGrads[('weighted',1)] = self.db.ones() * 0.1
+      paramGrads.reshaped = True
+      return paramGrads
+    # keep only some of the features in the pattern of the weights
+    w = self.db.getParameter('weighted',1)
+    half = mutil.csr(w.data[::2].copy(),w.indices[::2].copy(),[0,len(w.data[::2])],w.shape)
+    self.db.setParameter('weighted',1,half)
+    learner.applyUpdate(gradient(),1.0)
+    w1 = self.db.getParameter('weighted',1)
+    self.assertFalse(w1 is half)
+    learner.applyUpdate(gradient(),1.0)
+    w2 = self.db.getParameter('weighted',1)
+    # later updates are done in place, on the original pattern
+    self.assertTrue(w2 is w1)
+    self.assertEqual(list(w2.indices),list(half.indices))
+    self.assertTrue(NP.allclose(w2.data,half.data+0.2))
+    # growable parameters can gain non-zeros
+    self.db.markAsGrowable('weighted',1)
+    learner.applyUpdate(gradient(),1.0)
+    self.assertEqual(self.db.getParameter('weighted',1).nnz,self.db.dim())
+
+  def testLearnsOutsidePattern(self):
+    # paths to the corners of a grid are learned with weights for
+    # pairs of cells that aren't edges
+    def train(growable):
+      kb = synthkb.grid(8)
+      db = kb.toMatrixDB()
+      prog = program.Program(db=db,rules=parser.RuleCollection())
+      for r in kb.rules:
+        prog.rules.add(parser.Parser().parseRule(r))
+      prog.maxDepth = 4
+      if growable:
+        db.markAsGrowable('edge',2)
+      dset = kb.toDataset(db)
+      learner = learn.FixedRateGDLearner(prog,epochs=20,rate=0.05,tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent)
+      learner.train(dset)
+      mode = declare.asMode('path/io')
+      return learner.accuracy(dset.getY(mode),learner.predict(mode,dset.getX(mode))),db
+    acc,db = train(True)
+    self.assertEqual(acc,1.0)
+    self.assertTrue(db.getParameter('edge',2).nnz > synthkb.grid(8).toMatrixDB().getParameter('edge',2).nnz)
+    # on the fixed pattern of the edges, the corners aren't learned
+    acc,_ = train(False)
+    self.assertTrue(acc < 0.5)
+
+  def testLazyL2(self):
+    reg = learn.L2Regularizer(0.1)
+    w0 = self.db.getParameter('weighted',1).copy()
+    stored,_ = self.db.getScaledParameter('weighted',1)
+    for i in range(3):
+      reg.regularizeParams(self.prog,1)
+    # shrinking the weights doesn't touch the stored matrix
+    m,scale = self.db.getScaledParameter('weighted',1)
+    self.assertTrue(m is stored)
+    self.assertAlmostEqual(scale,0.9**3)
+    def eagerCost():
+      w = self.db.getParameter('weighted',1)
+      return 0.1*(w.data.astype('float64')**2).sum()
+    self.assertAlmostEqual(reg.regularizationCost(self.prog),0.1*0.9**6*(w0.data.astype('float64')**2).sum(),places=4)
+    # the sum of squares is maintained by updates, and is correct after training
+    learner = learn.FixedRateSGDLearner(self.prog,epochs=3,regularizer=reg,tracer=learn.Tracer.silent,miniBatchSize=3)
+    learner.epochTracer = learn.EpochTracer.silent
+    learner.train(self.trainData)
+    lazyCost = reg.regularizationCost(self.prog)
+    self.assertAlmostEqual(lazyCost,eagerCost(),places=4)
+    # reading the parameter folds the scale into it
+    self.assertEqual(self.db.getScaledParameter('weighted',1)[1],1.0)
+    P = learner.datasetPredict(self.testData)
+    self.assertEqual(learn.Learner.datasetAccuracy(self.testData,P), 1.0)
+
 class TestTypes(unittest.TestCase):
 
   def setUp(self):
@@ -1185,6 +1639,684 @@ class TestTypeSemantics(unittest.TestCase):
     fun = self.prog.compile(declare.asMode("predict/io"))
     self.assertEqual(fun.outputType, "label")
 
+class TestTypeInference(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.rules = parser.RuleCollection()
+    self.rules.add(parser.Parser().parseRule('inlaw(X,Y):-spouse(X,Z),sister(Z,Y).'))
+
+  def testInferAndRetype(self):
+    argTypes = typeinfer.inferTypes(self.db,self.rules)
+    # parents and siblings are the same kind of thing
+    self.assertEqual(argTypes[('sister',2)],[argTypes[('child',2)][0]]*2)
+    self.assertEqual(argTypes[('parent',2)],list(reversed(argTypes[('child',2)])))
+    self.assertTrue('# :- child(%s)' % ','.join(argTypes[('child',2)]) in typeinfer.declarations(argTypes))
+    typedDb = typeinfer.retype(self.db,argTypes)
+    report = typeinfer.TypeReport(self.db,typedDb)
+    self.assertTrue(max(report.typeDims.values()) < report.untypedDim)
+    self.assertTrue(report.typedBytes < report.untypedBytes)
+    # the typed database gives the same answers
+    mode = declare.asMode('inlaw(i,o)')
+    untypedProg = program.Program(db=self.db,rules=self.rules)
+    typedProg = program.Program(db=typedDb,rules=self.rules)
+    for x in ['susan','william']:
+      expected = self.db.rowAsSymbolDict(untypedProg.evalSymbols(mode,[x]))
+      if x=='susan': self.assertTrue('sarah' in expected)
+      actual = typedDb.rowAsSymbolDict(typedProg.evalSymbols(mode,[x],typeName=argTypes[('spouse',2)][0]),
+                                       typeName=argTypes[('sister',2)][1])
+      self.assertEqual(sorted(expected.keys()),sorted(actual.keys()))
+      for k in expected:
+        self.assertAlmostEqual(expected[k],actual[k],places=5)
+
+  def testRetypeReadsCurrentValues(self):
+    self.db.markAsParameter('child',2)
+    total = self.db.getParameter('child',2).sum()
+    self.db.scaleParameter('child',2,0.5)
+    # relations predating the new symbols are smaller than db.dim()
+    self.db.addFacts('sister',2,[('newsister','susan')])
+    self.db.flushUpdates()
+    self.db.addFacts('friend',2,[('x','y')])
+    argTypes = typeinfer.inferTypes(self.db)
+    self.assertTrue(('friend',2) in argTypes)
+    typedDb = typeinfer.retype(self.db,argTypes)
+    self.assertAlmostEqual(typedDb.getParameter('child',2).sum(),0.5*total,places=5)
+    self.assertTrue(typedDb.isParameter(declare.asMode('child(i,o)')))
+
+class TestReorder(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.rules = parser.RuleCollection()
+    self.rules.add(parser.Parser().parseRule('inlaw(X,Y):-spouse(X,Z),sister(Z,Y).'))
+    self.mode = declare.asMode('inlaw(i,o)')
+
+  def answers(self):
+    prog = program.Program(db=self.db,rules=self.rules)
+    return [self.db.rowAsSymbolDict(prog.evalSymbols(self.mode,[x])) for x in ['susan','william']]
+
+  def testReorderPreservesAnswers(self):
+    for method in ['rcm','degree']:
+      expected = self.answers()
+      williamId = self.db.schema.getId(None,'william')
+      onehot = self.db.onehot('william')
+      maps = reorder.reorderDB(self.db,method=method)
+      oldToNew = maps[dbschema.THING]
+      # the special entities keep their ids
+      self.assertEqual(list(oldToNew[:3]),[0,1,2])
+      self.assertEqual(self.db.schema.getId(None,'william'),oldToNew[williamId])
+      self.assertEqual(self.db.schema.getSymbol(None,oldToNew[williamId]),'william')
+      self.assertEqual(self.db.onehot('william').indices[0],oldToNew[onehot.indices[0]])
+      self.assertEqual(self.answers(),expected)
+
+  def testReorderDataset(self):
+    xs = mutil.stack([self.db.onehot('susan'),self.db.onehot('william')])
+    dset = dataset.Dataset({self.mode:xs},{self.mode:xs})
+    maps = reorder.reorderDB(self.db,method='degree')
+    relabeled = reorder.reorderDataset(dset,maps[dbschema.THING])
+    X = relabeled.getX(self.mode)
+    self.assertEqual(self.db.rowAsSymbolDict(mutil.selectRows(X,0,1)),{'susan':1.0})
+    self.assertEqual(self.db.rowAsSymbolDict(mutil.selectRows(X,1,2)),{'william':1.0})
+
+  def testCompiledConstantsAfterReorder(self):
+    self.rules.add(parser.Parser().parseRule('kid(X,Y) :- assign(Y,william).'))
+    self.rules.add(parser.Parser().parseRule('kidp(X,Y) :- child(Y,Z),assign(Z,lucas).'))
+    prog = program.Program(db=self.db,rules=self.rules)
+    prog.enableQueryCache()
+    modes = [declare.asMode('kid(i,o)'),declare.asMode('kidp(i,o)')]
+    before = [self.db.rowAsSymbolDict(prog.evalSymbols(mode,['susan'])) for mode in modes]
+    reorder.reorderDB(self.db,method='degree')
+    # functions compiled and queries cached before renumbering
+    after = [self.db.rowAsSymbolDict(prog.evalSymbols(mode,['susan'])) for mode in modes]
+    fresh = program.Program(db=self.db,rules=self.rules)
+    expected = [self.db.rowAsSymbolDict(fresh.evalSymbols(mode,['susan'])) for mode in modes]
+    self.assertEqual(after,expected)
+    self.assertEqual(after,before)
+    self.assertTrue('lottie' in after[1])
+
+  def testReorderAfterUpdates(self):
+    # older relations are smaller than the current dimension after
+    # new symbols are added
+    self.db.addFacts('child',2,[('newkid','susan')])
+    self.db.flushUpdates()
+    self.db.addFacts('friend',2,[('x','y')])
+    for method in ['rcm','degree']:
+      order = reorder.entityOrder(self.db,method=method)
+      self.assertEqual(sorted(order),list(range(self.db.dim())))
+
+  def testBenchmark(self):
+    queries = reorder.sampleQueries(self.db,numQueries=10)
+    self.assertTrue(('child',2) in queries)
+    stats = reorder.benchmark(self.db,queries,repeats=1)
+    self.assertTrue(0.0 <= stats['densify_rate'] <= 1.0)
+
+class TestCountMin(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.rules = parser.RuleCollection()
+    self.rules.add(parser.Parser().parseRule('inlaw(X,Y):-spouse(X,Z),sister(Z,Y).'))
+    self.mode = declare.asMode('inlaw(i,o)')
+    self.exact = program.Program(db=self.db,rules=self.rules)
+    self.exact.normalize = 'none'
+
+  def testEmbedding(self):
+    e = countmin.TypeEmbedding(self.db.dim(),width=7,depth=2)
+    self.assertEqual(e.buckets.shape,(self.db.dim(),2))
+    # the special entities are not hashed
+    self.assertEqual(e.buckets[1].tolist(),[1,1])
+    self.assertTrue(NP.all(e.buckets[3:]>=countmin.NUM_RESERVED_IDS))
+    self.assertTrue(NP.all(e.buckets<e.dim))
+    # decoding an embedded k-hot vector finds all of its entities
+    x = self.db.onehot('william') + self.db.onehot('susan')*2.0
+    decoded = self.db.rowAsSymbolDict(e.decode(e.embed(x)))
+    self.assertTrue(decoded['william']>=1.0)
+    self.assertTrue(decoded['susan']>=2.0)
+
+  def testInference(self):
+    expected = self.db.rowAsSymbolDict(self.exact.evalSymbols(self.mode,['susan']))
+    for width,depth in [(10,2),(1000,1),(1000,3)]:
+      cdb = countmin.CountMinDB(self.db,width=width,depth=depth)
+      self.assertEqual(cdb.edb.dim(),width+countmin.NUM_RESERVED_IDS)
+      actual = self.db.rowAsSymbolDict(cdb.evalSymbols(cdb.program(self.rules),self.mode,['susan']))
+      # count-min estimates never miss an answer or underestimate it
+      for k in expected:
+        self.assertTrue(actual[k] >= expected[k]-1e-5)
+      if width>=1000:
+        self.assertEqual(sorted(actual.keys()),sorted(expected.keys()))
+
+  def testEmbedsCurrentValues(self):
+    self.db.markAsParameter('child',2)
+    before = countmin.CountMinDB(self.db,width=50,depth=2)
+    self.db.scaleParameter('child',2,0.5)
+    # new symbols make the older relations smaller than db.dim()
+    self.db.addFacts('sister',2,[('newsister','susan')])
+    self.db.flushUpdates()
+    self.db.addFacts('friend',2,[('x','y')])
+    after = countmin.CountMinDB(self.db,width=50,depth=2)
+    self.assertTrue(('friend',2) in after.relations)
+    self.assertAlmostEqual(after.edb.getParameter('child',2).sum(),0.5*before.edb.getParameter('child',2).sum(),places=4)
+
+  def testTradeoff(self):
+    X = mutil.stack([self.db.onehot(s) for s in ['susan','william']])
+    dset = dataset.Dataset({self.mode:X},{self.mode:X})
+    results = countmin.tradeoff(self.db,self.rules,dset,[10,1000],depth=1)
+    self.assertEqual([r['width'] for r in results],[10,1000])
+    for r in results:
+      self.assertEqual(r['recall'],1.0)
+    self.assertEqual(results[-1]['precision'],1.0)
+
+class TestRuleMiner(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+
+  def testMine(self):
+    rules = minerules.mineRules(self.db)
+    self.assertTrue('child(X,Y):-parent(Y,X) {ifInv_child_parent}.\t#score 0.000' in rules)
+    self.assertTrue('spouse(X,Y):-spouse(Y,X) {ifInv_spouse_spouse}.\t#score 0.000' in rules)
+    # every rule parses, and is scored by a log probability
+    for r in rules:
+      ruleString,scoreString = r.split('\t')
+      parser.Parser().parseRule(ruleString)
+      self.assertTrue(float(scoreString.split()[1]) <= 0.0)
+    self.assertEqual(minerules.mineRules(self.db,parallel=2),rules)
+    self.assertEqual(minerules.mineRules(self.db,minSupport=1000),[])
+
+  def testChains(self):
+    db = matrixdb.MatrixDB()
+    db.addLines(['p\ta\tc\n','q\ta\tb\n','q\ta\td\n','r\tb\tc\n','r\td\te\n'])
+    rules = minerules.mineRules(db)
+    # one of the two q-r paths is a p fact
+    self.assertTrue('p(X,Y):-q(X,Z),r(Z,Y) {chain_p_q_r}.\t#score %.3f' % math.log(0.5) in rules)
+
+class TestDBSlice(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.rules = parser.RuleCollection()
+    self.rules.add(parser.Parser().parseRule('aunt(X,Y):-sister(X,Z),child(Z,Y).'))
+    self.rules.add(parser.Parser().parseRule('isWilliam(X,Y):-assign(Y,william).'))
+    self.rules.add(parser.Parser().parseRule('inlaw(X,Y):-spouse(X,Z),sister(Z,Y).'))
+    self.prog = program.Program(db=self.db,rules=self.rules)
+    self.modes = ['aunt/io','isWilliam/io']
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def testReachability(self):
+    self.assertEqual(dbslice.relationsNeeded(self.prog,self.modes),[('child',2),('sister',2)])
+    self.assertEqual(dbslice.constantsNeeded(self.prog,self.modes),[('william',None)])
+
+  def testSliceAndLazyLoad(self):
+    sliced = dbslice.sliceForProgram(self.prog,self.modes)
+    self.assertEqual(sorted(sliced.matEncoding.keys()),[('child',2),('sister',2)])
+    self.assertTrue(sliced.dim() < self.db.dim())
+    sliced.serialize(self.tmpDir,perRelation=True)
+    lazyDb = matrixdb.MatrixDB.deserialize(self.tmpDir,lazy=True)
+    self.assertEqual(lazyDb.numMatrices(),2)
+    self.assertFalse(lazyDb.matEncoding.isLoaded(('sister',2)))
+    # sizes of relations that aren't loaded are known without reading them
+    self.assertEqual(lazyDb.relationBytes(),sliced.relationBytes())
+    self.assertEqual(typeinfer.matrixBytes(lazyDb),typeinfer.matrixBytes(sliced))
+    self.assertFalse(lazyDb.matEncoding.isLoaded(('sister',2)))
+    # the slice gives the same answers, and only reads what it uses
+    lazyProg = program.Program(db=lazyDb,rules=self.rules)
+    mode = declare.asMode('isWilliam(i,o)')
+    self.assertTrue(lazyDb.rowAsSymbolDict(lazyProg.evalSymbols(mode,['rachel'])).get('william',0)>0.5)
+    self.assertFalse(lazyDb.matEncoding.isLoaded(('sister',2)))
+    mode = declare.asMode('aunt(i,o)')
+    for x in ['william','rachel']:
+      expected = self.db.rowAsSymbolDict(self.prog.evalSymbols(mode,[x]))
+      actual = lazyDb.rowAsSymbolDict(lazyProg.evalSymbols(mode,[x]))
+      self.assertEqual(sorted(expected.keys()),sorted(actual.keys()))
+      for k in expected:
+        self.assertAlmostEqual(expected[k],actual[k],places=5)
+    # unweighted relations are loaded as pattern matrices
+    self.assertTrue(mutil.isPatternMatrix(lazyDb.matEncoding[('sister',2)]))
+    self.assertTrue(lazyDb.matEncoding.isLoaded(('sister',2)))
+    # without lazy loading, everything is read at once
+    eagerDb = matrixdb.MatrixDB.deserialize(self.tmpDir)
+    self.assertEqual(eagerDb.size(),sliced.size())
+
+  def testSliceReadsCurrentValues(self):
+    self.db.markAsParameter('child',2)
+    total = self.db.getParameter('child',2).sum()
+    self.db.scaleParameter('child',2,0.5)
+    # relations predating the new symbols are smaller than db.dim()
+    self.db.addFacts('sister',2,[('newsister','susan')])
+    self.db.flushUpdates()
+    self.db.addFacts('friend',2,[('x','y')])
+    sliced = dbslice.sliceDB(self.db,[('child',2),('sister',2),('friend',2)])
+    self.assertAlmostEqual(sliced.getParameter('child',2).sum(),0.5*total,places=5)
+    self.assertEqual(sliced.rowAsSymbolDict(sliced.onehot('newsister')*sliced.matrix(declare.asMode('sister(i,o)'))),{'susan':1.0})
+
+class TestBench(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def testWorkloadsAreDeterministic(self):
+    for name in ['grid','chain']:
+      files1 = benchworkloads.makeWorkload(name,'tiny').generate(os.path.join(self.tmpDir,'a'))
+      files2 = benchworkloads.makeWorkload(name,'tiny').generate(os.path.join(self.tmpDir,'b'))
+      for f1,f2 in [(files1.facts,files2.facts),(files1.train,files2.train),(files1.test,files2.test)]:
+        self.assertEqual(open(f1).read(),open(f2).read())
+
+  def testMeasureAndCompare(self):
+    workload = benchworkloads.makeWorkload('chain','tiny')
+    result = benchmeasure.measureWorkload(workload,self.tmpDir,repeats=1,parallel=(1,),numQueries=10)
+    for metric in ['load_sec','compile_fps','query_p50_ms','query_p99_ms','batch_qps','epoch_sec','peak_rss_mb']:
+      self.assertTrue(result['metrics'][metric] > 0)
+    self.assertEqual(result['scaling']['1']['speedup'],1.0)
+    base = {'workloads':{'chain':result}}
+    fileName = os.path.join(self.tmpDir,'base.json')
+    benchresults.save(base,fileName)
+    self.assertEqual(benchresults.load(fileName),base)
+    self.assertFalse(any(c[-1] for c in benchresults.compare(base,base)))
+    # slower epochs and fewer queries per second are regressions
+    worse = {'workloads':{'chain':{'params':result['params'],'metrics':dict(result['metrics']),'scaling':{}}}}
+    worse['workloads']['chain']['metrics']['epoch_sec'] *= 100
+    worse['workloads']['chain']['metrics']['batch_qps'] /= 2
+    regressed = [c[1] for c in benchresults.compare(base,worse) if c[-1]]
+    self.assertEqual(sorted(regressed),['batch_qps','epoch_sec'])
+
+  def testSamplingScaling(self):
+    scaling = benchmeasure.samplingScaling([4,6],self.tmpDir,repeats=1,numNegatives=2)
+    self.assertTrue(scaling['4']['entities'] < scaling['6']['entities'])
+    for n in ['4','6']:
+      full,sampled = scaling[n]['full'],scaling[n]['sampled']
+      for k in ['eval_sec','loss_sec','backprop_sec']:
+        self.assertTrue(full[k] > 0 and sampled[k] > 0)
+      # the sampled softmax is over fewer answers
+      self.assertTrue(sampled['softmax_cells'] < full['softmax_cells'])
+
+class TestSyntheticKB(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def facts(self,db):
+    result = {}
+    for (functor,arity),m in list(db.matEncoding.items()):
+      for goal,weight in list(db.matrixAsPredicateFacts(functor,arity,m).items()):
+        result[str(goal)] = round(float(weight),5)
+    return result
+
+  def testBinaryMatchesText(self):
+    for kb in [synthkb.grid(5),synthkb.powerLaw(200),synthkb.typedMultiRelational(50),synthkb.smokers(20)]:
+      direc = tempfile.mkdtemp(dir=self.tmpDir)
+      db = kb.write(direc)
+      kb.writeCFacts(os.path.join(direc,'kb.cfacts'))
+      textDb = matrixdb.MatrixDB.loadFile(os.path.join(direc,'kb.cfacts'))
+      lazyDb = matrixdb.MatrixDB.deserialize(os.path.join(direc,'db'),lazy=True)
+      self.assertEqual(self.facts(textDb),self.facts(lazyDb))
+      self.assertEqual(textDb.paramList,kb.parameters)
+      if kb.examples:
+        kb.writeExamples(os.path.join(direc,'kb.exam'))
+        textData = dataset.Dataset.loadExamples(textDb,os.path.join(direc,'kb.exam'))
+        binaryData = dataset.MemmapDataset(os.path.join(direc,'examples'))
+        self.assertEqual(sorted(map(str,textData.modesToLearn())),sorted(map(str,binaryData.modesToLearn())))
+        for mode in textData.modesToLearn():
+          self.assertEqual(binaryData.getY(mode).nnz,textData.getY(mode).nnz)
+
+  def testGrid(self):
+    kb = synthkb.grid(4)
+    db = kb.toMatrixDB()
+    # corners have 4 edges, including the self-loop
+    self.assertEqual(len(db.rowAsSymbolDict(db.matrix(declare.asMode('edge(i,o)'))[db.schema.getId(None,'1,1')])),4)
+    prog = program.Program(db=db,rules=parser.RuleCollection())
+    for r in kb.rules:
+      prog.rules.add(parser.Parser().parseRule(r))
+    dset = kb.toDataset(db)
+    mode = declare.asMode('path/io')
+    self.assertEqual(prog.eval(mode,[dset.getX(mode)]).shape,dset.getY(mode).shape)
+
+class TestMemory(unittest.TestCase):
+
+  def setUp(self):
+    self.prog = program.ProPPRProgram.loadRules(
+        os.path.join(TEST_DATA_DIR,'textcat.ppr'),
+        db=matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts')))
+    self.prog.setFeatureWeights()
+    self.dset = dataset.Dataset.loadExamples(
+        self.prog.db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+    self.saved = (memory.conf.budget,memory.conf.probe_rows)
+
+  def tearDown(self):
+    memory.conf.budget,memory.conf.probe_rows = self.saved
+
+  def chunkTiny(self):
+    # one-row chunks after a two-row probe
+    memory.conf.budget,memory.conf.probe_rows = 1,2
+
+  def assertMatrixClose(self,m1,m2):
+    self.assertEqual(m1.shape,m2.shape)
+    self.assertTrue(NP.allclose(m1.toarray(),m2.toarray(),atol=1e-6))
+
+  def testMessageBytes(self):
+    pad = opfunutil.Scratchpad()
+    mode = self.dset.modesToLearn()[0]
+    self.prog.getPredictFunction(mode).eval(self.prog.db,[self.dset.getX(mode)],pad)
+    sizes = memory.messageBytes(pad)
+    self.assertTrue(sizes)
+    self.assertEqual(memory.padBytes(pad),sum(sizes.values()))
+    self.assertTrue(memory.padBytes(pad)>0)
+    relSizes = self.prog.db.relationBytes()
+    self.assertTrue(relSizes[('weighted',1)]>0)
+    self.assertTrue(util.memusage()>0)
+    self.assertTrue(util.peakMemusage()>=util.memusage())
+
+  def testChunksNeeded(self):
+    self.assertFalse(memory.needsChunking(1000))
+    self.chunkTiny()
+    self.assertFalse(memory.needsChunking(2))
+    self.assertTrue(memory.needsChunking(3))
+    spans = []
+    def evalRows(lo,hi):
+      spans.append((lo,hi))
+      return hi-lo,100*(hi-lo)
+    self.assertEqual(memory.evalInChunks(evalRows,5,budget=200),[2,2,1])
+    self.assertEqual(spans,[(0,2),(2,4),(4,5)])
+
+  def testChunkedEvalMatches(self):
+    learner = learn.OnePredFixedRateGDLearner(self.prog)
+    for mode in self.dset.modesToLearn():
+      X,Y = self.dset.getX(mode),self.dset.getY(mode)
+      self.assertTrue(mutil.numRows(X)>2)
+      memory.conf.budget = 0
+      P = self.prog.eval(mode,[X])
+      predicted = learner.predict(mode,X)
+      grads = learner.crossEntropyGrad(mode,X,Y)
+      expected = dict((k,m.copy()) for (k,m) in grads.items())
+      self.chunkTiny()
+      self.assertMatrixClose(self.prog.eval(mode,[X]),P)
+      self.assertMatrixClose(learner.predict(mode,X),predicted)
+      chunkedGrads = learner.crossEntropyGrad(mode,X,Y)
+      self.assertEqual(sorted(chunkedGrads.keys()),sorted(expected.keys()))
+      for k,m in list(expected.items()):
+        self.assertMatrixClose(chunkedGrads[k],m)
+      self.assertEqual(chunkedGrads.counter['n'],grads.counter['n'])
+
+class TestParameterServer(unittest.TestCase):
+
+  def setUp(self):
+    self.prog = program.ProPPRProgram.loadRules(
+        os.path.join(TEST_DATA_DIR,'textcat.ppr'),
+        db=matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts')))
+    self.prog.setFeatureWeights()
+    self.dset = dataset.Dataset.loadExamples(
+        self.prog.db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+
+  def params(self):
+    return dict((key,self.prog.db.getParameter(*key).toarray()) for key in self.prog.db.paramList)
+
+  def crossEntropy(self):
+    learner = learn.FixedRateGDLearner(self.prog)
+    return learn.Learner.datasetCrossEntropy(self.dset,learner.datasetPredict(self.dset),perExample=False)
+
+  def testEncoding(self):
+    mats = [scipy.sparse.csr_matrix(NP.array([[0.0,1.5,0.0],[2.0,0.0,-3.0]])),
+            scipy.sparse.csr_matrix((1,7)),
+            mutil.asCSR(scipy.sparse.random(50,40,density=0.1,format='csr',random_state=0))]
+    for m in mats:
+      m2 = pserver.decodeMatrix(bytearray(pserver.encodeMatrix(m)))
+      self.assertEqual(m2.shape,m.shape)
+      self.assertEqual(m2.dtype,mutil.DATA_DTYPE)
+      self.assertTrue(NP.allclose(m2.toarray(),m.toarray()))
+    a,b = socket.socketpair()
+    try:
+      pserver.sendMessage(a,{'op':'test','keys':[['w',1]]},mats)
+      header,received = pserver.recvMessage(b)
+      self.assertEqual(header,{'op':'test','keys':[['w',1]]})
+      self.assertEqual(len(received),len(mats))
+      for m,m2 in zip(mats,received):
+        self.assertTrue(NP.allclose(m2.toarray(),m.toarray()))
+      a.close()
+      self.assertRaises(EOFError,pserver.recvMessage,b)
+    finally:
+      b.close()
+
+  def testSynchronousMatchesBatch(self):
+    # with one minibatch per worker, a synchronous epoch is a step of
+    # batch gradient descent
+    numExamples = mutil.numRows(self.dset.getX(self.dset.modesToLearn()[0]))
+    self.assertEqual(len(self.dset.modesToLearn()),1)
+    initial = self.params()
+    learn.FixedRateGDLearner(self.prog,epochs=1,tracer=learn.Tracer.silent,epochTracer=learn.EpochTracer.silent).train(self.dset)
+    expected = self.params()
+    for (functor,arity),v in list(initial.items()):
+      self.prog.db.setParameter(functor,arity,mutil.asCSR(scipy.sparse.csr_matrix(v)))
+    learner = pserver.DistributedFixedRateSGDLearner(
+        self.prog,epochs=1,parallel=2,staleness=0,miniBatchSize=(numExamples+1)//2,
+        epochTracer=learn.EpochTracer.silent)
+    learner.train(self.dset)
+    actual = self.params()
+    for key in expected:
+      self.assertFalse(NP.allclose(initial[key],expected[key]))
+      self.assertTrue(NP.allclose(actual[key],expected[key],atol=1e-5))
+
+  def testLearns(self):
+    for staleness in [0,2]:
+      self.setUp()
+      before = self.crossEntropy()
+      learner = pserver.DistributedFixedRateSGDLearner(
+          self.prog,epochs=5,parallel=3,staleness=staleness,miniBatchSize=2,
+          epochTracer=learn.EpochTracer.silent)
+      learner.train(self.dset)
+      self.assertTrue(self.crossEntropy() < before)
+
+class TestNegativeSampling(unittest.TestCase):
+
+  def setUp(self):
+    kb = synthkb.grid(6)
+    self.db = kb.toMatrixDB()
+    self.prog = program.Program(db=self.db,rules=parser.RuleCollection())
+    for r in kb.rules:
+      self.prog.rules.add(parser.Parser().parseRule(r))
+    self.prog.maxDepth = 4
+    self.dset = kb.toDataset(self.db)
+    self.mode = declare.asMode('path/io')
+    self.X,self.Y = self.dset.getX(self.mode),self.dset.getY(self.mode)
+
+  def crossEntropy(self):
+    P = self.prog.eval(self.mode,[self.X])
+    return learn.Learner.crossEntropy(self.Y,P,perExample=False)
+
+  def testKeepsGoldAndSupport(self):
+    unnorm = self.prog.getPredictFunction(self.mode).fun.eval(self.db,[self.X],opfunutil.Scratchpad())
+    for proposal in learn.NegativeSampler.proposals:
+      sampler = learn.NegativeSampler(self.db,numNegatives=3,proposal=proposal)
+      candidates = sampler.candidates(self.Y)
+      restricted = sampler.restrict(unnorm,candidates,self.Y)
+      self.assertEqual(restricted.shape,unnorm.shape)
+      self.assertTrue(NP.all(mutil.patternPositions(candidates,restricted)>=0))
+      self.assertTrue(restricted.nnz < unnorm.nnz)
+      # only answers with non-zero scores are kept
+      self.assertTrue(NP.all(mutil.patternPositions(unnorm,restricted)>=0))
+      # gold answers are kept, with uncorrected scores
+      goldPos = mutil.patternPositions(restricted,self.Y)
+      self.assertTrue(NP.all(goldPos>=0))
+      self.assertTrue(NP.allclose(restricted.data[goldPos],unnorm.data[mutil.patternPositions(unnorm,self.Y)]))
+      # sampled negatives have their scores increased
+      self.assertTrue(NP.all(restricted.data >= unnorm.data[mutil.patternPositions(unnorm,restricted)] - 1e-5))
+    q = learn.NegativeSampler(self.db,proposal='frequency').proposalProbabilities(None,self.db.dim())
+    self.assertAlmostEqual(q.sum(),1.0)
+    self.assertEqual(q[1],0.0)
+    # corner cells have fewer neighbors, so are proposed less often
+    self.assertTrue(q[self.db.schema.getId(None,'1,1')] < q[self.db.schema.getId(None,'2,2')])
+
+  def testProposalCountsRelationsUsed(self):
+    corner,middle = self.db.schema.getId(None,'1,1'),self.db.schema.getId(None,'2,2')
+    self.db.addFacts('landmark',2,[('%d,%d' % (i,j),'1,1') for i in range(1,7) for j in range(1,7)])
+    sampler = learn.NegativeSampler(self.db,proposal='frequency')
+    q = sampler.proposalProbabilities(None,self.db.dim())
+    self.assertTrue(q[corner] > q[middle])
+    # facts in relations the predict function doesn't read are not counted
+    relations = self.prog.getPredictFunction(self.mode).fun.relationsUsed()
+    self.assertFalse(('landmark',2) in relations)
+    q = sampler.proposalProbabilities(None,self.db.dim(),relations)
+    self.assertTrue(q[corner] < q[middle])
+    # pending updates are counted
+    self.db.addFacts('edge',2,[('%d,%d' % (i,j),'1,1') for i in range(1,7) for j in range(1,7)])
+    q = sampler.proposalProbabilities(None,self.db.dim(),relations)
+    self.assertTrue(q[corner] > q[middle])
+
+  def testEvaluatesOnlyCandidates(self):
+    fun = self.prog.getPredictFunction(self.mode).fun
+    full = fun.eval(self.db,[self.X],opfunutil.Scratchpad())
+    candidates = learn.NegativeSampler(self.db,numNegatives=3).candidates(self.Y)
+    pad = opfunutil.Scratchpad()
+    pad[fun.id].candidates = candidates
+    restricted = fun.eval(self.db,[self.X],pad)
+    # fewer cells are computed, and the candidates have their full scores
+    self.assertTrue(restricted.nnz < full.nnz)
+    expected = mutil.restrictToPattern(full,candidates)
+    self.assertTrue(NP.allclose(mutil.restrictToPattern(restricted,candidates).toarray(),expected.toarray()))
+
+  def testMatchesFullSoftmax(self):
+    # with enough negatives every answer is drawn, and the corrections
+    # vanish
+    full = learn.FixedRateGDLearner(self.prog,tracer=learn.Tracer.silent)
+    sampled = learn.FixedRateGDLearner(self.prog,tracer=learn.Tracer.silent,
+                                       sampler=learn.NegativeSampler(self.db,numNegatives=50*self.db.dim(),proposal='uniform'))
+    expected = full.crossEntropyGrad(self.mode,self.X,self.Y)
+    actual = sampled.crossEntropyGrad(self.mode,self.X,self.Y)
+    self.assertTrue(NP.allclose(actual[('edge',2)].toarray(),expected[('edge',2)].toarray(),atol=1e-6))
+
+  def testLearns(self):
+    for proposal in learn.NegativeSampler.proposals:
+      self.setUp()
+      before = self.crossEntropy()
+      learner = learn.FixedRateSGDLearner(
+          self.prog,epochs=5,miniBatchSize=6,tracer=learn.Tracer.silent,
+          sampler=learn.NegativeSampler(self.db,numNegatives=4,proposal=proposal))
+      learner.epochTracer = learn.EpochTracer.silent
+      learner.train(self.dset)
+      self.assertTrue(self.crossEntropy() < before)
+
+class TestSubtreeCache(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts'))
+    self.prog = program.ProPPRProgram.loadRules(os.path.join(TEST_DATA_DIR,"textcat.ppr"),db=self.db)
+    self.prog.setAllWeights()
+    self.trainData = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+
+  def train(self,budget):
+    saved = subtreecache.conf.budget
+    subtreecache.conf.budget = budget
+    NP.random.seed(0)
+    try:
+      learner = learn.FixedRateSGDLearner(self.prog,epochs=4,tracer=learn.Tracer.silent,miniBatchSize=3)
+      learner.epochTracer = learn.EpochTracer.silent
+      learner.train(self.trainData)
+    finally:
+      subtreecache.conf.budget = saved
+    return learner
+
+  def testPlan(self):
+    fun = self.prog.getPredictFunction(declare.asMode('predict/io')).fun
+    plans = [f.memoPlan for f in self.allFunctions(fun) if isinstance(f,funs.OpSeqFunction) and f.memoPlan and f.memoPlan.cachedVars]
+    self.assertTrue(plans)
+    for plan in plans:
+      skipped = set(f for op in plan.skippedOps for f,a in op.relationsUsed())
+      self.assertTrue('hasWord' in skipped)
+      self.assertFalse('weighted' in skipped)
+      for op in plan.fixedOps:
+        self.assertFalse(('weighted',1) in op.relationsUsed())
+
+  def allFunctions(self,fun):
+    result = [fun]
+    for child in fun.children():
+      if isinstance(child,funs.Function):
+        result.extend(self.allFunctions(child))
+      elif isinstance(child,ops.DefinedPredOp):
+        result.extend(self.allFunctions(child.subfun))
+    return result
+
+  def testSameResult(self):
+    self.train(0)
+    expected = self.db.getParameter('weighted',1).toarray()
+    self.setUp()
+    learner = self.train(subtreecache.conf.budget)
+    actual = self.db.getParameter('weighted',1).toarray()
+    self.assertTrue(NP.allclose(expected,actual,atol=1e-6))
+    self.assertTrue(learner.subtreeCache.hits > 0)
+    self.assertTrue(learner.subtreeCache.bytes > 0)
+
+  def testBudgetAndInvalidation(self):
+    learner = self.train(subtreecache.conf.budget)
+    mode = self.trainData.modesToLearn()[0]
+    X,Y = self.trainData.getX(mode),self.trainData.getY(mode)
+    hits = learner.subtreeCache.hits
+    learner.crossEntropyGrad(mode,X,Y)
+    self.assertTrue(learner.subtreeCache.hits > hits)
+    # changing a relation read by the cached ops makes the cache stale
+    self.db._bumpVersion(('hasWord',2))
+    misses = learner.subtreeCache.misses
+    learner.crossEntropyGrad(mode,X,Y)
+    self.assertTrue(learner.subtreeCache.misses > misses)
+    # a tiny budget keeps almost nothing
+    cache = subtreecache.SubtreeCache(budget=1)
+    learner.subtreeCache = cache
+    learner.crossEntropyGrad(mode,X,Y)
+    self.assertTrue(cache.bytes <= 1)
+
+class TestAsyncTracer(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts'))
+    self.prog = program.ProPPRProgram.loadRules(os.path.join(TEST_DATA_DIR,"textcat.ppr"),db=self.db)
+    self.prog.setAllWeights()
+    self.trainData = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,"toytrain.examples"),proppr=True)
+
+  def train(self,tracer):
+    NP.random.seed(0)
+    learner = learn.FixedRateSGDLearner(self.prog,epochs=3,miniBatchSize=2,tracer=tracer)
+    counters = []
+    learner.epochTracer = lambda learner,ctr,**kw: counters.append(dict(ctr))
+    learner.train(self.trainData)
+    return counters
+
+  def testMatchesSynchronous(self):
+    expected = self.train(learn.Tracer.recordDefaults)
+    self.setUp()
+    tracer = learn.AsyncTracer(every=1)
+    actual = self.train(tracer)
+    for e,a in zip(expected,actual):
+      for key in [('crossEnt','tot'),('loss','tot'),('n','tot')]:
+        self.assertAlmostEqual(e[key],a[key],places=4)
+      self.assertEqual(a['measured'],a['counters'])
+    self.assertEqual(tracer.stats['measured'],3*6)
+
+  def testSampled(self):
+    tracer = learn.AsyncTracer(every=4,rows=1,accuracy=True)
+    counters = self.train(tracer)
+    for ctr in counters:
+      # minibatches 1 and 5 of the 6 in each epoch are measured
+      self.assertEqual(ctr['measured'],2)
+      self.assertEqual(ctr[('n','tot')],11)
+      self.assertTrue(ctr[('crossEnt','tot')]>0)
+      self.assertTrue(0.0<=ctr[('acc','avg')]<=1.0)
+    self.assertTrue(tracer.stats['callTime']>0)
+
+  def testErrorsAreRaised(self):
+    def brokenAccuracy(Y,P):
+      raise ValueError('broken')
+    tracer = learn.AsyncTracer(accuracy=True)
+    learner = learn.FixedRateSGDLearner(self.prog,epochs=1,miniBatchSize=2,tracer=tracer)
+    learner.accuracy = brokenAccuracy
+    learner.epochTracer = learn.EpochTracer.silent
+    self.assertRaises(ValueError,learner.train,self.trainData)
+
 class TestTrainableDeclarations(unittest.TestCase):
 
   def testIt(self):
@@ -1235,6 +2367,180 @@ class TestParser(unittest.TestCase):
         for r1,r2 in zip(keydef1,keydef2):
           equalRule(r1,r2)
 
+class TestIncrementalUpdates(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.mode = declare.asMode('child(i,o)')
+
+  def weight(self,a1,a2):
+    m = self.db.matrix(self.mode)
+    return m[self.db.asSymbolId(a1),self.db.asSymbolId(a2)]
+
+  def testAddRemoveUpsert(self):
+    v0 = self.db.getVersion('child',2)
+    self.db.addFacts('child',2,[('william','josh'),('william','newkid')],[1.0,2.0])
+    self.assertTrue(self.db.getVersion('child',2)>v0)
+    self.assertEqual(self.weight('william','josh'), 2.0)
+    self.assertEqual(self.weight('william','newkid'), 2.0)
+    self.db.removeFacts('child',2,[('william','josh'),('nobody','josh')])
+    self.assertEqual(self.weight('william','josh'), 0.0)
+    self.db.upsertWeights('child',2,[('william','susan'),('william','josh')],[0.5,3.0])
+    self.db.addFacts('child',2,[('william','josh')])
+    self.assertEqual(self.weight('william','susan'), 0.5)
+    self.assertEqual(self.weight('william','josh'), 4.0)
+    mutil.checkCSR(self.db.matrix(self.mode))
+
+  def testZeroWeightsAreRemoved(self):
+    nnz0 = self.db.matrix(self.mode).nnz
+    self.db.upsertWeights('child',2,[('william','josh'),('william','susan')],[0.0,0.5])
+    self.db.removeFacts('child',2,[('william','charlie')])
+    m = self.db.matrix(self.mode)
+    self.assertEqual(m.nnz, nnz0-1)
+    self.assertFalse(NP.any(m.data==0.0))
+    # a deletion followed by an addition sets the weight
+    self.db.removeFacts('child',2,[('william','susan')])
+    self.db.addFacts('child',2,[('william','susan'),('william','susan')],[1.0,2.0])
+    self.assertEqual(self.weight('william','susan'), 3.0)
+
+  def testGrowingDims(self):
+    n0 = self.db.dim()
+    self.db.addFacts('sister',2,[('newperson1','newperson2')])
+    self.assertEqual(self.db.dim(),n0+2)
+    # untouched relations grow as well
+    for functor in ['child','sister']:
+      m = self.db.matrix(declare.asMode('%s(i,o)' % functor))
+      self.assertEqual(m.shape,(n0+2,n0+2))
+    self.assertEqual(self.weight('william','josh'), 1.0)
+
+  def testNewUnaryRelation(self):
+    self.assertFalse(self.db.inDB('tall',1))
+    self.db.addFacts('tall',1,['william','rachel'])
+    self.assertTrue(self.db.inDB('tall',1))
+    d = self.db.rowAsSymbolDict(self.db.vector(declare.asMode('tall(o)')))
+    self.assertEqual(d, {'william':1.0,'rachel':1.0})
+
+  def testMergeThreshold(self):
+    saved = matrixdb.conf.update_merge_threshold
+    try:
+      matrixdb.conf.update_merge_threshold = 2
+      self.db.addFacts('child',2,[('william','josh')])
+      self.assertTrue(('child',2) in self.db._pendingUpdates)
+      self.db.addFacts('child',2,[('william','newkid')])
+      self.assertFalse(('child',2) in self.db._pendingUpdates)
+    finally:
+      matrixdb.conf.update_merge_threshold = saved
+
+  def testBufferedFactsForEncodedRelation(self):
+    self.db.addLines(['child\twilliam\tnewkid\n'])
+    self.assertEqual(self.weight('william','newkid'), 1.0)
+    self.assertEqual(self.weight('william','josh'), 1.0)
+    # the facts buffered for a relation are merged into it at once
+    saved = matrixdb.conf.update_merge_threshold
+    merged = []
+    mergeUpdates = self.db._mergeUpdates
+    def countingMerge(key):
+      merged.append(key)
+      mergeUpdates(key)
+    try:
+      matrixdb.conf.update_merge_threshold = 2
+      self.db._mergeUpdates = countingMerge
+      self.db.addLines(['child\twilliam\tkid%d\n' % i for i in range(10)] + ['child\twilliam\tkid0\n'])
+    finally:
+      matrixdb.conf.update_merge_threshold = saved
+    self.assertEqual(merged,[('child',2)])
+    self.assertEqual(self.weight('william','kid0'), 2.0)
+    self.assertEqual(self.weight('william','kid9'), 1.0)
+
+class TestConstantFolding(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+
+  def testPreimageIsCached(self):
+    rules = parser.RuleCollection()
+    rules.add(parser.Parser().parseRule('q(X,Y):-child(X,Y),parent(Y,W).'))
+    prog = program.Program(db=self.db,rules=rules)
+    mode = declare.asMode('q(i,o)')
+    fun = prog.compile(mode)
+    folded = [op for op in fun.fun.ops if op.folded]
+    self.assertEqual([type(op) for op in folded],[ops.AssignPreimageToVar])
+    def answers():
+      return self.db.matrixAsSymbolDict(prog.eval(mode,[self.db.onehot('william')]))[0]
+    self.assertEqual(list(answers().keys()),['__NULL__'])
+    preimage = folded[0]._constant[1]
+    answers()
+    self.assertTrue(folded[0]._constant[1] is preimage)
+    # the cached preimage is recomputed when the relation changes
+    self.db.addFacts('parent',2,[('josh','william')])
+    self.assertTrue('josh' in answers())
+    self.assertFalse(folded[0]._constant[1] is preimage)
+    self.assertTrue(self.db.ones() is self.db.ones())
+
+  def testConstantCacheEvictsLeastRecentlyUsed(self):
+    saved = matrixdb.conf.constant_cache_size
+    try:
+      matrixdb.conf.constant_cache_size = 2
+      ones = self.db.ones()
+      zeros = self.db.zeros()
+      self.assertTrue(self.db.ones() is ones)
+      # zeros is now the least recently used entry
+      self.db.zeros(numRows=2)
+      self.assertTrue(self.db.ones() is ones)
+      self.assertFalse(self.db.zeros() is zeros)
+    finally:
+      matrixdb.conf.constant_cache_size = saved
+
+class TestQueryCache(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    rules = rules_from_strings(['p(X,Z):-spouse(X,Y),sister(Y,Z).','q(X,Y):-child(X,Y).'])
+    self.prog = program.Program(db=self.db,rules=rules)
+    self.cache = self.prog.enableQueryCache()
+    self.p = declare.asMode('p(i,o)')
+    self.q = declare.asMode('q(i,o)')
+
+  def testRelationsUsed(self):
+    self.assertEqual(self.prog.relationsUsed(self.p), (('sister',2),('spouse',2)))
+
+  def testHitsAndMisses(self):
+    y1 = self.prog.evalSymbols(self.p,['susan'])
+    y2 = self.prog.evalSymbols(self.p,['susan'])
+    self.assertEqual(self.cache.stats['misses'],1)
+    self.assertEqual(self.cache.stats['hits'],1)
+    self.assertEqual(self.db.rowAsSymbolDict(y1),self.db.rowAsSymbolDict(y2))
+
+  def testMinibatch(self):
+    self.prog.evalSymbols(self.p,['william'])
+    x = mutil.stack([self.db.onehot(s) for s in ['susan','william','rachel']])
+    y = self.prog.eval(self.p,[x])
+    self.assertEqual(self.cache.stats['hits'],1)
+    self.assertEqual(self.cache.stats['misses'],3)
+    self.prog.disableQueryCache()
+    expected = self.prog.eval(self.p,[x])
+    self.assertEqual((y-expected).nnz,0)
+
+  def testInvalidation(self):
+    self.prog.evalSymbols(self.p,['susan'])
+    self.prog.evalSymbols(self.q,['william'])
+    # p doesn't depend on child, so its entry survives
+    self.db.addFacts('child',2,[('william','lottie')])
+    self.prog.evalSymbols(self.p,['susan'])
+    self.assertEqual(self.cache.stats['hits'],1)
+    y = self.prog.evalSymbols(self.q,['william'])
+    self.assertEqual(self.cache.stats['invalidations'],1)
+    self.assertTrue('lottie' in self.db.rowAsSymbolDict(y))
+
+  def testEviction(self):
+    cache = self.prog.enableQueryCache(maxEntries=2)
+    for s in ['susan','william','rachel']:
+      self.prog.evalSymbols(self.p,[s])
+    self.assertEqual(len(cache),2)
+    self.assertEqual(cache.stats['evictions'],1)
+    self.prog.evalSymbols(self.p,['susan'])
+    self.assertEqual(cache.stats['hits'],0)
+
 class TestExampleLoading(unittest.TestCase):
 
   def testIt(self):
@@ -0,0 +1,251 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# infer types for the arguments of relations in an untyped database,
+# and rewrite it as a typed database, so that each type has its own,
+# smaller, id space.  Usage:
+#
+#  python -m tensorlog.typeinfer --db foo.cfacts [--prog foo.ppr] [--out typed.cfacts|typed.db] [--minShared k]
+#
+
+import getopt
+import sys
+
+import numpy as NP
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import dbschema
+from tensorlog import matrixdb
+from tensorlog import mutil
+from tensorlog import parser
+
+conf = config.Config()
+conf.min_shared = 1;  conf.help.min_shared = 'Argument positions are given the same type if they share at least this many entities'
+
+ASSIGN = 'assign'
+
+def argumentIds(m,arity):
+  """Return a list with an array for each argument of a relation with
+  matrix m, holding the distinct entity ids used in that argument."""
+  if arity==1:
+    return [NP.unique(m.indices)]
+  else:
+    return [NP.flatnonzero(NP.diff(m.indptr)),NP.unique(m.indices)]
+
+class TypeInference(object):
+  """Infers types for the argument positions (functor,arity,i) of
+  relations in an untyped database.  Two positions get the same type
+  if they share entities in the data (see addData) or the same
+  variable in a rule (see addRules).  Types are found with
+  union-find over the positions.
+  """
+
+  def __init__(self,db):
+    assert db.isTypeless(), 'type inference needs an untyped database'
+    self.db = db
+    self._parent = {}
+
+  def find(self,pos):
+    self._parent.setdefault(pos,pos)
+    root = pos
+    while self._parent[root]!=root:
+      root = self._parent[root]
+    while self._parent[pos]!=root:
+      self._parent[pos],pos = root,self._parent[pos]
+    return root
+
+  def union(self,pos1,pos2):
+    r1,r2 = self.find(pos1),self.find(pos2)
+    if r1!=r2:
+      # keep the smallest position as the root, so the type names
+      # don't depend on the order that things were unified
+      r1,r2 = min(r1,r2),max(r1,r2)
+      self._parent[r2] = r1
+
+  def addData(self,minShared=None):
+    """Unify argument positions of relations that share entities.  Each
+    entity is assigned to the first position it is seen in, and a
+    later position is unified with that position if they share at
+    least minShared entities."""
+    if minShared is None: minShared = conf.min_shared
+    owner = NP.full(self.db.dim(),-1,dtype=mutil.LONG_INDEX_DTYPE)
+    positions = []
+    for (functor,arity) in self.db.relationKeys():
+      for i,ids in enumerate(argumentIds(self.db.relationMatrix(functor,arity),arity)):
+        pos = (functor,arity,i)
+        self.find(pos)
+        positions.append(pos)
+        owners = owner[ids]
+        claimed = owners>=0
+        if NP.any(claimed):
+          counts = NP.bincount(owners[claimed])
+          for k in NP.flatnonzero(counts>=minShared):
+            self.union(positions[k],pos)
+        owner[ids[~claimed]] = len(positions)-1
+    return self
+
+  def addRules(self,rules):
+    """Unify the argument positions that share a variable in a rule.
+    Constants bound with assign/2 don't constrain types, and
+    assign/3 already declares one."""
+    for rule in rules:
+      varPositions = {}
+      for goal in [rule.lhs] + rule.rhs:
+        if goal.functor==ASSIGN: continue
+        for i,a in enumerate(goal.args):
+          if isinstance(a,int) or parser.isVariableAtom(a):
+            varPositions.setdefault(a,[]).append((goal.functor,goal.arity,i))
+      for positions in list(varPositions.values()):
+        for pos in positions[1:]:
+          self.union(positions[0],pos)
+    return self
+
+  def argTypes(self):
+    """Return a dictionary mapping each (functor,arity) pair in the
+    database to a list of type names for its arguments.  A type is
+    named after the first argument position it includes, eg the
+    type containing the second argument of actedIn/2 is
+    actedIn_2."""
+    result = {}
+    for (functor,arity) in self.db.relationKeys():
+      roots = [self.find((functor,arity,i)) for i in range(arity)]
+      result[(functor,arity)] = ['%s_%d' % (f,i+1) for (f,a,i) in roots]
+    return result
+
+def inferTypes(db,rules=None,minShared=None):
+  """Infer argument types for the relations in an untyped database,
+  using the data and optionally a collection of rules.  Returns a
+  dictionary mapping (functor,arity) pairs to lists of type names."""
+  ti = TypeInference(db).addData(minShared)
+  if rules is not None:
+    ti.addRules(rules)
+  return ti.argTypes()
+
+def declarations(argTypes):
+  """Type declarations, in the format used in .cfacts files, for a
+  dictionary produced by inferTypes."""
+  return ['# :- %s(%s)' % (functor,','.join(types)) for ((functor,arity),types) in sorted(argTypes.items())]
+
+def retype(db,argTypes):
+  """Create a typed copy of an untyped database, where the arguments
+  of relations have the types given by argTypes, and each type has
+  its own id space, containing only the entities used in that type.
+  """
+  assert db.isTypeless(), 'retype needs an untyped database'
+  typed = matrixdb.MatrixDB(initSchema=dbschema.TypedSchema())
+  for (functor,arity),types in sorted(argTypes.items()):
+    typed.schema.declarePredicateTypes(functor,types)
+  # collect the old ids used by each type, and map them to new ids
+  used = {}
+  for (functor,arity) in db.relationKeys():
+    m = db.relationMatrix(functor,arity)
+    for typeName,ids in zip(argTypes[(functor,arity)],argumentIds(m,arity)):
+      used.setdefault(typeName,[]).append(ids)
+  newId = {}
+  for typeName in sorted(used.keys()):
+    oldIds = NP.unique(NP.concatenate(used[typeName]))
+    # the special entities keep their ids in every type
+    oldIds = oldIds[oldIds>2]
+    mapping = NP.zeros(db.dim(),dtype=mutil.LONG_INDEX_DTYPE)
+    mapping[1],mapping[2] = 1,2
+    for i in oldIds:
+      mapping[i] = typed.schema.getId(typeName,db.schema.getSymbol(dbschema.THING,i))
+    newId[typeName] = mapping
+  # re-index the matrices
+  for (functor,arity) in db.relationKeys():
+    m = db.relationMatrix(functor,arity)
+    types = argTypes[(functor,arity)]
+    rows = mutil.rowIndices(m)
+    if arity==1:
+      shape = (1,typed.dim(types[0]))
+      rows = NP.zeros_like(rows)
+      cols = newId[types[0]][m.indices]
+    else:
+      shape = (typed.dim(types[0]),typed.dim(types[1]))
+      rows = newId[types[0]][rows]
+      cols = newId[types[1]][m.indices]
+    typed.matEncoding[(functor,arity)] = mutil.csrFromCOO(m.data,rows,cols,shape,'retype')
+  for (functor,arity) in db.paramList:
+    typed.markAsParameter(functor,arity)
+    if db.isGrowable(functor,arity):
+      typed.markAsGrowable(functor,arity)
+  return typed
+
+class TypeReport(object):
+  """Compare the dimensions and memory used by an untyped database and
+  a typed version of it."""
+
+  def __init__(self,db,typedDb):
+    self.untypedDim = db.dim()
+    self.typeDims = dict((t,typedDb.dim(t)) for t in typedDb.schema.getTypes())
+    self.untypedBytes = matrixBytes(db)
+    self.typedBytes = matrixBytes(typedDb)
+    # the width of the messages passed to, and output by, each argument
+    self.argDims = {}
+    for (functor,arity) in typedDb.relationKeys():
+      for i in range(arity):
+        self.argDims[(functor,arity,i)] = typedDb.dim(typedDb.schema.getArgType(functor,arity,i))
+
+  def meanArgDim(self):
+    return float(sum(self.argDims.values()))/len(self.argDims) if self.argDims else 0.0
+
+  def lines(self):
+    result = []
+    result.append('untyped dimension: %d' % self.untypedDim)
+    for t in sorted(self.typeDims, key=lambda t:-self.typeDims[t]):
+      result.append('type %s: dimension %d (%.1f%% of untyped)' % (t,self.typeDims[t],100.0*self.typeDims[t]/self.untypedDim))
+    result.append('mean argument dimension: %.1f (was %d)' % (self.meanArgDim(),self.untypedDim))
+    result.append('matrix memory: %d bytes (was %d)' % (self.typedBytes,self.untypedBytes))
+    return result
+
+  def __str__(self):
+    return '\n'.join(self.lines())
+
+def matrixBytes(db):
+  """Total size of the arrays that encode the relations in a database."""
+  return sum(db.relationBytes().values())
+
+def writeCFacts(db,fileName):
+  """Write a database, with its type declarations, as a .cfacts file."""
+  with open(fileName,'w') as fp:
+    for (functor,arity) in db.relationKeys():
+      types = [db.schema.getArgType(functor,arity,i) for i in range(arity)]
+      fp.write('# :- %s(%s)\n' % (functor,','.join(types)))
+    for (functor,arity) in db.paramList:
+      fp.write('# :- %s(%s,%d)\n' % (matrixdb.TRAINABLE_DECLARATION_FUNCTOR,functor,arity))
+    for (functor,arity) in db.relationKeys():
+      m = db.relationMatrix(functor,arity)
+      for goal,weight in sorted(db.matrixAsPredicateFacts(functor,arity,m).items(), key=lambda gw:str(gw[0])):
+        fp.write('\t'.join([goal.functor] + goal.args + ['%g' % weight]) + '\n')
+
+if __name__ == "__main__":
+  def usage():
+    print('usage: python -m tensorlog.typeinfer --db dbspec [--prog progspec] [--proppr] [--out typed.cfacts|typed.db] [--minShared k]')
+    print('  infer types for an untyped database, print declarations and a report on the reduction in dimension')
+  argspec = ["db=","prog=","proppr","out=","minShared="]
+  try:
+    optlist,args = getopt.getopt(sys.argv[1:], 'x', argspec)
+  except getopt.GetoptError:
+    usage()
+    raise
+  optdict = dict(optlist)
+  if '--db' not in optdict:
+    usage()
+    sys.exit(-1)
+  db = comline.parseDBSpec(optdict['--db'])
+  rules = None
+  if '--prog' in optdict:
+    rules = comline.parseProgSpec(optdict['--prog'],db,proppr=('--proppr' in optdict)).rules
+  minShared = int(optdict['--minShared']) if '--minShared' in optdict else None
+  argTypes = inferTypes(db,rules,minShared)
+  for decl in declarations(argTypes):
+    print(decl)
+  typedDb = retype(db,argTypes)
+  print(TypeReport(db,typedDb))
+  out = optdict.get('--out')
+  if out and out.endswith('.db'):
+    typedDb.serialize(out)
+  elif out and out.endswith('.cfacts'):
+    writeCFacts(typedDb,out)
+  elif out:
+    assert False,'--out should end in .db or .cfacts'
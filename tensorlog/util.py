@@ -1,22 +1,39 @@
 import os
 import inspect
+import resource
 
 # misc utilities
 
-def memusage():
-    """ Memory used by the current process in Gb
+def _procStatus(field):
+    """ A memory size from /proc/self/status, in Gb, or None if it can't
+    be read (eg, not on Linux)
     """
-    proc_status = '/proc/%d/status' % os.getpid()
+    scale = {'kB': 1024.0, 'mB': 1024.0*1024.0, 'KB': 1024.0, 'MB': 1024.0*1024.0}
     try:
-        t = open(proc_status)
-        v = t.read()
-        t.close()
-        i = v.index('VmSize:')
+        with open('/proc/%d/status' % os.getpid()) as t:
+            v = t.read()
+        i = v.index(field+':')
         v = v[i:].split(None,3)
-        scale = {'kB': 1024.0, 'mB': 1024.0*1024.0, 'KB': 1024.0, 'MB': 1024.0*1024.0}
         return (float(v[1]) * scale[v[2]]) / (1024.0*1024.0*1024.0)
-    except IOError:
-        return 0.0
+    except (IOError,ValueError):
+        return None
+
+def memusage():
+    """ Memory used by the current process in Gb - ie, the resident set
+    size, not the virtual size, which includes mapped files and
+    address space that was reserved but never used
+    """
+    result = _procStatus('VmRSS')
+    return result if result is not None else peakMemusage()
+
+def peakMemusage():
+    """ Largest memusage() of the current process so far, in Gb
+    """
+    result = _procStatus('VmHWM')
+    if result is None:
+        # ru_maxrss is in kilobytes on Linux
+        result = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0*1024.0)
+    return result
 
 def linesIn(fileLike):
   """ If fileLike is a string, open it as a file and return lines in the file.
@@ -360,7 +360,7 @@ class AbstractCrossCompiler(object):
     if mode not in self._wsDict:
       self.ws = self._wsDict[mode] = Workspace(self)
       startTime = time.time()
-      def status(msg): logging.info('%s time %.3f sec mem %.3f Gb' % (msg,time.time()-startTime,util.memusage()))
+      def status(msg): logging.info('%s time %.3f sec rss %.3f Gb peak %.3f Gb' % (msg,time.time()-startTime,util.memusage(),util.peakMemusage()))
       status('compiling %s'%str(mode))
       fun = self.ws.tensorlogFun = self.prog.compile(mode)
       status('tensorlog compilation complete; cross-compiling %s'%str(mode))